@@ -0,0 +1,80 @@
+"""Benchmark removing index.cnxml.html from large, media-heavy module zips.
+
+Compares the original extract-and-recompress approach with `fix_cnx_zip`,
+which copies the compressed members as they are.
+
+Usage:
+  fix_cnx_zip.py [--images=<n>] [--image-size=<kb>]
+
+Options:
+  --images=<n>          Number of images in the test module [default: 200]
+  --image-size=<kb>     Size of every image in kilobytes [default: 500]
+"""
+import os
+import time
+import zipfile
+from tempfile import TemporaryDirectory
+
+from docopt import docopt
+
+import src.utils
+from src.utils import fix_cnx_zip
+
+
+def build_module_zip(zip_path: str, images: int, image_size: int) -> None:
+    """Writes a module export zip with an index.cnxml.html file and many images.
+
+    """
+    module_id = os.path.basename(zip_path).replace(".zip", "")
+    with zipfile.ZipFile(zip_path, "w", zipfile.ZIP_DEFLATED) as zip_file:
+        zip_file.writestr(f"{module_id}/index.cnxml", "<document><para>text</para></document>" * 500)
+        zip_file.writestr(f"{module_id}/index.cnxml.html", "<html><body>text</body></html>" * 500)
+        for i in range(images):
+            # Half random, half repetitive, so deflate has some real work to do
+            image = os.urandom(image_size // 2) + bytes(image_size // 2)
+            zip_file.writestr(f"{module_id}/image{i}.png", image)
+
+
+def extract_and_recompress(zip_path: str, out_path: str) -> None:
+    """The original fix_cnx_zip: extract to a temp dir, delete, recompress.
+
+    """
+    with zipfile.ZipFile(zip_path) as zip_file, TemporaryDirectory() as tmp_dir:
+        zip_file.extractall(path=tmp_dir)
+        module_dir = os.path.join(tmp_dir, os.listdir(tmp_dir)[0])
+        os.remove(os.path.join(module_dir, "index.cnxml.html"))
+        with zipfile.ZipFile(out_path, "w") as new_zip:
+            for root, dirs, files in os.walk(module_dir):
+                for file in files:
+                    path = os.path.join(root, file)
+                    new_zip.write(path, os.path.basename(path))
+
+
+def main():
+    arguments = docopt(__doc__)
+    images = int(arguments["--images"])
+    image_size = int(arguments["--image-size"]) * 1024
+
+    with TemporaryDirectory() as tmp_dir:
+        src.utils.DOWNLOAD_PATH = tmp_dir
+        zip_path = os.path.join(tmp_dir, "m12345.zip")
+        build_module_zip(zip_path, images, image_size)
+        print(f"{images} images, {os.path.getsize(zip_path) / 2 ** 20:.0f} MB zip")
+
+        start = time.perf_counter()
+        extract_and_recompress(zip_path, os.path.join(tmp_dir, "baseline.zip"))
+        baseline = time.perf_counter() - start
+        print(f"extract and recompress  {baseline:6.2f}s")
+
+        start = time.perf_counter()
+        fixed_zip_path = fix_cnx_zip(zip_path)
+        elapsed = time.perf_counter() - start
+        print(f"raw member copy         {elapsed:6.2f}s  {baseline / elapsed:5.1f}x")
+
+        with zipfile.ZipFile(fixed_zip_path) as zip_file:
+            assert zip_file.testzip() is None
+            assert not any(name.endswith("index.cnxml.html") for name in zip_file.namelist())
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,480 @@
+"""A local stand-in for CNX Legacy: its content pages and the authoring workflow.
+
+It serves the pages the module copy workflow goes through, with the same forms
+and locators the page objects in `src.pages` use, so both the Selenium path
+and the HTTP engine can be run and timed against it:
+
+  login_form -> mycnx -> cc_license -> content_title -> module edit
+  -> module_import_form -> module_publish -> publishContent -> published
+
+It also serves the content that `download_pdfs` and `download_module` read,
+for any collection or module id:
+
+  /content/<id>/latest/query_ptool                   PDF status, ready after --pdf-ready-delay
+  /content/<id>/latest/pdf                           a PDF of --pdf-size, with Range support
+  /content/<id>/latest/latest                        redirects to the module page of version 1.5
+  /content/<id>/latest/latest/module_export?format=zip   a module zip of --zip-size with CNXML metadata
+  /content/<id>/latest/complete                      a collection zip of --collection-size such modules
+
+Every content request waits --latency seconds, and --error-rate of them are
+answered with a 503, like a legacy server under stress.
+
+The authoring pages load a stylesheet, a web font and a logo from
+/portal_static, like the legacy portal skin, each after --asset-latency
+seconds, so what a browser loads besides the forms shows in the page timings.
+
+Usage:
+  legacy_server.py [--port=<port>] [--publish-delay=<seconds>] [--site-error-rate=<rate>] [--latency=<seconds>] [--pdf-ready-delay=<seconds>] [--pdf-size=<kb>] [--zip-size=<kb>] [--error-rate=<rate>] [--asset-latency=<seconds>] [--asset-size=<kb>] [--collection-size=<n>]
+
+Options:
+  --port=<port>                 Port to listen on [default: 8080]
+  --publish-delay=<seconds>     How long publishing a module takes [default: 2]
+  --site-error-rate=<rate>      Fraction of title and publish submissions answered with a Site Error [default: 0]
+  --latency=<seconds>           Delay before every content response [default: 0]
+  --pdf-ready-delay=<seconds>   How long after its first status check a collection's PDF is ready [default: 0]
+  --pdf-size=<kb>               Size of every collection PDF in kilobytes [default: 512]
+  --zip-size=<kb>               Size of every module export zip in kilobytes [default: 256]
+  --error-rate=<rate>           Fraction of content requests answered with a 503 [default: 0]
+  --asset-latency=<seconds>     Delay before every stylesheet, font and image of the portal skin [default: 0]
+  --asset-size=<kb>             Size of the font and logo of the portal skin in kilobytes [default: 64]
+  --collection-size=<n>         Number of modules in every collection zip [default: 20]
+"""
+import asyncio
+import io
+import itertools
+import os
+import random
+import time
+import zipfile
+
+from aiohttp import web
+from docopt import docopt
+
+USERNAME = "master_splinter"
+PASSWORD = "imakeanotherfunny!"
+AUTH_COOKIE = "__ac"
+
+PAGE = """<html><head><title>{title}</title><base href="{base}" />
+<link rel="stylesheet" href="/portal_static/portal.css" /></head>
+<body><img id="portal-logo" src="/portal_static/logo.png" alt="CNX" /><div id="portal-personaltools"><a href="/logout">Log out</a></div>
+<div id="content"><div class="documentContent"><div><div>{body}</div></div></div></div></body></html>"""
+
+PDF_TIME = "2019-09-12 14:05:33.281 Universal"
+CHUNK_SIZE = 64 * 1024
+
+PORTAL_CSS = """@font-face { font-family: "Portal"; src: url("/portal_static/portal.woff") format("woff"); }
+body { font-family: "Portal", sans-serif; }"""
+
+SITE_ERROR = """<html><head><title>Site Error</title></head>
+<body><div id="content"><h2>Site Error</h2><p>An error was encountered while publishing this resource.</p>
+</div></body></html>"""
+
+
+class LegacyState:
+    """The modules the stand-in server has created and published, and how it serves content.
+
+    """
+    def __init__(self, username, password, publish_delay, site_error_rate, latency=0, pdf_ready_delay=0,
+                 pdf_size=512 * 1024, zip_size=256 * 1024, error_rate=0, asset_latency=0, asset_size=64 * 1024,
+                 collection_size=20):
+        self.username = username
+        self.password = password
+        self.publish_delay = publish_delay
+        self.site_error_rate = site_error_rate
+        self.latency = latency
+        self.pdf_ready_delay = pdf_ready_delay
+        self.pdf_size = pdf_size
+        self.zip_size = zip_size
+        self.error_rate = error_rate
+        self.asset_latency = asset_latency
+        self.asset_size = asset_size
+        self.collection_size = collection_size
+        self.sessions = set()
+        self.modules = {}
+        self.published = {}
+        self._temp_ids = itertools.count(1)
+        self._module_ids = itertools.count(60001)
+        self.site_errors = 0
+        self.content_requests = 0
+        self.content_errors = 0
+        self._first_checked = {}
+        self._pdf = None
+        self._image = None
+        self._asset = None
+
+    def site_error(self) -> bool:
+        if random.random() < self.site_error_rate:
+            self.site_errors += 1
+            return True
+        return False
+
+    def content_error(self) -> bool:
+        self.content_requests += 1
+        if random.random() < self.error_rate:
+            self.content_errors += 1
+            return True
+        return False
+
+    def is_pdf_ready(self, col_id: str) -> bool:
+        first_checked = self._first_checked.setdefault(col_id, time.monotonic())
+        return time.monotonic() - first_checked >= self.pdf_ready_delay
+
+    @property
+    def pdf(self) -> bytes:
+        if self._pdf is None:
+            self._pdf = b"%PDF-1.4\n" + os.urandom(max(0, self.pdf_size - 16)) + b"\n%%EOF\n"
+        return self._pdf
+
+    @property
+    def asset(self) -> bytes:
+        if self._asset is None:
+            self._asset = os.urandom(self.asset_size)
+        return self._asset
+
+    def module_zip(self, module_id: str) -> bytes:
+        """The export zip of a module, index.cnxml.html included, padded to `zip_size` with an image.
+
+        The index.cnxml has the metadata of version 1.5 of the module, titled
+        like its module page.
+
+        """
+        buffer = io.BytesIO()
+        with zipfile.ZipFile(buffer, "w", zipfile.ZIP_STORED) as zip_file:
+            self._write_module(zip_file, "module", module_id)
+        return buffer.getvalue()
+
+    def collection_zip(self, col_id: str) -> bytes:
+        """The complete zip of a collection: its collection.xml and a directory per module.
+
+        The collection has `collection_size` modules, each with the files of
+        its export zip.
+
+        """
+        module_ids = [f"m{20000 + i}" for i in range(self.collection_size)]
+        buffer = io.BytesIO()
+        with zipfile.ZipFile(buffer, "w", zipfile.ZIP_STORED) as zip_file:
+            directory = f"{col_id}_1.7_complete"
+            zip_file.writestr(f"{directory}/collection.xml", "".join(
+                f'<col:module document="{module_id}" version="1.5"/>' for module_id in module_ids))
+            for module_id in module_ids:
+                self._write_module(zip_file, f"{directory}/{module_id}", module_id)
+        return buffer.getvalue()
+
+    def _write_module(self, zip_file: zipfile.ZipFile, directory: str, module_id: str) -> None:
+        if self._image is None:
+            self._image = os.urandom(max(0, self.zip_size - 4096))
+        zip_file.writestr(f"{directory}/index.cnxml", f"""<?xml version="1.0"?>
+<document xmlns="http://cnx.rice.edu/cnxml" xmlns:md="http://cnx.rice.edu/mdml" id="{module_id}">
+  <title>Module {module_id}</title>
+  <metadata>
+    <md:content-id>{module_id}</md:content-id>
+    <md:title>Module {module_id}</md:title>
+    <md:version>1.5</md:version>
+    <md:language>en</md:language>
+  </metadata>
+  <content>{"<para>text</para>" * 20}</content>
+</document>""")
+        zip_file.writestr(f"{directory}/index.cnxml.html", "<html><body>text</body></html>" * 20)
+        zip_file.writestr(f"{directory}/image.png", self._image)
+
+
+def render(request, title, body, status=200, base=None):
+    base = base or str(request.url.with_query(None))
+    return web.Response(text=PAGE.format(title=title, base=base, body=body),
+                        content_type="text/html", status=status)
+
+
+def require_login(handler):
+    async def wrapper(request):
+        state = request.app["state"]
+        if request.cookies.get(AUTH_COOKIE) not in state.sessions:
+            raise web.HTTPFound("/login_form")
+        return await handler(request)
+    return wrapper
+
+
+def temp_module(request):
+    module = request.app["state"].modules.get(request.match_info["temp_id"])
+    if module is None:
+        raise web.HTTPNotFound(text="This temp module does not exist or was published")
+    return module
+
+
+def module_base(request):
+    return f"{request.url.origin()}/Members/{request.match_info['user']}/{request.match_info['temp_id']}/"
+
+
+async def login_form(request):
+    state = request.app["state"]
+    if request.method == "POST":
+        data = await request.post()
+        if data.get("__ac_name") == state.username and data.get("__ac_password") == state.password:
+            token = f"{state.username}-{random.getrandbits(64):x}"
+            state.sessions.add(token)
+            response = web.HTTPFound("/mycnx")
+            response.set_cookie(AUTH_COOKIE, token)
+            raise response
+
+    return render(request, "Log in", """
+        <div id="portlet-login"><form id="login_form" name="login_form" action="login_form" method="post">
+          <input type="hidden" name="form.submitted" value="1" />
+          <input type="hidden" name="came_from" value="" />
+          <input type="text" id="__ac_name" name="__ac_name" value="" />
+          <input type="password" id="__ac_password" name="__ac_password" value="" />
+          <input type="submit" name="submit" value="Log in" />
+        </form></div>""")
+
+
+@require_login
+async def my_cnx(request):
+    return render(request, "MyCNX", """
+        <p class="createlink"><a href="/mydashboard/cc_license?type_name=Module">Create a new module</a></p>
+        <p class="createlink"><a href="/mydashboard/cc_license?type_name=Collection">Create a new collection</a></p>
+        """, base=f"{request.url.origin()}/mycnx")
+
+
+@require_login
+async def cc_license(request):
+    state = request.app["state"]
+    if request.method == "POST":
+        data = await request.post()
+        if data.get("agree"):
+            temp_id = f"module.{next(state._temp_ids)}"
+            state.modules[temp_id] = dict(title=None, zip=None)
+            raise web.HTTPFound(f"/Members/{state.username}/{temp_id}/content_title")
+
+    return render(request, "License", """
+        <form action="cc_license" method="post">
+          <input type="hidden" name="type_name" value="Module" />
+          <input type="checkbox" name="agree" />
+          <input type="submit" name="form.button.next" value="Next" />
+        </form>""", base=f"{request.url.origin()}/mydashboard/cc_license")
+
+
+@require_login
+async def content_title(request):
+    state = request.app["state"]
+    temp_id = request.match_info["temp_id"]
+    if request.method == "POST":
+        data = await request.post()
+        if state.site_error():
+            return web.Response(text=SITE_ERROR, content_type="text/html", status=500)
+        if data.get("form.button.next") and data.get("title"):
+            state.modules[temp_id]["title"] = data["title"]
+            raise web.HTTPFound(module_base(request).rstrip("/"))
+
+    return render(request, "Metadata", """
+        <form action="content_title" method="post">
+          <input type="text" name="title" value="" />
+          <input type="submit" name="form.button.next" value="Next" />
+        </form>""", base=module_base(request))
+
+
+@require_login
+async def module_edit(request):
+    module = temp_module(request)
+    return render(request, "Module", f"""
+        <h1>Module: {module['title']}</h1>
+        <a href="{module_base(request)}module_publish">Publish</a>
+        <form action="module_import_form" method="post">
+          <select name="format">
+            <option value="plain">Plain text</option>
+            <option value="zip">Zip file</option>
+          </select>
+          <input type="submit" name="form.button.import" value="Import" />
+        </form>""", base=module_base(request))
+
+
+@require_login
+async def module_import_form(request):
+    module = temp_module(request)
+    if request.content_type == "multipart/form-data":
+        data = await request.post()
+        upload = data.get("importFile")
+        if upload is None:
+            raise web.HTTPBadRequest(text="No file was uploaded")
+        with zipfile.ZipFile(io.BytesIO(upload.file.read())) as zip_file:
+            module["zip"] = zip_file.namelist()
+        raise web.HTTPFound(module_base(request).rstrip("/"))
+
+    return render(request, "Import", """
+        <form action="module_import_form" name="import" method="post" enctype="multipart/form-data">
+          <input type="hidden" name="format" value="zip" />
+          <input type="file" name="importFile" />
+          <input type="submit" name="form.button.import" value="Import" />
+        </form>""", base=module_base(request))
+
+
+@require_login
+async def module_publish(request):
+    return render(request, "Publish", """
+        <form action="module_publish_description" method="post">
+          <textarea name="message"></textarea>
+          <input type="submit" name="form.button.publish" value="Publish" />
+        </form>""", base=module_base(request))
+
+
+@require_login
+async def module_publish_description(request):
+    data = await request.post()
+    return render(request, "Confirm", f"""
+        <form action="publishContent" method="post">
+          <input type="hidden" name="message" value="{data.get('message', '')}" />
+          <input type="submit" name="publish" value="Yes, Publish" />
+        </form>""", base=module_base(request))
+
+
+@require_login
+async def publish_content(request):
+    state = request.app["state"]
+    module = temp_module(request)
+    await asyncio.sleep(state.publish_delay)
+    if state.site_error():
+        return web.Response(text=SITE_ERROR, content_type="text/html", status=500)
+    if module["zip"] is None or any(name.endswith("index.cnxml.html") for name in module["zip"]):
+        return web.Response(text=SITE_ERROR, content_type="text/html", status=500)
+
+    module_id = f"m{next(state._module_ids)}"
+    # Like on legacy, the temp module leaves the workspace once it is published
+    state.published[module_id] = state.modules.pop(request.match_info["temp_id"])
+    return render(request, "Published", f"""
+        <table class="leftheadings"><tbody>
+          <tr><th>Name:</th><td><span>{module['title']}</span></td></tr>
+          <tr><th>ID:</th><td>{module_id}</td></tr>
+        </tbody></table>""", base=module_base(request))
+
+
+def content(handler):
+    """Delays a content response by the latency, and answers some with a 503.
+
+    """
+    async def wrapper(request):
+        state = request.app["state"]
+        await asyncio.sleep(state.latency)
+        if state.content_error():
+            raise web.HTTPServiceUnavailable(text="The server is busy")
+        return await handler(request)
+    return wrapper
+
+
+@content
+async def query_ptool(request):
+    col_id = request.match_info["id"]
+    time_cell = PDF_TIME if request.app["state"].is_pdf_ready(col_id) else ""
+    return render(request, "query_ptool", f"""
+        <table class="listing"><tr><td>{col_id}</td><td>1.7</td><td>{time_cell}</td><td>success</td></tr></table>
+        """)
+
+
+@content
+async def pdf(request):
+    body = request.app["state"].pdf
+    start, end = 0, len(body) - 1
+    range_header = request.headers.get("Range")
+    if range_header:
+        first, last = range_header.replace("bytes=", "").split("-")
+        start = int(first)
+        end = min(int(last), end) if last else end
+        if start > end:
+            raise web.HTTPRequestRangeNotSatisfiable()
+
+    response = web.StreamResponse(status=206 if range_header else 200)
+    response.content_length = end + 1 - start
+    response.content_type = "application/pdf"
+    response.headers["Accept-Ranges"] = "bytes"
+    if range_header:
+        response.headers["Content-Range"] = f"bytes {start}-{end}/{len(body)}"
+    await response.prepare(request)
+    for offset in range(start, end + 1, CHUNK_SIZE):
+        await response.write(body[offset:min(offset + CHUNK_SIZE, end + 1)])
+    await response.write_eof()
+    return response
+
+
+@content
+async def latest_module(request):
+    raise web.HTTPFound(f"/content/{request.match_info['id']}/1.5/")
+
+
+@content
+async def module_page(request):
+    module_id = request.match_info["id"]
+    return render(request, f"Module {module_id}", f"""
+        <h1 id="cnx_content_title">Module {module_id}</h1>
+        <p>The content of the module.</p>""")
+
+
+@content
+async def module_export(request):
+    return web.Response(body=request.app["state"].module_zip(request.match_info["id"]),
+                        content_type="application/zip")
+
+
+@content
+async def collection_complete(request):
+    return web.Response(body=request.app["state"].collection_zip(request.match_info["id"]),
+                        content_type="application/zip")
+
+
+async def portal_static(request):
+    state = request.app["state"]
+    await asyncio.sleep(state.asset_latency)
+    name = request.match_info["name"]
+    if name == "portal.css":
+        return web.Response(text=PORTAL_CSS, content_type="text/css")
+    if name == "portal.woff":
+        return web.Response(body=state.asset, content_type="font/woff")
+    if name == "logo.png":
+        return web.Response(body=state.asset, content_type="image/png")
+    raise web.HTTPNotFound()
+
+
+def create_app(username: str = USERNAME,
+               password: str = PASSWORD,
+               publish_delay: float = 2,
+               site_error_rate: float = 0,
+               **content_options) -> web.Application:
+    """Creates the stand-in server. `content_options` are the content settings of LegacyState.
+
+    """
+    app = web.Application(client_max_size=1024 ** 3)
+    app["state"] = LegacyState(username, password, publish_delay, site_error_rate, **content_options)
+
+    member = "/Members/{user}/{temp_id}"
+    app.router.add_route("*", "/login_form", login_form)
+    app.router.add_get("/mycnx", my_cnx)
+    app.router.add_route("*", "/mydashboard/cc_license", cc_license)
+    app.router.add_route("*", member + "/content_title", content_title)
+    app.router.add_get(member, module_edit)
+    app.router.add_route("*", member + "/module_import_form", module_import_form)
+    app.router.add_get(member + "/module_publish", module_publish)
+    app.router.add_post(member + "/module_publish_description", module_publish_description)
+    app.router.add_post(member + "/publishContent", publish_content)
+
+    app.router.add_get("/content/{id}/latest/query_ptool", query_ptool)
+    app.router.add_get("/content/{id}/latest/pdf", pdf)
+    app.router.add_get("/content/{id}/latest/latest", latest_module)
+    app.router.add_get("/content/{id}/1.5/", module_page)
+    app.router.add_get("/content/{id}/latest/latest/module_export", module_export)
+    app.router.add_get("/content/{id}/latest/complete", collection_complete)
+    app.router.add_get("/portal_static/{name}", portal_static)
+    return app
+
+
+def main():
+    arguments = docopt(__doc__)
+    app = create_app(publish_delay=float(arguments["--publish-delay"]),
+                     site_error_rate=float(arguments["--site-error-rate"]),
+                     latency=float(arguments["--latency"]),
+                     pdf_ready_delay=float(arguments["--pdf-ready-delay"]),
+                     pdf_size=int(arguments["--pdf-size"]) * 1024,
+                     zip_size=int(arguments["--zip-size"]) * 1024,
+                     error_rate=float(arguments["--error-rate"]),
+                     asset_latency=float(arguments["--asset-latency"]),
+                     asset_size=int(arguments["--asset-size"]) * 1024,
+                     collection_size=int(arguments["--collection-size"]))
+    web.run_app(app, host="127.0.0.1", port=int(arguments["--port"]))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,64 @@
+"""Micro-benchmark of reading the PDF time from a query_ptool_page.
+
+Compares the original BeautifulSoup tree search with PtoolStatusParser, which
+stops tokenizing at the time cell.
+
+Usage:
+  query_ptool_parser.py [--padding=<kb>] [--number=<n>]
+
+Options:
+  --padding=<kb>    Kilobytes of page markup before and after the status table [default: 20]
+  --number=<n>      Number of parses per measurement [default: 200]
+"""
+import timeit
+
+from bs4 import BeautifulSoup
+from docopt import docopt
+
+from src.query_ptool import PtoolStatusParser
+
+STATUS_TABLE = (
+    '<table class="listing"><tr><td>col11406</td><td>1.7</td>'
+    '<td>2019-09-12 14:05:33.281 Universal</td><td>success</td></tr></table>'
+)
+
+
+def build_page(padding: int) -> str:
+    """Builds a page shaped like the legacy query_ptool_page.
+
+    """
+    item = '<li class="navTreeItem"><a href="/content/m12345/latest/" title="A module">A module</a></li>\n'
+    filler = "<ul>" + item * (padding // len(item) + 1) + "</ul>"
+    return (f"<html><head><title>query_ptool</title></head><body>"
+            f"<div id='portal-header'>{filler}</div>{STATUS_TABLE}"
+            f"<div id='portal-footer'>{filler}</div></body></html>")
+
+
+def parse_with_soup(text: str) -> str:
+    return BeautifulSoup(text, "html.parser").findAll("td")[2].string
+
+
+def parse_with_parser(text: str) -> str:
+    parser = PtoolStatusParser()
+    parser.feed(text)
+    return parser.time_string
+
+
+def main():
+    arguments = docopt(__doc__)
+    text = build_page(int(arguments["--padding"]) * 1024)
+    number = int(arguments["--number"])
+
+    assert parse_with_soup(text).strip() == parse_with_parser(text)
+
+    print(f"{len(text) / 1024:.0f} KB page, {number} parses")
+    baseline = None
+    for name, parse in (("BeautifulSoup", parse_with_soup), ("PtoolStatusParser", parse_with_parser)):
+        elapsed = min(timeit.repeat(lambda: parse(text), number=number, repeat=3))
+        per_parse = elapsed / number * 1000
+        baseline = baseline or per_parse
+        print(f"{name:<18} {per_parse:8.3f} ms/parse  {baseline / per_parse:6.1f}x")
+
+
+if __name__ == "__main__":
+    main()
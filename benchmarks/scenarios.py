@@ -0,0 +1,177 @@
+"""Scripted end to end scenarios against the local legacy stand-in server.
+
+Every scenario starts a `benchmarks.legacy_server` with its own settings and
+runs `download_pdfs`, `copy_modules` or `copy_collection` (with the http
+engine) against it in a child process, so the peak RSS reported is that of
+the copy alone. The child gets a temporary home directory, so nothing is
+written to ~/Downloads or to the caches and journal in ~/.cache. Each scenario reports its throughput,
+the p50, p95, p99 and max of every traced stage and the peak RSS.
+
+Usage:
+  scenarios.py [<scenario>...] [--latency=<seconds>] [--error-rate=<rate>] [--pdf-ready-delay=<seconds>] [--pdf-size=<kb>] [--zip-size=<kb>] [--large-zip-size=<mb>] [--publish-delay=<seconds>] [--verbose]
+
+Scenarios:
+  pdfs-10, pdfs-100, pdfs-1000    Download the PDFs of 10, 100 or 1000 collections
+  modules-10, modules-100         Copy 10 or 100 modules
+  large-zips                      Copy 3 modules whose zips are --large-zip-size
+  collection-100                  Copy the 100 modules of a collection from its complete zip
+  All of them are run when none are given.
+
+Options:
+  --latency=<seconds>           Delay before every content response [default: 0.05]
+  --error-rate=<rate>           Fraction of content requests answered with a 503 [default: 0]
+  --pdf-ready-delay=<seconds>   How long after its first status check a collection's PDF is ready [default: 0]
+  --pdf-size=<kb>               Size of every collection PDF in kilobytes [default: 256]
+  --zip-size=<kb>               Size of every module export zip in kilobytes [default: 256]
+  --large-zip-size=<mb>         Size of the module zips of the large-zips scenario in megabytes [default: 64]
+  --publish-delay=<seconds>     How long the server takes to publish a module [default: 0.1]
+  --verbose                     Show the output of the copies
+"""
+import asyncio
+import concurrent.futures
+import contextlib
+import json
+import multiprocessing
+import os
+import resource
+import sys
+import time
+from tempfile import TemporaryDirectory
+from types import SimpleNamespace
+from typing import Dict, NamedTuple
+
+from aiohttp import web
+from docopt import docopt
+
+from benchmarks.legacy_server import PASSWORD, USERNAME, create_app
+from src.tracing import StageMetrics
+
+
+class Scenario(NamedTuple):
+    name: str
+    workflow: str
+    count: int
+    large_zips: bool = False
+
+
+SCENARIOS = [Scenario("pdfs-10", "pdfs", 10),
+             Scenario("pdfs-100", "pdfs", 100),
+             Scenario("pdfs-1000", "pdfs", 1000),
+             Scenario("modules-10", "modules", 10),
+             Scenario("modules-100", "modules", 100),
+             Scenario("large-zips", "modules", 3, large_zips=True),
+             Scenario("collection-100", "collection", 100)]
+
+# The stages whose bytes count towards the download throughput
+DOWNLOAD_STAGES = ("download_pdf", "download_module", "download_collection")
+
+
+def run_copy(workflow: str, count: int, server_url: str, home: str, verbose: bool) -> Dict:
+    """Runs one scenario's copy in a child process and returns its timings, spans and peak RSS.
+
+    """
+    # The paths in src.constants are derived from the home directory when src is first imported
+    os.environ["HOME"] = home
+    os.makedirs(os.path.join(home, "Downloads"))
+    from src.modules import copy_collection, copy_modules
+    from src.pdfs import download_pdfs
+    from src.pipeline import PipelineItem
+
+    trace_path = os.path.join(home, "trace.jsonl")
+    output = contextlib.nullcontext() if verbose else contextlib.redirect_stdout(open(os.devnull, "w"))
+    start = time.perf_counter()
+    with output:
+        if workflow == "pdfs":
+            unfinished = asyncio.run(download_pdfs(server_url, [f"col{10000 + i}" for i in range(count)],
+                                                   trace_path=trace_path))
+            done = count - len(unfinished)
+        elif workflow == "collection":
+            items = asyncio.run(copy_collection(server_url, server_url, "col10000", True, USERNAME, PASSWORD,
+                                                engine="http", trace_path=trace_path))
+            done = sum(1 for item in items if item.status == PipelineItem.DONE)
+        else:
+            items = asyncio.run(copy_modules(server_url, server_url, [f"m{10000 + i}" for i in range(count)],
+                                             True, USERNAME, PASSWORD, engine="http", trace_path=trace_path))
+            done = sum(1 for item in items if item.status == PipelineItem.DONE)
+    elapsed = time.perf_counter() - start
+
+    with open(trace_path) as trace_file:
+        spans = [json.loads(line) for line in trace_file]
+    # ru_maxrss is in kilobytes on Linux and in bytes on macOS
+    peak_rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * (1 if sys.platform == "darwin" else 1024)
+    return dict(elapsed=elapsed, done=done, spans=spans, peak_rss=peak_rss)
+
+
+async def run_scenario(scenario: Scenario, server_options: Dict, large_zip_size: int, verbose: bool) -> None:
+    if scenario.large_zips:
+        server_options = dict(server_options, zip_size=large_zip_size)
+    if scenario.workflow == "collection":
+        server_options = dict(server_options, collection_size=scenario.count)
+    app = create_app(**server_options)
+    runner = web.AppRunner(app)
+    await runner.setup()
+    site = web.TCPSite(runner, "127.0.0.1", 0)
+    await site.start()
+    port = site._server.sockets[0].getsockname()[1]
+    server_url = f"http://127.0.0.1:{port}"
+
+    loop = asyncio.get_event_loop()
+    # A fresh process per scenario, so the peak RSS of one doesn't carry over into the next
+    executor = concurrent.futures.ProcessPoolExecutor(max_workers=1,
+                                                      mp_context=multiprocessing.get_context("spawn"))
+    try:
+        with TemporaryDirectory() as home:
+            result = await loop.run_in_executor(executor, run_copy, scenario.workflow, scenario.count,
+                                                server_url, home, verbose)
+    finally:
+        executor.shutdown()
+        await runner.cleanup()
+
+    report(scenario, result, app["state"])
+
+
+def report(scenario: Scenario, result: Dict, state) -> None:
+    stages = {}
+    for span in result["spans"]:
+        stages.setdefault(span["stage"], StageMetrics()).add(SimpleNamespace(**span))
+    downloaded = sum(metrics.bytes for stage, metrics in stages.items() if stage in DOWNLOAD_STAGES)
+    elapsed = result["elapsed"]
+
+    print(f"{scenario.name}: {result['done']} of {scenario.count} done in {elapsed:.2f}s, "
+          f"{result['done'] / elapsed:.1f}/s, {downloaded / elapsed / 2 ** 20:.1f} MB/s downloaded, "
+          f"peak RSS {result['peak_rss'] / 2 ** 20:.0f} MB")
+    print(f"  server: {state.content_requests} content requests, {state.content_errors} answered with 503, "
+          f"{state.site_errors} site errors")
+    print(f"  {'stage':<24} {'count':>6} {'p50':>8} {'p95':>8} {'p99':>8} {'max':>8} {'retries':>8} {'failed':>7}")
+    for stage, metrics in sorted(stages.items()):
+        failed = sum(count for outcome, count in metrics.outcomes.items() if outcome != "ok")
+        print(f"  {stage:<24} {len(metrics.durations):>6} "
+              f"{metrics.percentile(0.5):>7.3f}s {metrics.percentile(0.95):>7.3f}s "
+              f"{metrics.percentile(0.99):>7.3f}s {metrics.max:>7.3f}s {metrics.retries:>8} {failed:>7}")
+
+
+async def run_benchmark(scenarios, server_options: Dict, large_zip_size: int, verbose: bool) -> None:
+    for scenario in scenarios:
+        await run_scenario(scenario, server_options, large_zip_size, verbose)
+
+
+def main():
+    arguments = docopt(__doc__)
+    by_name = {scenario.name: scenario for scenario in SCENARIOS}
+    unknown = [name for name in arguments["<scenario>"] if name not in by_name]
+    if unknown:
+        sys.exit(f"Unknown scenarios: {', '.join(unknown)}. Use {', '.join(by_name)}")
+    scenarios = [by_name[name] for name in arguments["<scenario>"]] or SCENARIOS
+
+    server_options = dict(publish_delay=float(arguments["--publish-delay"]),
+                          latency=float(arguments["--latency"]),
+                          error_rate=float(arguments["--error-rate"]),
+                          pdf_ready_delay=float(arguments["--pdf-ready-delay"]),
+                          pdf_size=int(arguments["--pdf-size"]) * 1024,
+                          zip_size=int(arguments["--zip-size"]) * 1024)
+    asyncio.run(run_benchmark(scenarios, server_options, int(arguments["--large-zip-size"]) * 2 ** 20,
+                              arguments["--verbose"]))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,99 @@
+"""Benchmark single stream vs. segmented downloads against a local server.
+
+The local server caps the throughput of every connection, which is how the
+legacy servers behave for large collection PDFs, so splitting a download into
+byte ranges over several connections should be close to N times faster.
+
+Usage:
+  segmented_download.py [--size=<mb>] [--rate=<mb_per_sec>] [--segments=<n>...]
+
+Options:
+  --size=<mb>             Size of the test PDF in megabytes [default: 32]
+  --rate=<mb_per_sec>     Throughput cap per connection in megabytes/sec [default: 8]
+  --segments=<n>          Segment counts to compare [default: 1 2 4 8]
+"""
+import asyncio
+import os
+import time
+from tempfile import TemporaryDirectory
+
+from aiohttp import web
+from docopt import docopt
+
+from src.utils import download_file, http_session
+
+CHUNK_SIZE = 64 * 1024
+
+
+def create_app(body: bytes, rate: float) -> web.Application:
+    """Creates an app serving `body` at /pdf at `rate` bytes/sec per connection.
+
+    """
+    async def pdf(request):
+        start, end = 0, len(body) - 1
+        range_header = request.headers.get("Range")
+        if range_header:
+            first, last = range_header.replace("bytes=", "").split("-")
+            start = int(first)
+            end = int(last) if last else end
+
+        response = web.StreamResponse(status=206 if range_header else 200)
+        response.content_length = end + 1 - start
+        response.headers["Accept-Ranges"] = "bytes"
+        if range_header:
+            response.headers["Content-Range"] = f"bytes {start}-{end}/{len(body)}"
+        await response.prepare(request)
+
+        for offset in range(start, end + 1, CHUNK_SIZE):
+            chunk = body[offset:min(offset + CHUNK_SIZE, end + 1)]
+            await response.write(chunk)
+            await asyncio.sleep(len(chunk) / rate)
+        await response.write_eof()
+        return response
+
+    app = web.Application()
+    app.router.add_get("/pdf", pdf)
+    return app
+
+
+async def run_benchmark(size: int, rate: float, segment_counts) -> None:
+    body = b"%PDF-1.4\n" + os.urandom(size) + b"\n%%EOF\n"
+    runner = web.AppRunner(create_app(body, rate))
+    await runner.setup()
+    site = web.TCPSite(runner, "127.0.0.1", 0)
+    await site.start()
+    port = site._server.sockets[0].getsockname()[1]
+    url = f"http://127.0.0.1:{port}/pdf"
+
+    print(f"{size / 2 ** 20:.0f} MB PDF, {rate / 2 ** 20:.0f} MB/s per connection")
+    baseline = None
+    try:
+        with TemporaryDirectory() as tmp_dir:
+            async with http_session() as session:
+                for segments in segment_counts:
+                    filename = os.path.join(tmp_dir, f"{segments}.pdf")
+                    start = time.perf_counter()
+                    await download_file(url, filename, session, segments=segments)
+                    elapsed = time.perf_counter() - start
+
+                    with open(filename, "rb") as f_handle:
+                        assert f_handle.read() == body, "downloaded file does not match"
+
+                    baseline = baseline or elapsed
+                    print(f"segments={segments:<3} {elapsed:6.2f}s  "
+                          f"{size / elapsed / 2 ** 20:7.1f} MB/s  {baseline / elapsed:4.1f}x")
+    finally:
+        await runner.cleanup()
+
+
+def main():
+    arguments = docopt(__doc__)
+    size = int(arguments["--size"]) * 2 ** 20
+    rate = float(arguments["--rate"]) * 2 ** 20
+    segment_counts = [int(n) for value in arguments["--segments"] for n in value.split()]
+
+    asyncio.run(run_benchmark(size, rate, segment_counts))
+
+
+if __name__ == "__main__":
+    main()
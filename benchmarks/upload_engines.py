@@ -0,0 +1,137 @@
+"""Benchmark copying modules with the HTTP engine vs. driving Chrome.
+
+Both engines upload to the stand-in legacy server in `benchmarks.legacy_server`.
+The selenium engine is only run with --selenium, since it needs Chrome and a
+chromedriver on the machine. It is run with a stock Chrome and with the
+lightweight ChromeProfile, and for both the p50, p95 and max of opening
+and loading every page and the peak RSS of a browser are reported. The
+profile template of the lightweight profile is warmed before it is timed,
+as it is kept between runs.
+
+Usage:
+  upload_engines.py [--modules=<n>] [--publish-delay=<seconds>] [--site-error-rate=<rate>] [--asset-latency=<seconds>] [--selenium] [--headless]
+
+Options:
+  --modules=<n>                 Number of modules to copy [default: 5]
+  --publish-delay=<seconds>     How long the server takes to publish a module [default: 2]
+  --site-error-rate=<rate>      Fraction of title and publish submissions answered with a Site Error [default: 0]
+  --asset-latency=<seconds>     Delay before every stylesheet, font and image of the stand-in pages [default: 0.2]
+  --selenium                    Also copy the modules by driving Chrome
+  --headless                    Run the Chrome driver in headless mode
+"""
+import asyncio
+import concurrent.futures
+import os
+import time
+import zipfile
+from tempfile import TemporaryDirectory
+
+from aiohttp import web
+from docopt import docopt
+
+from benchmarks.legacy_server import PASSWORD, USERNAME, create_app
+from src.legacy_http import copy_module_over_http
+from src.modules import copy_module_to_server
+from src.selenium import ChromeProfile, DriverPool, create_chrome_driver
+from src.sessions import SessionBroker
+from src.tracing import Tracer
+from src.utils import http_session
+
+
+def build_module_zips(tmp_dir: str, count: int):
+    """Writes `count` small module export zips, as download_module leaves them.
+
+    """
+    modules = []
+    for i in range(count):
+        module_id = f"m{10000 + i}"
+        zip_path = os.path.join(tmp_dir, f"{module_id}.zip")
+        with zipfile.ZipFile(zip_path, "w", zipfile.ZIP_DEFLATED) as zip_file:
+            zip_file.writestr(f"{module_id}/index.cnxml", "<document><para>text</para></document>" * 50)
+            zip_file.writestr(f"{module_id}/image.png", os.urandom(64 * 1024))
+        modules.append(dict(zip_path=zip_path, title=f"Module {module_id}"))
+    return modules
+
+
+async def copy_with_http(server_url: str, modules, max_workers: int = 5):
+    """Copies the modules like copy_modules does with the http engine, without the download stages.
+
+    """
+    broker = SessionBroker(USERNAME, PASSWORD)
+    semaphore = asyncio.Semaphore(max_workers)
+    async with http_session(cookie_jar=broker.cookie_jar) as session:
+        async def copy_module(module):
+            async with semaphore:
+                return await copy_module_over_http(session, server_url, module["zip_path"], module["title"],
+                                                   USERNAME, PASSWORD, broker=broker)
+
+        return await asyncio.gather(*[copy_module(module) for module in modules])
+
+
+async def copy_with_selenium(server_url: str, modules, headless: bool, profile: ChromeProfile):
+    loop = asyncio.get_event_loop()
+    pool = DriverPool(server_url, USERNAME, PASSWORD, headless, profile=profile)
+    executor = concurrent.futures.ThreadPoolExecutor(max_workers=pool.size)
+    futures = [loop.run_in_executor(executor, copy_module_to_server, server_url, module["zip_path"],
+                                    module["title"], headless, USERNAME, PASSWORD, pool)
+               for module in modules]
+    # The summary the tracer prints has the open and load timings of every page
+    tracer = Tracer().start()
+    try:
+        await asyncio.gather(*futures)
+    finally:
+        pool.close()
+        tracer.finish()
+        print(f"Chrome drivers: {pool}")
+
+
+async def run_benchmark(count: int, publish_delay: float, site_error_rate: float, asset_latency: float,
+                        selenium: bool, headless: bool) -> None:
+    app = create_app(publish_delay=publish_delay, site_error_rate=site_error_rate, asset_latency=asset_latency)
+    runner = web.AppRunner(app)
+    await runner.setup()
+    site = web.TCPSite(runner, "127.0.0.1", 0)
+    await site.start()
+    port = site._server.sockets[0].getsockname()[1]
+    server_url = f"http://127.0.0.1:{port}"
+
+    print(f"{count} modules, {publish_delay:.1f}s to publish each")
+    try:
+        with TemporaryDirectory() as tmp_dir:
+            engines = [("http", lambda modules: copy_with_http(server_url, modules))]
+            if selenium:
+                lightweight = ChromeProfile(template_dir=os.path.join(tmp_dir, "chrome-profile"))
+                # The template is kept between runs, so it is warmed before the timing starts
+                loop = asyncio.get_event_loop()
+                await loop.run_in_executor(None, lambda: create_chrome_driver(True, lightweight).quit())
+                for name, profile in (("selenium (stock Chrome)", ChromeProfile.full()), ("selenium", lightweight)):
+                    engines.append((name, lambda modules, profile=profile: copy_with_selenium(server_url, modules,
+                                                                                               headless, profile)))
+
+            modules = build_module_zips(tmp_dir, count)
+            for name, copy in engines:
+                published = len(app["state"].published)
+                start = time.perf_counter()
+                await copy(modules)
+                elapsed = time.perf_counter() - start
+
+                assert len(app["state"].published) - published == count, "not every module was published"
+                print(f"{name:<24} {elapsed:7.2f}s  {elapsed / count:6.2f}s/module")
+    finally:
+        await runner.cleanup()
+
+    print(f"{app['state'].site_errors} site errors retried")
+
+
+def main():
+    arguments = docopt(__doc__)
+    asyncio.run(run_benchmark(int(arguments["--modules"]),
+                              float(arguments["--publish-delay"]),
+                              float(arguments["--site-error-rate"]),
+                              float(arguments["--asset-latency"]),
+                              arguments["--selenium"],
+                              arguments["--headless"]))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,133 @@
+import hashlib
+import json
+import os
+from typing import Dict, List, Optional, Tuple
+
+from src.constants import HTTP_CACHE_MAX_SIZE, HTTP_CACHE_PATH, HTTP_CACHE_TRIM_RATIO
+
+
+class HttpCache:
+    """A size-bounded on-disk cache of GET response bodies and their validators.
+
+    Responses that come with an ETag or Last-Modified header are stored as a
+    `<sha256 of url>.body` file next to a `.json` file holding the validators.
+    The next request for the url sends them back as If-None-Match and
+    If-Modified-Since, so an unchanged page costs a 304 response and is served
+    from disk. Every hit touches the entry, and the least recently used
+    entries are removed once the cache grows past `max_size` bytes. The size
+    is kept as a running total, so the directory is only scanned when the
+    cache is first written to and when it has to be trimmed.
+
+    """
+    def __init__(self, path: str = HTTP_CACHE_PATH, max_size: int = HTTP_CACHE_MAX_SIZE):
+        self.path = path
+        self.max_size = max_size
+        self.hits = 0
+        self.misses = 0
+        self._size = None
+        os.makedirs(path, exist_ok=True)
+
+    def conditional_headers(self, url: str) -> Dict:
+        """Returns the request headers that revalidate the cached copy of `url`.
+
+        """
+        meta = self._load_meta(url)
+        headers = {}
+        if meta is None:
+            return headers
+        if meta.get("etag"):
+            headers["If-None-Match"] = meta["etag"]
+        if meta.get("last_modified"):
+            headers["If-Modified-Since"] = meta["last_modified"]
+        return headers
+
+    def load(self, url: str) -> Optional[bytes]:
+        """Returns the cached body of `url` after a 304, or None if it was evicted.
+
+        """
+        entry_path = self._entry_path(url)
+        try:
+            with open(entry_path + ".body", "rb") as f_handle:
+                body = f_handle.read()
+        except FileNotFoundError:
+            return None
+
+        os.utime(entry_path + ".json")
+        self.hits += 1
+        return body
+
+    def store(self, url: str, headers, body: bytes) -> None:
+        """Stores a 200 response for `url` if it has validators to revalidate with.
+
+        """
+        self.misses += 1
+        etag = headers.get("ETag")
+        last_modified = headers.get("Last-Modified")
+        if not etag and not last_modified:
+            return
+
+        if self._size is None:
+            self._size = self._scan()[1]
+        old_meta = self._load_meta(url)
+        if old_meta is not None:
+            self._size -= old_meta.get("size", 0)
+
+        entry_path = self._entry_path(url)
+        meta = dict(url=url, etag=etag, last_modified=last_modified, size=len(body))
+        self._write(entry_path + ".body", body)
+        self._write(entry_path + ".json", json.dumps(meta).encode("utf-8"))
+        self._size += len(body)
+        if self._size > self.max_size:
+            self.evict()
+
+    def evict(self) -> None:
+        """Removes the least recently used entries until the cache fits `max_size`.
+
+        It trims the cache a bit further, to HTTP_CACHE_TRIM_RATIO of
+        `max_size`, so the next few stores fit without another scan.
+
+        """
+        entries, total = self._scan()
+        if total <= self.max_size:
+            self._size = total
+            return
+        for _, meta_path, body_path, size in sorted(entries):
+            if total <= self.max_size * HTTP_CACHE_TRIM_RATIO:
+                break
+            for path in (meta_path, body_path):
+                if os.path.exists(path):
+                    os.remove(path)
+            total -= size
+        self._size = total
+
+    def _scan(self) -> Tuple[List[Tuple[float, str, str, int]], int]:
+        # Every entry's last use, meta and body paths and body size, and the size of all bodies
+        entries = []
+        total = 0
+        for entry in os.scandir(self.path):
+            if entry.name.endswith(".json"):
+                body_path = entry.path[:-len(".json")] + ".body"
+                size = os.path.getsize(body_path) if os.path.exists(body_path) else 0
+                entries.append((entry.stat().st_mtime, entry.path, body_path, size))
+                total += size
+        return entries, total
+
+    def _load_meta(self, url: str) -> Optional[Dict]:
+        try:
+            with open(self._entry_path(url) + ".json", "rb") as f_handle:
+                return json.loads(f_handle.read())
+        except (FileNotFoundError, ValueError):
+            return None
+
+    def _entry_path(self, url: str) -> str:
+        return os.path.join(self.path, hashlib.sha256(url.encode("utf-8")).hexdigest())
+
+    @staticmethod
+    def _write(path: str, data: bytes) -> None:
+        tmp_path = path + ".tmp"
+        with open(tmp_path, "wb") as f_handle:
+            f_handle.write(data)
+        os.replace(tmp_path, path)
+
+    def __str__(self):
+        return f"{self.hits} served from disk, {self.misses} fetched"
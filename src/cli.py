@@ -1,18 +1,46 @@
 """Krunk Copy: Get krunk with copying modules or downloading PDFs from CNX Legacy.
 Usage:
-  kcopy download_pdfs <server_url> (<collection_ids>...)
-  kcopy copy_modules [--headless] (<from_server_url> <to_server_url> <module_ids>...)
+  kcopy download_pdfs [--timeout=<seconds>] [--deadline=<seconds>] [--segments=<n>] [--no-cache] [--no-store] [--http-limit=<n>] [--trace=<file>] [--metrics=<file>] <server_url> (--ids-from=<file> | <collection_ids>...)
+  kcopy copy_modules [--headless] [--full-chrome] [--chrome-switches=<switches>] [--no-cache] [--no-store] [--engine=<engine>] [--async-publish] [--http-limit=<n>] [--browsers=<n>] [--zip-workers=<n>] [--resume=<job>] [--trace=<file>] [--metrics=<file>] (<from_server_url> <to_server_url> (--ids-from=<file> | <module_ids>...))
+  kcopy copy_collection [--headless] [--full-chrome] [--chrome-switches=<switches>] [--no-cache] [--no-store] [--engine=<engine>] [--async-publish] [--http-limit=<n>] [--browsers=<n>] [--zip-workers=<n>] [--resume=<job>] [--trace=<file>] [--metrics=<file>] <from_server_url> <to_server_url> <collection_id>
   kcopy (-h | --help)
 
 Examples:
   kcopy download_pdfs https://legacy-devb.cnx.org col23566 col23455 col23456
   kcopy download_pdfs https://legacy-qa.cnx.org col23678
+  kcopy download_pdfs --timeout=1800 --deadline=3600 https://legacy-qa.cnx.org col23678 col23455
+  kcopy download_pdfs --segments=4 https://legacy-qa.cnx.org col11406
+  kcopy download_pdfs --ids-from=collections.csv https://legacy-qa.cnx.org
+  kcopy download_pdfs --trace=pdfs.jsonl --metrics=/var/lib/node_exporter/kcopy.prom https://legacy-qa.cnx.org col23678
   kcopy copy_modules https://legacy-devb.cnx.org  https://legacy-devb.cnx.org m25467
   kcopy copy_modules --headless https://legacy-qa.cnx.org https://legacy-devb.cnx.org m12345
+  kcopy copy_modules --engine=http https://legacy-qa.cnx.org https://legacy-devb.cnx.org m12345
+  cat module_ids.txt | kcopy copy_modules --headless --ids-from=- https://legacy-qa.cnx.org https://legacy-devb.cnx.org
+  kcopy copy_modules --headless --browsers=auto --zip-workers=auto https://legacy-qa.cnx.org https://legacy-devb.cnx.org m12345 m12346
+  kcopy copy_modules --headless --resume=20240115-093000-1a2b --ids-from=module_ids.txt https://legacy-qa.cnx.org https://legacy-devb.cnx.org
+  kcopy copy_modules --headless --chrome-switches="--disable-extensions --renderer-process-limit=1" https://legacy-qa.cnx.org https://legacy-devb.cnx.org m12345
+  kcopy copy_modules --headless --async-publish --browsers=2 https://legacy-qa.cnx.org https://legacy-devb.cnx.org m12345 m12346 m12347
+  kcopy copy_collection --headless https://legacy-qa.cnx.org https://legacy-devb.cnx.org col11406
 
 Options:
   -h  --help    Show this screen
   --headless    Run the Chrome driver in headless mode
+  --full-chrome         Start a stock Chrome instead of the lightweight profile that skips images, fonts and media
+  --chrome-switches=<switches>  Start Chrome with these switches, separated by spaces, instead of the memory-saving ones
+  --timeout=<seconds>   Stop polling a collection whose PDF is not ready after this long [default: 7200]
+  --deadline=<seconds>  Stop polling all collections after this long
+  --segments=<n>        Download each PDF over this many concurrent connections [default: 1]
+  --no-cache            Fetch every legacy page in full instead of revalidating the on-disk cache
+  --no-store            Download every PDF and module again instead of reusing the unchanged ones in the artifact store, which also saves a version check per module
+  --engine=<engine>     Copy modules by driving Chrome (selenium) or by posting the forms directly (http) [default: selenium]
+  --async-publish       Leave the publish confirmation to an HTTP request, so the browsers upload the next modules while the server publishes
+  --http-limit=<n>      Number of downloads and legacy page requests to run at once, a number [default: 10]
+  --browsers=<n>        Number of modules to upload at once, or auto to size the Chrome browsers by RAM and CPU cores [default: 5]
+  --zip-workers=<n>     Number of module zips to fix at once, or auto for one per CPU core [default: 2]
+  --ids-from=<file>     Read the ids from a file, or - for stdin, one per line or as id,server CSV rows
+  --resume=<job>        Continue an interrupted copy_modules job with the same servers and ids, skipping the stages it completed
+  --trace=<file>        Append a JSON line with the duration, bytes, retries and outcome of every traced stage to this file
+  --metrics=<file>      Write the p50, p95 and max duration, bytes and retries of every stage to this Prometheus textfile
 
 Note:
   - All legacy credentials are set via environmental variables. Make sure you have
@@ -27,8 +55,11 @@ from datetime import datetime
 
 from docopt import docopt
 
-from src.modules import copy_modules
+from src.ids import stream_ids
+from src.limits import ConcurrencyLimits
+from src.modules import copy_collection, copy_modules
 from src.pdfs import download_pdfs
+from src.selenium import ChromeProfile
 
 
 def cli():
@@ -37,26 +68,47 @@ def cli():
     # Assign commands to variables
     pdfs = arguments["download_pdfs"]
     module = arguments["copy_modules"]
+    collection = arguments["copy_collection"]
 
     # Assign arguments to variables
     server_url = arguments["<server_url>"]
     col_ids = arguments["<collection_ids>"]
+    col_id = arguments["<collection_id>"]
     module_ids = arguments["<module_ids>"]
     to_server_url = arguments["<to_server_url>"]
     from_server_url = arguments["<from_server_url>"]
 
     # Assign options to variables
     headless = arguments["--headless"]
+    timeout = float(arguments["--timeout"])
+    deadline = float(arguments["--deadline"]) if arguments["--deadline"] else None
+    segments = int(arguments["--segments"])
+    use_cache = not arguments["--no-cache"]
+    use_store = not arguments["--no-store"]
+    engine = arguments["--engine"]
+    async_publish = arguments["--async-publish"]
+    ids_from = arguments["--ids-from"]
+    job_id = arguments["--resume"]
+    trace_path = arguments["--trace"]
+    metrics_path = arguments["--metrics"]
+    chrome_profile = ChromeProfile.from_options(arguments["--full-chrome"], arguments["--chrome-switches"])
+    limits = ConcurrencyLimits.from_options(arguments["--http-limit"], arguments["--browsers"],
+                                            arguments["--zip-workers"])
+
+    if ids_from:
+        # The ids are read as they are needed, so a huge list never has to fit in memory
+        col_ids = module_ids = stream_ids(ids_from)
 
     if pdfs:
-        print(f"Polling and downloading PDFs for {col_ids} at {server_url}")
+        print(f"Polling and downloading PDFs for {ids_from or col_ids} at {server_url}")
         print(f"Started at: {datetime.utcnow()}")
         try:
-            asyncio.run(download_pdfs(server_url, col_ids))
+            asyncio.run(download_pdfs(server_url, col_ids, timeout, deadline, segments, use_cache, use_store,
+                                      limits=limits, trace_path=trace_path, metrics_path=metrics_path))
         except KeyboardInterrupt:
             pass
 
-    if module:
+    if module or collection:
 
         try:
             username = os.environ["LEGACY_USERNAME"]
@@ -65,11 +117,26 @@ def cli():
             print("You need to set LEGACY_USERNAME and LEGACY_PASSWORD environment variables")
             sys.exit()
 
-        print(f"Initiating the module zip download and copy process for {module_ids}")
+        copy_options = dict(engine=engine, limits=limits, job_id=job_id, trace_path=trace_path,
+                            metrics_path=metrics_path, chrome_profile=chrome_profile, async_publish=async_publish)
+
+    if module:
+        print(f"Initiating the module zip download and copy process for {ids_from or module_ids}")
+        print(f"Started at: {datetime.utcnow()}")
+
+        try:
+            asyncio.run(copy_modules(from_server_url, to_server_url, module_ids, headless, username, password,
+                                     use_cache, use_store, **copy_options))
+        except KeyboardInterrupt:
+            pass
+
+    if collection:
+        print(f"Initiating the collection zip download and copy process for the modules of {col_id}")
         print(f"Started at: {datetime.utcnow()}")
 
         try:
-            asyncio.run(copy_modules(from_server_url, to_server_url, module_ids, headless, username, password))
+            asyncio.run(copy_collection(from_server_url, to_server_url, col_id, headless, username, password,
+                                        use_cache, use_store, **copy_options))
         except KeyboardInterrupt:
             pass
 
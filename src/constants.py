@@ -3,3 +3,88 @@ from pathlib import Path
 
 HOME_PATH = str(Path.home())
 DOWNLOAD_PATH = os.path.join(HOME_PATH, "Downloads")
+
+# Connection pool settings for the shared per-run aiohttp session
+HTTP_CONNECTION_LIMIT = 100
+HTTP_CONNECTION_LIMIT_PER_HOST = 10
+HTTP_DNS_CACHE_TTL = 300
+HTTP_KEEPALIVE_TIMEOUT = 30
+
+# Backoff schedule for polling the query_ptool until a PDF is ready
+POLL_BASE_DELAY = 20
+POLL_MAX_DELAY = 300
+POLL_BACKOFF_FACTOR = 1.5
+POLL_JITTER = 0.25
+POLL_ITEM_TIMEOUT = 2 * 60 * 60
+POLL_MAX_IN_FLIGHT = 10
+
+# Downloads are written to a .part file in chunks and resumed when interrupted
+DOWNLOAD_CHUNK_SIZE = 64 * 1024
+DOWNLOAD_CONNECT_TIMEOUT = 30
+DOWNLOAD_READ_TIMEOUT = 60
+DOWNLOAD_MAX_ATTEMPTS = 5
+PDF_TRAILER_SEARCH_SIZE = 1024
+
+# Segmented downloads split a file into byte ranges of at least this size
+DOWNLOAD_SEGMENT_MIN_SIZE = 1024 * 1024
+
+# On-disk cache of legacy pages, revalidated with ETag / Last-Modified
+HTTP_CACHE_PATH = os.path.join(HOME_PATH, ".cache", "krunk-copy", "http")
+HTTP_CACHE_MAX_SIZE = 100 * 1024 * 1024
+# Eviction trims the cache to this fraction of its max size, so a full cache isn't scanned on every store
+HTTP_CACHE_TRIM_RATIO = 0.9
+
+# Content-addressed store of downloaded PDFs and module zips
+ARTIFACT_STORE_PATH = os.path.join(HOME_PATH, ".cache", "krunk-copy", "artifacts")
+ARTIFACT_KEEP_VERSIONS = 3
+ARTIFACT_STORE_MAX_SIZE = 10 * 1024 * 1024 * 1024
+
+# Journal of the copy_modules jobs, so an interrupted job can be resumed
+JOURNAL_PATH = os.path.join(HOME_PATH, ".cache", "krunk-copy", "journal.sqlite")
+
+# Publishing can keep a legacy server busy for minutes before it answers
+LEGACY_HTTP_READ_TIMEOUT = 600
+
+# Chrome drivers kept logged in for copy_modules, and how many modules each copies before a restart
+DRIVER_POOL_SIZE = 5
+DRIVER_MAX_USES = 20
+
+# Lightweight profile of the upload workers' Chrome browsers: pages count as loaded once their DOM is ready,
+# fonts, media and analytics are blocked, and every browser starts from a copy of a warmed user data directory
+CHROME_PAGE_LOAD_STRATEGY = "eager"
+CHROME_BLOCKED_URLS = ("*.woff", "*.woff2", "*.ttf", "*.otf", "*.eot", "*.mp3", "*.mp4", "*.ogg", "*.webm", "*.swf",
+                       "*google-analytics.com/*", "*googletagmanager.com/*")
+CHROME_PROFILE_TEMPLATE = os.path.join(HOME_PATH, ".cache", "krunk-copy", "chrome-profile")
+
+# Chrome switches that turn off background features to save memory, unless --chrome-switches replaces them
+CHROME_MEMORY_SWITCHES = ("--disable-extensions", "--disable-background-networking", "--disable-component-update",
+                          "--disable-default-apps", "--disable-sync", "--no-first-run", "--mute-audio",
+                          "--disable-features=Translate,MediaRouter,OptimizationHints",
+                          "--renderer-process-limit=2", "--disk-cache-size=33554432")
+
+# How long the page objects wait for a legacy page to be ready. The readiness is checked again on every change of
+# the page's DOM, and at least this often
+PAGE_LOAD_TIMEOUT = 60
+PAGE_READY_POLL_INTERVAL = 0.25
+
+# Zip rewrite workers of the copy_modules download -> fix zip -> upload pipeline, and the queue size between stages
+PIPELINE_FIX_WORKERS = 2
+PIPELINE_QUEUE_SIZE = 5
+
+# Memory set aside per Chrome browser, and kept back for everything else, when sizing browsers automatically
+BROWSER_MEMORY = 512 * 1024 * 1024
+MEMORY_RESERVE = 512 * 1024 * 1024
+
+# Adaptive (AIMD) concurrency limit per legacy host, shared by HTTP requests and browser actions
+ADAPTIVE_INITIAL_LIMIT = 4
+ADAPTIVE_MAX_LIMIT = 16
+ADAPTIVE_DECREASE_FACTOR = 0.5
+ADAPTIVE_DECREASE_INTERVAL = 5
+ADAPTIVE_SLOW_RESPONSE = 10
+
+# Seconds before the first retry of a Site Error or 5xx response. Doubles with every retry
+SITE_ERROR_RETRY_DELAY = 2
+HTTP_MAX_ATTEMPTS = 3
+
+# Ids read at a time from an --ids-from file or stdin
+IDS_READ_BATCH_SIZE = 256
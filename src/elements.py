@@ -0,0 +1,55 @@
+import threading
+from typing import Callable, Hashable
+
+
+class LookupStats:
+    """Counts the element lookups of the page objects, and how many the caches answered without a round trip.
+
+    """
+    def __init__(self):
+        self.lookups = 0
+        self.saved = 0
+        self._lock = threading.Lock()
+
+    def count(self, saved: bool) -> None:
+        with self._lock:
+            self.lookups += 1
+            if saved:
+                self.saved += 1
+
+    def __str__(self):
+        return f"{self.lookups} element lookups, {self.saved} round trips saved by the element caches"
+
+
+# Shared by the page objects of every browser
+lookup_stats = LookupStats()
+
+
+class ElementCache:
+    """The WebElements a page or region found, by locator.
+
+    The page objects are thrown away once they navigate to another page, so
+    an element they found stays valid for as long as they are used, except
+    when the same object waits for its page to load again, e.g. after going
+    back to retry a form. The owner clears the cache then, and when one of
+    the elements turns out to be stale.
+
+    """
+    def __init__(self):
+        self._elements = {}
+
+    def get(self, key: Hashable, find: Callable):
+        """Returns the element cached under `key`, or finds it with `find()` and caches it.
+
+        """
+        element = self._elements.get(key)
+        if element is not None:
+            lookup_stats.count(saved=True)
+            return element
+        element = find()
+        lookup_stats.count(saved=False)
+        self._elements[key] = element
+        return element
+
+    def clear(self) -> None:
+        self._elements.clear()
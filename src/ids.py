@@ -0,0 +1,85 @@
+import asyncio
+import csv
+import itertools
+import sys
+from typing import AsyncIterator, Hashable, Iterable, Iterator, NamedTuple, Optional, Tuple
+
+from src.constants import IDS_READ_BATCH_SIZE
+
+STDIN = "-"
+_HEADER_NAMES = ("id", "ids", "module_id", "collection_id", "col_id")
+
+
+class IdRow(NamedTuple):
+    """A module or collection id read from an ids file, and the server of its row, if any.
+
+    """
+    id: str
+    server: Optional[str] = None
+
+    def __str__(self):
+        return self.id if self.server is None else f"{self.id} ({self.server})"
+
+
+def resolve(key: Hashable, default_server: str) -> Tuple[str, str]:
+    """Returns the server and id of a key, which is either an id or an IdRow.
+
+    """
+    if isinstance(key, IdRow):
+        return key.server or default_server, key.id
+    return default_server, key
+
+
+def parse_ids(lines: Iterable[str]) -> Iterator[IdRow]:
+    """Parses newline or comma delimited ids, with an optional server per row.
+
+    Every line is either a single id or a CSV row of `id,server`. Blank lines,
+    lines starting with # and a header row are skipped.
+
+    """
+    for line in lines:
+        line = line.strip()
+        if not line or line.startswith("#"):
+            continue
+
+        fields = [field.strip() for field in next(csv.reader([line]))]
+        if fields[0].lower() in _HEADER_NAMES:
+            continue
+        server = fields[1].rstrip("/") if len(fields) > 1 and fields[1] else None
+        yield IdRow(fields[0], server)
+
+
+def unique(rows: Iterable[IdRow]) -> Iterator[IdRow]:
+    """Drops the rows whose id and server were already seen.
+
+    Only the seen rows are kept, not the rows still to come.
+
+    """
+    seen = set()
+    for row in rows:
+        if row not in seen:
+            seen.add(row)
+            yield row
+
+
+async def stream_ids(path: str, batch_size: int = IDS_READ_BATCH_SIZE) -> AsyncIterator[IdRow]:
+    """Yields the unique ids in a file, or stdin for `-`, as they are read.
+
+    The file is read in batches of `batch_size` rows in the default executor,
+    so a slow pipe on stdin doesn't block the event loop, and only one batch
+    is held in memory at a time.
+
+    """
+    loop = asyncio.get_event_loop()
+    ids_file = sys.stdin if path == STDIN else open(path, newline="")
+    try:
+        rows = unique(parse_ids(ids_file))
+        while True:
+            batch = await loop.run_in_executor(None, list, itertools.islice(rows, batch_size))
+            if not batch:
+                return
+            for row in batch:
+                yield row
+    finally:
+        if ids_file is not sys.stdin:
+            ids_file.close()
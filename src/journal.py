@@ -0,0 +1,165 @@
+import os
+import secrets
+import sqlite3
+from contextlib import contextmanager
+from datetime import datetime
+from typing import Callable, Dict, Optional
+
+from src.constants import JOURNAL_PATH
+
+# The stages a module goes through in a copy_modules job, in order
+STAGES = ("downloaded", "fixed", "created", "imported", "publishing", "published")
+
+
+def has_reached(entry: Optional[Dict], stage: str) -> bool:
+    """Returns whether the journal entry of a module got to `stage` or past it.
+
+    """
+    if entry is None or entry["stage"] is None:
+        return False
+    return STAGES.index(entry["stage"]) >= STAGES.index(stage)
+
+
+class JobJournal:
+    """A SQLite journal of the copy_modules jobs and how far each of their modules got.
+
+    Every stage a module completes is written as soon as it happens, together
+    with what is needed to pick it up from there: the downloaded and fixed zip,
+    the title and the url of the temp module in the workspace once it was
+    created. Every transition is also kept in a history table, with the error
+    of the ones that failed.
+
+    A job that was interrupted is resumed by running it again with the same
+    job id. Modules that were published are skipped, and the others continue
+    after the last stage they completed, e.g. by importing the zip into the
+    temp module they already have instead of creating another one.
+
+    """
+    def __init__(self, path: str = JOURNAL_PATH):
+        self.path = path
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+
+        with self._connect() as db:
+            # Write-ahead logging keeps the journal intact if the process is killed mid-write
+            db.execute("PRAGMA journal_mode=WAL")
+            db.execute("""
+                CREATE TABLE IF NOT EXISTS jobs (
+                    job_id TEXT PRIMARY KEY,
+                    from_server TEXT NOT NULL,
+                    to_server TEXT NOT NULL,
+                    created_at TEXT NOT NULL
+                )
+            """)
+            db.execute("""
+                CREATE TABLE IF NOT EXISTS modules (
+                    job_id TEXT NOT NULL,
+                    server TEXT NOT NULL,
+                    module_id TEXT NOT NULL,
+                    stage TEXT,
+                    title TEXT,
+                    zip_path TEXT,
+                    temp_url TEXT,
+                    published_id TEXT,
+                    published_url TEXT,
+                    error TEXT,
+                    updated_at TEXT NOT NULL,
+                    PRIMARY KEY (job_id, server, module_id)
+                )
+            """)
+            db.execute("""
+                CREATE TABLE IF NOT EXISTS transitions (
+                    job_id TEXT NOT NULL,
+                    server TEXT NOT NULL,
+                    module_id TEXT NOT NULL,
+                    stage TEXT NOT NULL,
+                    error TEXT,
+                    created_at TEXT NOT NULL
+                )
+            """)
+
+    def create_job(self, from_server_url: str, to_server_url: str) -> str:
+        """Starts a new job and returns its id.
+
+        """
+        now = datetime.utcnow()
+        job_id = f"{now.strftime('%Y%m%d-%H%M%S')}-{secrets.token_hex(2)}"
+        with self._connect() as db:
+            db.execute("INSERT INTO jobs VALUES (?, ?, ?, ?)",
+                       (job_id, from_server_url.rstrip("/"), to_server_url.rstrip("/"), now.isoformat()))
+        return job_id
+
+    def resume_job(self, job_id: str, from_server_url: str, to_server_url: str) -> str:
+        """Checks that a job exists and copies between the same servers, and returns its id.
+
+        """
+        with self._connect() as db:
+            row = db.execute("SELECT * FROM jobs WHERE job_id = ?", (job_id,)).fetchone()
+
+        if row is None:
+            raise Exception(f"There is no job {job_id} in the journal at {self.path}")
+        if (row["from_server"], row["to_server"]) != (from_server_url.rstrip("/"), to_server_url.rstrip("/")):
+            raise Exception(f"Job {job_id} copies modules from {row['from_server']} to {row['to_server']}, "
+                            f"not from {from_server_url} to {to_server_url}")
+        return job_id
+
+    def module(self, job_id: str, server: str, module_id: str) -> Optional[Dict]:
+        """Returns the journal entry of a module in a job, or None if it wasn't started.
+
+        """
+        with self._connect() as db:
+            row = db.execute("SELECT * FROM modules WHERE job_id = ? AND server = ? AND module_id = ?",
+                             (job_id, server, module_id)).fetchone()
+        return dict(row) if row is not None else None
+
+    def record(self, job_id: str, server: str, module_id: str, stage: str, **fields) -> None:
+        """Records that a module completed `stage`, along with any of the module's other columns.
+
+        The stage never goes back, e.g. when a module that already has a temp
+        module is downloaded again only its new zip is recorded.
+
+        """
+        if stage not in STAGES:
+            raise Exception(f"Unknown stage {stage}. Use one of {', '.join(STAGES)}")
+        self._write(job_id, server, module_id, stage, None, dict(fields, stage=stage, error=None))
+
+    def fail(self, job_id: str, server: str, module_id: str, error: BaseException) -> None:
+        """Records why a module failed. It keeps the last stage it completed.
+
+        """
+        self._write(job_id, server, module_id, "failed", str(error), dict(error=str(error)))
+
+    def recorder(self, job_id: str, server: str, module_id: str) -> Callable:
+        """Returns a `record` for one module, to give to the upload engines as `on_stage`.
+
+        """
+        def on_stage(stage: str, **fields) -> None:
+            self.record(job_id, server, module_id, stage, **fields)
+        return on_stage
+
+    def _write(self, job_id: str, server: str, module_id: str, transition: str, error: Optional[str],
+               fields: Dict) -> None:
+        now = datetime.utcnow().isoformat()
+        columns = dict(fields, updated_at=now)
+        with self._connect() as db:
+            db.execute("INSERT OR IGNORE INTO modules (job_id, server, module_id, updated_at) VALUES (?, ?, ?, ?)",
+                       (job_id, server, module_id, now))
+            if "stage" in columns:
+                row = db.execute("SELECT stage FROM modules WHERE job_id = ? AND server = ? AND module_id = ?",
+                                 (job_id, server, module_id)).fetchone()
+                if has_reached(dict(row), columns["stage"]):
+                    del columns["stage"]
+            db.execute(f"UPDATE modules SET {', '.join(f'{name} = :{name}' for name in columns)} "
+                       "WHERE job_id = :job_id AND server = :server AND module_id = :module_id",
+                       dict(columns, job_id=job_id, server=server, module_id=module_id))
+            db.execute("INSERT INTO transitions VALUES (?, ?, ?, ?, ?, ?)",
+                       (job_id, server, module_id, transition, error, now))
+
+    @contextmanager
+    def _connect(self):
+        db = sqlite3.connect(self.path, timeout=30)
+        db.row_factory = sqlite3.Row
+        try:
+            with db:
+                yield db
+        finally:
+            db.close()
@@ -0,0 +1,414 @@
+import asyncio
+import os
+import re
+from html.parser import HTMLParser
+from typing import Callable, Dict, List, Optional, Tuple
+from urllib.parse import urljoin
+
+from aiohttp import ClientSession, ClientTimeout, FormData
+
+from src import tracing
+from src.constants import LEGACY_HTTP_READ_TIMEOUT, SITE_ERROR_RETRY_DELAY
+from src.journal import has_reached
+from src.throttle import HostLimiters
+
+_SITE_ERROR_REGEX = re.compile(r"<h1[^>]*>\s*Site error\s*</h1>|<h2[^>]*>\s*Site Error\s*</h2>")
+
+
+class LegacyForm:
+    """A form on a legacy page and the values its fields would submit.
+
+    """
+    def __init__(self, attrs: Dict):
+        self.attrs = attrs
+        self.fields = []
+        self.buttons = []
+
+    @property
+    def action(self) -> str:
+        return self.attrs.get("action", "")
+
+    @property
+    def method(self) -> str:
+        return self.attrs.get("method", "get").lower()
+
+    @property
+    def is_multipart(self) -> bool:
+        return self.attrs.get("enctype", "").lower() == "multipart/form-data"
+
+    def has_button(self, name: str) -> bool:
+        return any(button_name == name for button_name, _ in self.buttons)
+
+    def values(self, overrides: Dict = None, button: str = None) -> List[Tuple[str, str]]:
+        """Returns the (name, value) pairs a browser would submit.
+
+        `overrides` replaces the value of fields, and checks checkboxes, by
+        name. When `button` is given that submit button is the one clicked,
+        otherwise the form is submitted without a button, like `form.submit()`.
+
+        """
+        overrides = overrides or {}
+        values = []
+        for field_type, name, value, checked in self.fields:
+            if field_type == "file":
+                continue
+            if name in overrides:
+                if field_type != "checkbox" or overrides[name]:
+                    values.append((name, overrides[name] if field_type != "checkbox" else value))
+            elif field_type not in ("checkbox", "radio") or checked:
+                values.append((name, value))
+
+        if button is not None:
+            values.extend((name, value) for name, value in self.buttons if name == button)
+        return values
+
+
+class LegacyPage(HTMLParser):
+    """The parts of a legacy page the HTTP engine needs: forms, links and tables.
+
+    """
+    def __init__(self, url: str, text: str):
+        super().__init__(convert_charrefs=True)
+        self.url = url
+        self.base_url = url
+        self.text = text
+        self.forms = []
+        self.links = []
+        self.table = {}
+        self._form = None
+        self._textarea = None
+        self._select = None
+        self._heading = None
+        self._cell = None
+        self.feed(text)
+        self.close()
+
+    @property
+    def has_site_error(self) -> bool:
+        return bool(_SITE_ERROR_REGEX.search(self.text))
+
+    @property
+    def has_login_form(self) -> bool:
+        return any(form.attrs.get("id") == "login_form" for form in self.forms)
+
+    def form(self, action: str = None, name: str = None, button: str = None) -> LegacyForm:
+        """Returns the first form with the given action, name and/or submit button.
+
+        """
+        for form in self.forms:
+            if action is not None and form.action.rstrip("?") != action:
+                continue
+            if name is not None and form.attrs.get("name") != name:
+                continue
+            if button is not None and not form.has_button(button):
+                continue
+            return form
+        raise Exception(f"No form (action={action}, name={name}, button={button}) found on {self.url}")
+
+    def link(self, ends_with: str) -> str:
+        """Returns the absolute url of the first link whose href ends with `ends_with`.
+
+        """
+        for href in self.links:
+            if href.endswith(ends_with):
+                return urljoin(self.base_url, href)
+        raise Exception(f"No link to {ends_with} found on {self.url}")
+
+    def handle_starttag(self, tag, attrs):
+        attrs = {key: value if value is not None else "" for key, value in attrs}
+        if tag == "base" and attrs.get("href"):
+            self.base_url = attrs["href"]
+        elif tag == "a" and "href" in attrs:
+            self.links.append(attrs["href"])
+        elif tag == "form":
+            self._form = LegacyForm(attrs)
+            self.forms.append(self._form)
+        elif tag == "th":
+            self._heading = []
+        elif tag == "td" and self._heading is not None:
+            self._cell = []
+        elif self._form is not None:
+            self._handle_field(tag, attrs)
+
+    def _handle_field(self, tag, attrs):
+        name = attrs.get("name")
+        if tag == "input" and name:
+            field_type = attrs.get("type", "text").lower()
+            if field_type in ("submit", "image", "button"):
+                self._form.buttons.append((name, attrs.get("value", "")))
+            else:
+                default = "on" if field_type in ("checkbox", "radio") else ""
+                self._form.fields.append([field_type, name, attrs.get("value", default), "checked" in attrs])
+        elif tag == "button" and name:
+            self._form.buttons.append((name, attrs.get("value", "")))
+        elif tag == "textarea" and name:
+            self._textarea = ["textarea", name, "", False]
+            self._form.fields.append(self._textarea)
+        elif tag == "select" and name:
+            self._select = ["select", name, None, False]
+            self._form.fields.append(self._select)
+        elif tag == "option" and self._select is not None:
+            # The first option is submitted unless another one is selected
+            if self._select[2] is None or ("selected" in attrs and not self._select[3]):
+                self._select[2] = attrs.get("value", "")
+                self._select[3] = "selected" in attrs
+
+    def handle_endtag(self, tag):
+        if tag == "form":
+            self._form = None
+        elif tag == "textarea":
+            self._textarea = None
+        elif tag == "select":
+            self._select = None
+        elif tag == "td" and self._cell is not None:
+            self.table["".join(self._heading).strip()] = "".join(self._cell).strip()
+            self._heading = self._cell = None
+
+    def handle_data(self, data):
+        if self._textarea is not None:
+            self._textarea[2] += data
+        elif self._cell is not None:
+            self._cell.append(data)
+        elif self._heading is not None:
+            self._heading.append(data)
+
+
+class LegacyHttpClient:
+    """Browses a CNX Legacy server over HTTP with a cookie-aware session.
+
+    With `limiters`, Site Error pages that come with a 200 status cut the
+    host's adaptive limit like 5xx responses do.
+
+    """
+    def __init__(self, session: ClientSession, base_url: str, limiters: HostLimiters = None):
+        self.session = session
+        self.base_url = base_url.rstrip("/")
+        self.limiters = limiters
+        self.timeout = ClientTimeout(sock_read=LEGACY_HTTP_READ_TIMEOUT)
+
+    async def get(self, url: str) -> LegacyPage:
+        async with self.session.get(urljoin(self.base_url + "/", url), timeout=self.timeout) as response:
+            return await self._page(response)
+
+    async def submit(self,
+                     page: LegacyPage,
+                     form: LegacyForm,
+                     overrides: Dict = None,
+                     button: str = None,
+                     files: Dict = None) -> LegacyPage:
+        """Submits a form the way the browser would and returns the next page.
+
+        `files` maps file field names to the paths to upload.
+
+        """
+        url = urljoin(page.base_url, form.action)
+        values = form.values(overrides, button)
+
+        if form.method != "post":
+            async with self.session.get(url, params=values, timeout=self.timeout) as response:
+                return await self._page(response)
+
+        if form.is_multipart or files:
+            data = FormData()
+            for name, value in values:
+                data.add_field(name, value)
+            handles = []
+            try:
+                for name, path in (files or {}).items():
+                    tracing.add_bytes(os.path.getsize(path))
+                    handle = open(path, "rb")
+                    handles.append(handle)
+                    data.add_field(name, handle, filename=os.path.basename(path),
+                                   content_type="application/zip")
+                async with self.session.post(url, data=data, timeout=self.timeout) as response:
+                    return await self._page(response)
+            finally:
+                for handle in handles:
+                    handle.close()
+
+        async with self.session.post(url, data=values, timeout=self.timeout) as response:
+            return await self._page(response)
+
+    async def login(self, username: str, password: str) -> LegacyPage:
+        """Logs in through the login_form and returns the MyCnx page.
+
+        """
+        login_page = await self.get("login_form")
+        page = await self.submit(login_page, login_page.form(action="login_form"),
+                                 {"__ac_name": username, "__ac_password": password})
+        if page.has_login_form:
+            raise Exception(f"Could not log into {self.base_url} as {username}")
+        if not page.url.rstrip("/").endswith("/mycnx"):
+            page = await self.get("mycnx")
+        return page
+
+    async def _page(self, response) -> LegacyPage:
+        tracing.add_bytes(len(await response.read()))
+        text = await response.text()
+        if response.status >= 400 and not _SITE_ERROR_REGEX.search(text):
+            raise Exception(f"There was a problem retrieving {response.url}. Status Code: {response.status}")
+        page = LegacyPage(str(response.url), text)
+        if page.has_site_error and response.status < 500 and self.limiters is not None:
+            self.limiters.get(page.url).penalize()
+        return page
+
+
+async def copy_module_over_http(session: ClientSession,
+                                to_server_url: str,
+                                zip_path: str,
+                                title: str,
+                                username: str,
+                                password: str,
+                                metadata_attempts: int = 3,
+                                publish_attempts: int = 5,
+                                broker=None,
+                                limiters: HostLimiters = None,
+                                on_stage: Callable = None,
+                                resume: Dict = None) -> Dict:
+    """Copies a downloaded module zip to a server without a browser.
+
+    This performs the same workflow as `copy_module_to_server` by posting the
+    legacy forms directly: login, license agreement, title, zip import, publish
+    and confirm. Site Errors on the title and publish confirmation forms are
+    retried like the page objects do. Returns the title, id and url of the
+    published module.
+
+    With a SessionBroker the login is shared with every other copy to the same
+    server, and `session` has to use the broker's cookie jar.
+
+    `on_stage(stage, **fields)` is called as the module is created, imported,
+    sent to be published and published (see JobJournal.record). With the
+    journal entry of an earlier attempt as `resume`, the copy continues from
+    the temp module that attempt created.
+
+    """
+    client = LegacyHttpClient(session, to_server_url, limiters)
+    on_stage = on_stage or (lambda stage, **fields: None)
+
+    if broker is not None:
+        my_cnx = await broker.my_cnx(session, to_server_url)
+    else:
+        print(f"logging into the legacy server {to_server_url} as {username} over http")
+        with tracing.span("login", server=to_server_url, engine="http"):
+            my_cnx = await client.login(username, password)
+
+    if has_reached(resume, "created"):
+        print(f"continuing with the temp module at {resume['temp_url']}")
+        module_edit = await _open_temp_module(client, resume)
+    else:
+        with tracing.span("create_module", title=title, engine="http"):
+            print(f"accepting license agreement for the module")
+            cc_license = await client.get(my_cnx.link("/mydashboard/cc_license?type_name=Module"))
+            metadata_edit = await client.submit(cc_license, cc_license.form(action="cc_license"),
+                                                {"agree": True})
+
+            print(f"creating module with title '{title}'")
+            module_edit = await _submit_until_no_site_error(
+                client, metadata_edit, metadata_edit.form(action="content_title"),
+                {"title": title}, "form.button.next", metadata_attempts)
+        print(f"temp module located at {module_edit.url}")
+        on_stage("created", temp_url=module_edit.url)
+
+    if not has_reached(resume, "imported"):
+        print(f"uploading module zip from {zip_path} to {to_server_url}")
+        with tracing.span("import_zip", title=title, engine="http"):
+            module_import = await client.submit(module_edit, module_edit.form(action="module_import_form"),
+                                                {"format": "zip"})
+            module_edit = await client.submit(module_import,
+                                              module_import.form(action="module_import_form", name="import"),
+                                              files={"importFile": zip_path})
+        on_stage("imported")
+
+    print(f"attempting to publish the module ...")
+    with tracing.span("publish", title=title, engine="http"):
+        content_publish = await client.get(module_edit.link("module_publish"))
+        publish_button = next(button for button in ("form.button.publish", "form.button.submit")
+                              if any(form.has_button(button) for form in content_publish.forms))
+        confirm_publish = await client.submit(content_publish, content_publish.form(button=publish_button),
+                                              button=publish_button)
+    return await _confirm_publish(client, confirm_publish, title, publish_attempts, on_stage)
+
+
+async def confirm_publish_over_http(session: ClientSession,
+                                    to_server_url: str,
+                                    confirm_url: str,
+                                    confirm_html: str,
+                                    title: str,
+                                    publish_attempts: int = 5,
+                                    limiters: HostLimiters = None,
+                                    on_stage: Callable = None) -> Dict:
+    """Confirms a publish that a browser got to the ConfirmPublish page of, without the browser.
+
+    `confirm_url` and `confirm_html` are the url and source of that page, so
+    the browser can go on with another module while the legacy server
+    publishes this one. Its publishContent form is posted with the session's
+    cookies, which have to be those the browser is logged in with, e.g. the
+    cookie jar of a SessionBroker. Site Errors are retried, and the title and
+    id of the module are read from the ContentPublished page. Returns the
+    title, id and url of the published module.
+
+    """
+    client = LegacyHttpClient(session, to_server_url, limiters)
+    return await _confirm_publish(client, LegacyPage(confirm_url, confirm_html), title, publish_attempts,
+                                  on_stage or (lambda stage, **fields: None))
+
+
+async def _confirm_publish(client: LegacyHttpClient,
+                           confirm_publish: LegacyPage,
+                           title: str,
+                           publish_attempts: int,
+                           on_stage: Callable) -> Dict:
+    on_stage("publishing")
+    with tracing.span("confirm_publish", title=title, engine="http"):
+        content_published = await _submit_until_no_site_error(
+            client, confirm_publish, confirm_publish.form(action="publishContent"),
+            None, None, publish_attempts)
+
+    published = dict(title=content_published.table.get("Name:"),
+                     id=content_published.table.get("ID:"),
+                     url=content_published.url)
+    if published["title"] == title:
+        print(f"uploaded module located at {published['url']}")
+        on_stage("published", published_id=published["id"], published_url=published["url"])
+        return published
+    else:
+        raise Exception("There was a problem with publishing the module. Review the log.")
+
+
+async def _open_temp_module(client: LegacyHttpClient, resume: Dict) -> LegacyPage:
+    """Opens the temp module an earlier attempt created, unless it is gone.
+
+    """
+    try:
+        module_edit = await client.get(resume["temp_url"])
+        module_edit.link("module_publish")
+    except Exception as e:
+        if has_reached(resume, "publishing"):
+            # Publishing moves the temp module out of the workspace, so it may have gone through
+            raise Exception(f"The temp module at {resume['temp_url']} was being published when the job "
+                            f"stopped and is gone now. Check whether it was published before copying it again")
+        raise Exception(f"Could not continue with the temp module at {resume['temp_url']}: {e}")
+    return module_edit
+
+
+async def _submit_until_no_site_error(client: LegacyHttpClient,
+                                      page: LegacyPage,
+                                      form: LegacyForm,
+                                      overrides: Optional[Dict],
+                                      button: Optional[str],
+                                      max_attempts: int) -> LegacyPage:
+    """Submits a form again while the legacy server answers with a Site Error.
+
+    The delay before each retry doubles, to give a struggling server room.
+
+    """
+    for i in range(max_attempts):
+        next_page = await client.submit(page, form, overrides, button)
+        if not next_page.has_site_error:
+            return next_page
+        print(f"SiteError detected retry number {i}")
+        if i < max_attempts - 1:
+            tracing.retried()
+            await asyncio.sleep(SITE_ERROR_RETRY_DELAY * 2 ** i)
+
+    raise Exception(f"Maximum number of attempts exceeded for SiteError ({max_attempts})")
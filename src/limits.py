@@ -0,0 +1,180 @@
+import os
+from typing import Callable, Dict, NamedTuple, Optional
+
+from src.constants import (BROWSER_MEMORY,
+                           DRIVER_POOL_SIZE,
+                           HTTP_CONNECTION_LIMIT_PER_HOST,
+                           MEMORY_RESERVE,
+                           PIPELINE_FIX_WORKERS)
+
+AUTO = "auto"
+
+# The cgroup v2 and v1 memory controllers: their mount point, the controller's name in
+# /proc/self/cgroup ("" for v2) and the files with the limit, usage and inactive page cache
+_CGROUP_MEMORY_FILES = (("/sys/fs/cgroup", "", "memory.max", "memory.current", "inactive_file"),
+                        ("/sys/fs/cgroup/memory", "memory", "memory.limit_in_bytes", "memory.usage_in_bytes",
+                         "total_inactive_file"))
+# cgroup v1 reports no limit as a number close to 2 ** 63
+_CGROUP_NO_LIMIT = 2 ** 60
+
+
+class ConcurrencyLimits(NamedTuple):
+    """How many HTTP requests, Chrome browsers and zip rewrites may run at once.
+
+    `http` caps the concurrent downloads, query_ptool checks and connections
+    per host, `browsers` the upload workers (and so the Chrome drivers) and
+    `zips` the zip files being rewritten by `fix_cnx_zip`.
+
+    """
+    http: int = HTTP_CONNECTION_LIMIT_PER_HOST
+    browsers: int = DRIVER_POOL_SIZE
+    zips: int = PIPELINE_FIX_WORKERS
+
+    @classmethod
+    def from_options(cls, http: str = None, browsers: str = None, zips: str = None) -> "ConcurrencyLimits":
+        """Creates the limits from command line values: a number, `auto` or None for the default.
+
+        `auto` sizes the browsers and zip rewrites to the machine. There is no
+        `auto` for the HTTP limit, which is a cap on what the legacy server is
+        asked to serve at once rather than on local resources. The adaptive
+        limiters lower it while the server is under stress.
+
+        """
+        return cls(http=_parse_limit(http, cls._field_defaults["http"]),
+                   browsers=_parse_limit(browsers, cls._field_defaults["browsers"], auto_browsers),
+                   zips=_parse_limit(zips, cls._field_defaults["zips"], auto_zips))
+
+    def __str__(self):
+        return f"{self.http} HTTP requests, {self.browsers} browsers, {self.zips} zip rewrites at once"
+
+
+def _parse_limit(value: Optional[str], default: int, auto: Callable[[], int] = None) -> int:
+    if value is None:
+        return default
+    if value == AUTO and auto is not None:
+        return auto()
+    try:
+        limit = int(value)
+    except ValueError:
+        if auto is None:
+            raise Exception(f"The HTTP concurrency limit has to be a number, not {value}")
+        raise Exception(f"A concurrency limit has to be a number or {AUTO}, not {value}")
+    if limit < 1:
+        raise Exception(f"A concurrency limit has to be at least 1, not {limit}")
+    return limit
+
+
+def available_memory() -> Optional[int]:
+    """Returns the memory available for new processes in bytes, or None if unknown.
+
+    Uses MemAvailable from /proc/meminfo on Linux, which counts the page cache
+    as available but is host-wide, so it is capped by what the memory limit
+    of our cgroup leaves (see `cgroup_memory_available`), e.g. in a container.
+    Elsewhere half of the physical memory is assumed to be available.
+
+    """
+    memory = None
+    try:
+        with open("/proc/meminfo") as meminfo:
+            for line in meminfo:
+                if line.startswith("MemAvailable:"):
+                    memory = int(line.split()[1]) * 1024
+                    break
+    except OSError:
+        pass
+
+    if memory is None:
+        try:
+            memory = os.sysconf("SC_PHYS_PAGES") * os.sysconf("SC_PAGE_SIZE") // 2
+        except (AttributeError, ValueError, OSError):
+            pass
+
+    cgroup_memory = cgroup_memory_available()
+    if cgroup_memory is not None:
+        memory = cgroup_memory if memory is None else min(memory, cgroup_memory)
+    return memory
+
+
+def cgroup_memory_available() -> Optional[int]:
+    """Returns what the memory limits of our cgroup leave in bytes, or None without one.
+
+    Reads cgroup v2's memory.max or v1's memory.limit_in_bytes of our cgroup
+    and each of its parents, as any of them can have the lowest limit. What a
+    limit leaves is the limit less the cgroup's usage, except for the inactive
+    page cache, which the kernel reclaims before it enforces the limit.
+
+    """
+    paths = _cgroup_paths()
+    available = None
+    for root, controller, limit_name, usage_name, inactive_name in _CGROUP_MEMORY_FILES:
+        if controller not in paths:
+            continue
+        directory = root + paths[controller].rstrip("/")
+        while True:
+            limit = _read_cgroup_value(os.path.join(directory, limit_name))
+            if limit is not None and limit < _CGROUP_NO_LIMIT:
+                usage = _read_cgroup_value(os.path.join(directory, usage_name)) or 0
+                inactive = _read_memory_stat(os.path.join(directory, "memory.stat"), inactive_name)
+                left = max(0, limit - usage + min(inactive, usage))
+                available = left if available is None else min(available, left)
+            if directory == root:
+                break
+            directory = os.path.dirname(directory)
+    return available
+
+
+def _cgroup_paths() -> Dict[str, str]:
+    # The cgroup of this process per controller, "" for the cgroup v2 hierarchy
+    paths = {}
+    try:
+        with open("/proc/self/cgroup") as cgroup_file:
+            for line in cgroup_file:
+                _, controllers, path = line.rstrip("\n").split(":", 2)
+                for controller in controllers.split(","):
+                    paths[controller] = path
+    except (OSError, ValueError):
+        pass
+    return paths
+
+
+def _read_cgroup_value(path: str) -> Optional[int]:
+    # None for a missing file and for cgroup v2's "max", which means there is no limit
+    try:
+        with open(path) as value_file:
+            value = value_file.read().strip()
+    except OSError:
+        return None
+    return int(value) if value.isdigit() else None
+
+
+def _read_memory_stat(path: str, name: str) -> int:
+    try:
+        with open(path) as stat_file:
+            for line in stat_file:
+                key, value = line.split()
+                if key == name:
+                    return int(value)
+    except (OSError, ValueError):
+        pass
+    return 0
+
+
+def auto_browsers() -> int:
+    """Sizes the browser workers from the available memory and CPU cores.
+
+    Every Chrome browser is given BROWSER_MEMORY after MEMORY_RESERVE is kept
+    back for everything else, and there is at most one browser per core.
+
+    """
+    cores = os.cpu_count() or 1
+    memory = available_memory()
+    if memory is None:
+        return min(cores, DRIVER_POOL_SIZE)
+    return max(1, min(cores, (memory - MEMORY_RESERVE) // BROWSER_MEMORY))
+
+
+def auto_zips() -> int:
+    """Rewrites one zip per CPU core.
+
+    """
+    return os.cpu_count() or 1
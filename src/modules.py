@@ -1,80 +1,471 @@
 import asyncio
 import concurrent.futures
+import contextvars
 import os
 import re
-from typing import List, Dict
+from contextlib import nullcontext
+from typing import AsyncIterable, Callable, Dict, Iterable, List, Optional, Union
 
+from aiohttp import ClientSession
 from selenium.common.exceptions import NoSuchElementException
 
+from src import tracing
+from src.cache import HttpCache
 from src.constants import DOWNLOAD_PATH
+from src.elements import lookup_stats
+from src.ids import resolve
+from src.journal import JobJournal, has_reached
+from src.legacy_http import confirm_publish_over_http, copy_module_over_http
+from src.limits import ConcurrencyLimits
+from src.pipeline import Pipeline, PipelineItem, Stage
 from src.pages.login_form import LoginForm
-from src.selenium import create_chrome_driver
-from src.utils import build_url, download_file, aiohttp_get, fix_cnx_zip
+from src.pages.module_edit import ModuleEdit
+from src.selenium import ChromeProfile, DriverPool, create_chrome_driver
+from src.sessions import SessionBroker
+from src.store import ArtifactStore
+from src.throttle import AdaptiveLimiter, HostLimiters
+from src.tracing import Tracer
+from src.utils import (ConnectionStats,
+                       aiohttp_get,
+                       build_url,
+                       download_file,
+                       download_filtered_zip,
+                       fix_cnx_zip,
+                       http_session,
+                       is_cnx_index,
+                       reuse_or_create_session)
+from src.zips import UnsupportedZip, read_cnxml_metadata, split_collection_zip
 
 
 async def copy_modules(from_server_url: str,
                        to_server_url: str,
-                       module_ids: List,
+                       module_ids: Optional[Union[Iterable, AsyncIterable]],
                        headless: str,
                        username: str,
-                       password: str) -> None:
+                       password: str,
+                       use_cache: bool = True,
+                       use_store: bool = True,
+                       engine: str = "selenium",
+                       limits: ConcurrencyLimits = None,
+                       job_id: str = None,
+                       trace_path: str = None,
+                       metrics_path: str = None,
+                       chrome_profile: ChromeProfile = None,
+                       async_publish: bool = False,
+                       col_id: str = None) -> List[PipelineItem]:
     """The main controller function for copying modules to a server.
 
-    This function combines code that is non-blocking and blocking. First, we
-    create a set of tasks that downloads modules to the local machine; this is
-    all non-blocking asyncio code. The results are gathered for these tasks and
-    are then passed to a set of futures that will run in a
-    `ThreadPoolExecutor`. This is necessary b/c that code is blocking and uses
-    selenium.
+    Every module goes through a Pipeline of three stages: download, fix zip
+    and upload. A module moves to the next stage as soon as it is ready, so
+    the first modules are uploading while the rest are still downloading, and
+    a module that fails at any stage doesn't hold up or abort the others. The
+    bounded queues between the stages keep the downloads from running far
+    ahead of the uploads.
+
+    The downloads are non-blocking asyncio code. Fixing a zip runs in the
+    default executor. With the `selenium` engine the uploads run in a
+    `ThreadPoolExecutor`, b/c that code is blocking, and the executor's
+    workers share a DriverPool of logged in Chrome drivers, which starts its
+    browsers while the first downloads are still running. With the `http`
+    engine the modules are copied without a browser by `copy_module_over_http`,
+    which posts the same legacy forms directly.
+
+    A SessionBroker logs into the target server once, before anything else,
+    and its cookies are given to every Chrome driver and HTTP request.
+
+    All of the downloads share one pooled HTTP session. Unless `use_cache` is
+    False the module pages are revalidated against the on-disk HttpCache, and
+    unless `use_store` is False module versions that were already downloaded
+    are taken from the ArtifactStore.
+
+    `limits` sets how many downloads, uploads (and Chrome browsers) and zip
+    rewrites run at once. On top of that every HTTP request and browser
+    action to a host goes through the host's AdaptiveLimiter, which lowers
+    the concurrency when the server answers with 5xx responses, Site Errors
+    or timeouts and raises it again while the server keeps up.
+
+    Every stage a module completes is recorded in the JobJournal under the
+    job's id, which is printed at the start. Passing that `job_id` resumes the
+    job: published modules are skipped, zips that were downloaded or fixed
+    are used again and modules that already have a temp module continue from
+    it instead of being created again.
+
+    Every stage is traced: logging in, the module pages, downloads, zip fixes,
+    each step of the upload and every page load, with their durations,
+    bytes, retries and outcome. The spans are written to `trace_path` as JSON
+    lines and the metrics per stage to `metrics_path` as a Prometheus
+    textfile, if given, and the p50, p95 and max of every stage are printed
+    at the end.
+
+    The Chrome browsers are started with `chrome_profile`, the lightweight
+    ChromeProfile by default.
+
+    With `async_publish` the selenium engine's browsers stop at the
+    ConfirmPublish page and go back to the pool, and a fourth stage confirms
+    the publish with `confirm_publish_over_http`, using the broker's cookies.
+    The legacy server takes longest to publish a module, so the browsers
+    upload the next modules meanwhile.
+
+    `module_ids` can also be IdRows, whose server replaces `from_server_url`,
+    and an async iterable such as `stream_ids`, which is read as the download
+    stage takes the modules. With a `col_id` the modules are instead those of
+    the collection, which `download_collection` downloads and splits with the
+    session, cache and store of the downloads when the download stage first
+    asks for a module.
+
+    Returns a PipelineItem per module, with the stage and error of the ones
+    that failed.
 
     """
+    if engine not in ("selenium", "http"):
+        raise Exception(f"Unknown upload engine {engine}. Use selenium or http")
+
+    limits = limits or ConcurrencyLimits()
+    print(f"Concurrency: {limits}")
     loop = asyncio.get_event_loop()
-    executor = concurrent.futures.ThreadPoolExecutor(max_workers=5)
+    zip_executor = concurrent.futures.ThreadPoolExecutor(max_workers=limits.zips)
+    stats = ConnectionStats()
+    cache = HttpCache() if use_cache else None
+    store = ArtifactStore() if use_store else None
+    broker = SessionBroker(username, password)
+    limiters = HostLimiters(max_limit=limits.http + limits.browsers)
+    journal = JobJournal()
+    tracer = Tracer(trace_path, metrics_path).start()
+    pool = None
+    prestarts = []
+
+    if job_id is None:
+        job_id = journal.create_job(from_server_url, to_server_url)
+        print(f"Job {job_id}: resume it with --resume={job_id} if it is interrupted")
+    else:
+        job_id = journal.resume_job(job_id, from_server_url, to_server_url)
+        print(f"Resuming job {job_id}")
+
+    downloaded = {}
+    async with http_session(stats, limit_per_host=limits.http, cookie_jar=broker.cookie_jar,
+                            limiters=limiters) as session:
+        try:
+            # Log in once up front. Every browser and HTTP client reuses the cookies
+            print(f"logging into the legacy server {to_server_url} as {username}")
+            await broker.login(session, to_server_url)
+
+            if engine == "http":
+                async def upload(module):
+                    return await copy_module_over_http(session, to_server_url, module["zip_path"],
+                                                       module["title"], username, password, broker=broker,
+                                                       limiters=limiters, on_stage=module["on_stage"],
+                                                       resume=module["entry"])
+            else:
+                executor = concurrent.futures.ThreadPoolExecutor(max_workers=limits.browsers)
+                pool = DriverPool(to_server_url, username, password, headless, size=limits.browsers, broker=broker,
+                                  limiters=limiters, profile=chrome_profile)
+                print(f"Chrome profile: {chrome_profile or ChromeProfile()}")
+                prestarts = [loop.run_in_executor(executor, pool.prestart) for _ in range(pool.size)]
+
+                async def upload(module):
+                    # The copy runs in the current span's context, so its spans are nested in it
+                    result = await loop.run_in_executor(executor, contextvars.copy_context().run,
+                                                        copy_module_to_server, to_server_url,
+                                                        module["zip_path"], module["title"], headless,
+                                                        username, password, pool, module["on_stage"],
+                                                        module["entry"], chrome_profile, not async_publish)
+                    if async_publish:
+                        # Hand the pending publish on to the confirm publish stage
+                        return dict(result, title=module["title"], on_stage=module["on_stage"])
+                    return result
+
+            async def collection_module_ids():
+                # The split module zips are upload ready, so the download stage only picks them up
+                modules = await download_collection(from_server_url, col_id, session, cache, store)
+                for module in modules:
+                    downloaded[module["module_id"]] = module
+                    yield module["module_id"]
+
+            async def download(key):
+                source_url, module_id = resolve(key, from_server_url)
+                entry = journal.module(job_id, source_url, module_id)
+                on_stage = journal.recorder(job_id, source_url, module_id)
+                if has_reached(entry, "published"):
+                    # Nothing left to do, so its zip isn't needed even if it is gone
+                    return dict(zip_path=entry["zip_path"], title=entry["title"], entry=entry, on_stage=on_stage,
+                                is_fixed=True)
+                if has_reached(entry, "downloaded") and os.path.exists(entry["zip_path"]):
+                    print(f"module {module_id} was downloaded by an earlier run. File located at {entry['zip_path']}")
+                    return dict(zip_path=entry["zip_path"], title=entry["title"], entry=entry, on_stage=on_stage,
+                                is_fixed=has_reached(entry, "fixed"))
+
+                if module_id in downloaded:
+                    module = downloaded[module_id]
+                else:
+                    module = await download_module(source_url, module_id, session, cache, store)
+                on_stage("downloaded", zip_path=module["zip_path"], title=module["title"])
+                return dict(module, entry=entry, on_stage=on_stage, is_fixed=False)
+
+            async def fix(module):
+                if module["is_fixed"]:
+                    return module
+                with tracing.span("fix_zip", zip_path=module["zip_path"]):
+                    fixed_zip_path = await loop.run_in_executor(zip_executor, fix_cnx_zip, module["zip_path"])
+                module["on_stage"]("fixed", zip_path=fixed_zip_path)
+                return dict(module, zip_path=fixed_zip_path)
+
+            async def upload_once(module):
+                if has_reached(module["entry"], "published"):
+                    print(f"module '{module['title']}' was published by an earlier run at "
+                          f"{module['entry']['published_url']}")
+                    return dict(title=module["title"], id=module["entry"]["published_id"],
+                                url=module["entry"]["published_url"])
+                with tracing.span("upload", title=module["title"], engine=engine):
+                    return await upload(module)
+
+            async def confirm(module):
+                if "confirm_url" not in module:
+                    return module
+                return await confirm_publish_over_http(session, to_server_url, module["confirm_url"],
+                                                       module["confirm_html"], module["title"],
+                                                       limiters=limiters, on_stage=module["on_stage"])
+
+            stages = [Stage("download", download, limits.http),
+                      Stage("fix zip", fix, limits.zips),
+                      Stage("upload", upload_once, limits.browsers)]
+            if async_publish and engine == "selenium":
+                # Publishing holds a connection instead of a browser, so as many run at once as downloads
+                stages.append(Stage("confirm publish", confirm, limits.http))
+            items = await Pipeline(stages).run(collection_module_ids() if col_id is not None else module_ids)
+        finally:
+            for error in await asyncio.gather(*prestarts, return_exceptions=True):
+                if error is not None:
+                    print(f"could not pre-start a Chrome driver: {error!r}")
+            if pool is not None:
+                pool.close()
+                await loop.run_in_executor(None, executor.shutdown)
+                print(f"Chrome drivers: {pool}")
+                print(f"Element lookups: {lookup_stats}")
+            zip_executor.shutdown(wait=False)
+            print(f"HTTP connections: {stats}")
+            print(f"Sessions: {broker}")
+            print(f"Adaptive limits: {limiters}")
+            if cache is not None:
+                print(f"HTTP cache: {cache}")
+            tracer.finish()
+
+    failed = [item for item in items if item.status == PipelineItem.FAILED]
+    print(f"copied {len(items) - len(failed)} of {len(items)} modules")
+    for item in failed:
+        print(f"  {item.key} failed at the {item.stage} stage: {item.error}")
+        journal.fail(job_id, *resolve(item.key, from_server_url), item.error)
+    if failed:
+        print(f"Resume job {job_id} with --resume={job_id} to retry the failed modules")
+    return items
+
+
+async def copy_collection(from_server_url: str,
+                          to_server_url: str,
+                          col_id: str,
+                          headless: str,
+                          username: str,
+                          password: str,
+                          use_cache: bool = True,
+                          use_store: bool = True,
+                          **options) -> List[PipelineItem]:
+    """Copies all the modules of a collection to a server from the collection's complete zip.
+
+    The complete zip is downloaded once and split into upload ready module
+    zips by `download_collection`, instead of exporting every module on its
+    own. The modules then go through the fix zip and upload stages of
+    `copy_modules`, which is given the `options`, e.g. the engine, limits or
+    the id of a job to resume.
+
+    The collection is downloaded by `copy_modules` when its download stage
+    first asks for a module, so the download shares the run's session,
+    limits, cache and store, and it is traced with the rest of the job.
 
-    tasks = [download_module(from_server_url, module_id) for module_id in module_ids]
+    """
+    return await copy_modules(from_server_url, to_server_url, None, headless, username, password,
+                              use_cache, use_store, col_id=col_id, **options)
 
-    modules = await asyncio.gather(*tasks)
-    futures = [loop.run_in_executor(
-        executor,
-        copy_module_to_server,
-        to_server_url,
-        module["zip_path"],
-        module["title"],
-        headless,
-        username,
-        password)
-        for module in modules]
-    return await asyncio.wait(futures, return_when=asyncio.ALL_COMPLETED)
 
+async def download_collection(source_url: str,
+                              col_id: str,
+                              session: ClientSession = None,
+                              cache: HttpCache = None,
+                              store: ArtifactStore = None) -> List[Dict]:
+    """Downloads the complete zip of a collection and splits it into a zip per module.
 
-async def get_module_title(source_url: str, module_id: str):
-    """Gets the module page and uses a regex to extract the title
+    This is a single transfer instead of an export request per module. The
+    module zips are left without their index.cnxml.html files (see
+    `fix_cnx_zip`), so they are ready for upload. The titles are read from
+    the metadata in each module's index.cnxml. The module page is only
+    fetched for the title of modules without one.
+
+    With a `store`, a collection version that was already downloaded is taken
+    from the store instead of being downloaded again, like `download_module`
+    does for modules.
+
+    Returns the module id, zip path and title of every module.
 
     """
-    module_title_regex = re.compile(r"id=\"cnx_content_title\">(.+)<\/")
+    loop = asyncio.get_event_loop()
+    with tracing.span("download_collection", col_id=col_id) as span:
+        print(f"downloading the complete zip of collection {col_id}")
+        zip_url = await build_url(source_url, col_id, "complete")
+        zip_path = os.path.join(DOWNLOAD_PATH, f"{col_id}_complete.zip")
+
+        entry = None
+        col_version = None
+        if store is not None:
+            col_version = await fetch_latest_version(source_url, col_id, session)
+            if col_version is not None:
+                entry = store.lookup(source_url, col_id, "collection", col_version)
+
+        if entry is not None:
+            store.checkout(entry, zip_path)
+            print(f"collection {col_id} version {col_version} is unchanged. File located at {zip_path}")
+        else:
+            await download_file(zip_url, zip_path, session)
+            print(f"download complete. File located at {zip_path}")
+            if store is not None and col_version is not None:
+                await loop.run_in_executor(None, store.add, source_url, col_id, "collection", col_version,
+                                           zip_path)
+        span.set(version=col_version, from_store=entry is not None)
+
+    with tracing.span("split_collection", col_id=col_id) as span:
+        split = await loop.run_in_executor(None, split_collection_zip, zip_path, DOWNLOAD_PATH, is_cnx_index)
+        span.set(modules=len(split))
+    print(f"split collection {col_id} into {len(split)} module zips")
+
+    modules = []
+    for module in split:
+        metadata = await loop.run_in_executor(None, read_cnxml_metadata, module["zip_path"])
+        if metadata.get("title"):
+            module_title = to_ascii(metadata["title"])
+        else:
+            print(f"the zip of module {module['module_id']} has no title, getting it from the module page")
+            module_title = await get_module_title(source_url, module["module_id"], session, cache)
+        modules.append(dict(module, title=module_title))
+    return modules
+
+
+async def fetch_module_page(source_url: str,
+                            module_id: str,
+                            session: ClientSession = None,
+                            cache: HttpCache = None) -> Dict:
+    """Gets the latest module page, which redirects to the versioned page.
 
+    """
     module_url = await build_url(source_url, module_id, "latest")
-    module_page = await aiohttp_get(module_url)
+    with tracing.span("module_page", module_id=module_id) as span:
+        module_page = await aiohttp_get(module_url, session, cache)
+        span.set(cached=module_page["cached"])
+    return module_page
+
+
+def parse_module_title(module_page: Dict, module_id: str) -> str:
+    """Uses a regex to extract the title from a module page
+
+    """
+    module_title_regex = re.compile(r"id=\"cnx_content_title\">(.+)<\/")
+
     module_title = re.search(module_title_regex, module_page["text"]).group(1)
     if module_title:
-        return module_title.encode('ascii', 'ignore').decode('ascii')
+        return to_ascii(module_title)
     else:
         raise Exception(f"No title found for {module_id}")
 
 
-async def download_module(source_url: str, module_id: str) -> Dict:
-    """Downloads a module as a zip file to upload to another server.
+def parse_module_version(url: str) -> Optional[str]:
+    """Extracts the module version from the url `latest` redirected to, if any.
 
     """
-    print(f"downloading module id {module_id}")
-    zip_url = await build_url(source_url, module_id, 'latest/module_export?format=zip')
-    filename = os.path.join(module_id + ".zip")
-    module_title = await get_module_title(source_url, module_id)
+    match = re.search(r"/content/[^/]+/(\d+(?:\.\d+)+)(?:/|$)", url)
+    return match.group(1) if match else None
+
 
-    zip_path = os.path.join(DOWNLOAD_PATH, filename)
+def to_ascii(title: str) -> str:
+    return title.encode('ascii', 'ignore').decode('ascii')
 
-    await download_file(zip_url, zip_path)
-    print(f"download complete. File located at {zip_path}")
+
+async def get_module_title(source_url: str,
+                           module_id: str,
+                           session: ClientSession = None,
+                           cache: HttpCache = None):
+    """Gets the module page and uses a regex to extract the title
+
+    """
+    module_page = await fetch_module_page(source_url, module_id, session, cache)
+    return parse_module_title(module_page, module_id)
+
+
+async def fetch_latest_version(source_url: str,
+                               item_id: str,
+                               session: ClientSession = None) -> Optional[str]:
+    """Gets the version `latest` of a module or collection redirects to, without the page.
+
+    """
+    latest_url = await build_url(source_url, item_id, "latest")
+    with tracing.span("latest_version", item_id=item_id):
+        async with reuse_or_create_session(session) as session:
+            async with session.head(latest_url, allow_redirects=False) as response:
+                location = response.headers.get("Location")
+    return parse_module_version(location) if location is not None else None
+
+
+async def download_module(source_url: str,
+                          module_id: str,
+                          session: ClientSession = None,
+                          cache: HttpCache = None,
+                          store: ArtifactStore = None) -> Dict:
+    """Downloads a module as a zip file to upload to another server.
+
+    The index.cnxml.html file is left out of the zip while it downloads (see
+    `fix_cnx_zip`), so the downloaded zip is ready for upload. The title and
+    version are read from the metadata in the zip's index.cnxml. The module
+    page is only fetched for the title of zips without one.
+
+    With a `store`, a module version that was already downloaded is taken
+    from the store instead of being exported again. The version to look up
+    comes from a HEAD request for `latest`, whose redirect names it without
+    a body. That check is the only extra request, and it is skipped without
+    a store, so each module then costs the export alone.
+
+    """
+    with tracing.span("download_module", module_id=module_id) as span:
+        print(f"downloading module id {module_id}")
+        zip_url = await build_url(source_url, module_id, 'latest/module_export?format=zip')
+        zip_path = os.path.join(DOWNLOAD_PATH, module_id + ".zip")
+
+        entry = None
+        module_version = None
+        if store is not None:
+            module_version = await fetch_latest_version(source_url, module_id, session)
+            if module_version is not None:
+                entry = store.lookup(source_url, module_id, "module", module_version)
+
+        if entry is not None:
+            store.checkout(entry, zip_path)
+            print(f"module {module_id} version {module_version} is unchanged. File located at {zip_path}")
+        else:
+            try:
+                await download_filtered_zip(zip_url, zip_path, is_cnx_index, session)
+            except UnsupportedZip:
+                # fix_cnx_zip will remove the index.cnxml.html file before upload instead
+                await download_file(zip_url, zip_path, session)
+            print(f"download complete. File located at {zip_path}")
+
+        loop = asyncio.get_event_loop()
+        metadata = await loop.run_in_executor(None, read_cnxml_metadata, zip_path)
+        module_version = module_version or metadata.get("version")
+        if entry is None and store is not None and module_version is not None:
+            await loop.run_in_executor(None, store.add, source_url, module_id, "module",
+                                       module_version, zip_path)
+
+        title_from_zip = bool(metadata.get("title"))
+        if title_from_zip:
+            module_title = to_ascii(metadata["title"])
+        else:
+            print(f"the zip of module {module_id} has no title, getting it from the module page")
+            module_title = await get_module_title(source_url, module_id, session, cache)
+        span.set(version=module_version, from_store=entry is not None, title_from_zip=title_from_zip)
 
     return dict(zip_path=zip_path, title=module_title)
 
@@ -84,7 +475,12 @@ def copy_module_to_server(to_server_url: str,
                           title: str,
                           headless: str,
                           username: str,
-                          password: str) -> None:
+                          password: str,
+                          pool: DriverPool = None,
+                          on_stage: Callable = None,
+                          resume: Dict = None,
+                          profile: ChromeProfile = None,
+                          confirm: bool = True) -> Optional[Dict]:
     """Copies a downloaded module zip to a server using the Chrome web browser.
 
     This function utilizes selenium and the Chrome webdriver to drive the
@@ -102,52 +498,148 @@ def copy_module_to_server(to_server_url: str,
       7. Confirm publishing of the module. This step takes the longest.
 
     The original zip file that is downloaded contains an index.cnxml.html file
-    which will cause errors during publishing. This function also created a
-    fixed version where this file has been removed.
+    which will cause errors during publishing. `download_module` leaves it out
+    while downloading, and this function makes sure of it with `fix_cnx_zip`,
+    which only writes a fixed version if the file is still there.
+
+    With a `pool` the module is copied with one of its logged in drivers, which
+    skips step 1. Otherwise a driver is started with `profile`, logged in and
+    quit afterwards.
+
+    `on_stage`, `resume` and `confirm` are passed on to `create_and_publish_module`.
 
     When this process is complete the url of the completed module is printed to
     the screen.
     """
     print(f"starting the module upload process for {zip_path} to {to_server_url}")
 
-    selenium = create_chrome_driver(headless)
-
-    # Login to CNX Legacy
-    print(f"logging into the legacy server {to_server_url} as {username}")
-    login_page = LoginForm(selenium, to_server_url).open()
-    my_cnx = login_page.login(username, password)
-
-    # Go to create a module and accept the license agreement
-    print(f"accepting license agreement for the module")
-    cc_license = my_cnx.create_module()
-    metadata_edit = cc_license.agree().submit()
+    if pool is not None:
+        with pool.driver() as selenium:
+            my_cnx = pool.open_my_cnx(selenium)
+            return create_and_publish_module(my_cnx, to_server_url, zip_path, title, pool.limiter,
+                                             on_stage, resume, confirm)
 
-    # Enter the title on the first metadata page. All other fields are left blank
-    print(f"creating module with title '{title}'")
-    module_edit = metadata_edit.fill_in_title(title).submit()
-    module_temp_url = module_edit.current_url
-    print(f"temp module located at {module_temp_url}")
+    selenium = create_chrome_driver(headless, profile)
+    try:
+        # Login to CNX Legacy
+        print(f"logging into the legacy server {to_server_url} as {username}")
+        login_page = LoginForm(selenium, to_server_url).open()
+        my_cnx = login_page.login(username, password)
+
+        return create_and_publish_module(my_cnx, to_server_url, zip_path, title, on_stage=on_stage,
+                                         resume=resume, confirm=confirm)
+    finally:
+        selenium.quit()
+
+
+def create_and_publish_module(my_cnx,
+                              to_server_url: str,
+                              zip_path: str,
+                              title: str,
+                              limiter: AdaptiveLimiter = None,
+                              on_stage: Callable = None,
+                              resume: Dict = None,
+                              confirm: bool = True) -> Optional[Dict]:
+    """Steps 2 to 7 of `copy_module_to_server`, starting from the MyCnx page.
+
+    With a `limiter` every step holds a slot of the server's adaptive limiter,
+    and Site Errors cut its limit.
+
+    `on_stage(stage, **fields)` is called as the module is created, imported,
+    sent to be published and published (see JobJournal.record). With the
+    journal entry of an earlier attempt as `resume`, the steps that attempt
+    completed are skipped and the copy continues from its temp module.
+    Returns the title, id and url of the published module.
+
+    Unless `confirm` is True step 7 is left to `confirm_publish_over_http`:
+    the module is sent to be published and the url and source of the
+    ConfirmPublish page are returned as `confirm_url` and `confirm_html`, so
+    the driver is free while the server publishes the module.
 
-    # Fix the downloaded zip by removing the index.cnxml.html file
-    print(f"removing index.cnxml.html file from the downloaded module zip for upload")
-    fixed_zip_path = fix_cnx_zip(zip_path)
-    print(f"fixed zip saved at {fixed_zip_path}")
+    """
+    throttle = limiter.hold if limiter is not None else nullcontext
+    on_stage = on_stage or (lambda stage, **fields: None)
 
-    # Select zip for import and upload
-    print(f"uploading module zip from {fixed_zip_path} to {to_server_url}")
-    module_import = module_edit.select_import_format("zip").click_import()
-    module_edit = module_import.fill_in_filename(fixed_zip_path).submit()
+    if has_reached(resume, "created"):
+        print(f"continuing with the temp module at {resume['temp_url']}")
+        with throttle():
+            module_edit = open_temp_module(my_cnx.driver, to_server_url, resume)
+    else:
+        with tracing.span("create_module", title=title, engine="selenium"):
+            # Go to create a module and accept the license agreement
+            print(f"accepting license agreement for the module")
+            with throttle():
+                cc_license = my_cnx.create_module()
+            with throttle():
+                metadata_edit = cc_license.agree().submit()
+
+            # Enter the title on the first metadata page. All other fields are left blank
+            print(f"creating module with title '{title}'")
+            with throttle():
+                module_edit = metadata_edit.fill_in_title(title).submit(limiter=limiter)
+        module_temp_url = module_edit.current_url
+        print(f"temp module located at {module_temp_url}")
+        on_stage("created", temp_url=module_temp_url)
+
+    if not has_reached(resume, "imported"):
+        # Make sure the index.cnxml.html file is gone. download_module normally
+        # leaves it out already, in which case the zip is used as is
+        print(f"removing index.cnxml.html file from the downloaded module zip for upload")
+        fixed_zip_path = fix_cnx_zip(zip_path)
+        print(f"fixed zip saved at {fixed_zip_path}")
+
+        # Select zip for import and upload
+        print(f"uploading module zip from {fixed_zip_path} to {to_server_url}")
+        with tracing.span("import_zip", title=title, engine="selenium") as span:
+            span.add_bytes(os.path.getsize(fixed_zip_path))
+            with throttle():
+                module_import = module_edit.select_import_format("zip").click_import()
+            with throttle():
+                module_edit = module_import.fill_in_filename(fixed_zip_path).submit()
+        on_stage("imported")
 
     # Publish the imported zip file
     print(f"attempting to publish the module ...")
-    content_publish = module_edit.publish()
-    confirm_publish = content_publish.submit()
+    with tracing.span("publish", title=title, engine="selenium"):
+        with throttle():
+            content_publish = module_edit.publish()
+        with throttle():
+            confirm_publish = content_publish.submit()
+    if not confirm:
+        try:
+            confirm_publish.publish_form
+        except NoSuchElementException:
+            raise Exception("There was no publish button found. Check that you have publish permissions")
+        print(f"publish of '{title}' is pending, it will be confirmed over HTTP")
+        return dict(confirm_url=confirm_publish.current_url, confirm_html=confirm_publish.driver.page_source)
+
+    on_stage("publishing")
     try:
-        content_published = confirm_publish.submit()
+        with tracing.span("confirm_publish", title=title, engine="selenium"), throttle():
+            content_published = confirm_publish.submit(limiter=limiter)
     except NoSuchElementException:
         raise Exception("There was no publish button found. Check that you have publish permissions")
 
     if content_published.title == title:
-        print(f"uploaded module located at {content_published.current_url}")
+        published = dict(title=content_published.title, id=content_published.id,
+                         url=content_published.current_url)
+        print(f"uploaded module located at {published['url']}")
+        on_stage("published", published_id=published["id"], published_url=published["url"])
+        return published
     else:
         raise Exception("There was a problem with publishing the module. Review the log.")
+
+
+def open_temp_module(driver, to_server_url: str, resume: Dict) -> ModuleEdit:
+    """Opens the temp module an earlier attempt created, unless it is gone.
+
+    """
+    driver.get(resume["temp_url"])
+    module_edit = ModuleEdit(driver, to_server_url).wait_for_page_to_load()
+    if not module_edit.can_publish:
+        if has_reached(resume, "publishing"):
+            # Publishing moves the temp module out of the workspace, so it may have gone through
+            raise Exception(f"The temp module at {resume['temp_url']} was being published when the job "
+                            f"stopped and is gone now. Check whether it was published before copying it again")
+        raise Exception(f"Could not continue with the temp module at {resume['temp_url']}")
+    return module_edit
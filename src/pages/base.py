@@ -1,15 +1,166 @@
+import re
+import time
+from urllib.parse import urlparse
+
 import pypom
 
+from selenium.common.exceptions import (JavascriptException,
+                                        NoSuchElementException,
+                                        StaleElementReferenceException,
+                                        TimeoutException)
 from selenium.webdriver.common.by import By
 
+from src import tracing
+from src.constants import PAGE_LOAD_TIMEOUT, PAGE_READY_POLL_INTERVAL
+from src.elements import ElementCache
+
+# Resolves with true on the first change to the DOM, or with false after arguments[0] milliseconds
+_MUTATION_SCRIPT = """
+var done = arguments[arguments.length - 1];
+var observer = new MutationObserver(function () {
+    observer.disconnect();
+    clearTimeout(timer);
+    done(true);
+});
+var timer = setTimeout(function () {
+    observer.disconnect();
+    done(false);
+}, arguments[0]);
+observer.observe(document, {childList: true, subtree: true, attributes: true, characterData: true});
+"""
+
+
+def wait_for_mutation(driver, timeout: float) -> bool:
+    """Blocks until the DOM of the current page changes, or for at most `timeout` seconds.
+
+    Returns whether it changed. A page that is unloaded while waiting, e.g.
+    because a form submission navigated away from it, counts as a change.
+
+    """
+    try:
+        return bool(driver.execute_async_script(_MUTATION_SCRIPT, int(timeout * 1000)))
+    except JavascriptException:
+        return True
+
 
 class Page(pypom.Page):
+    """A legacy page, which counts as loaded once it is ready or shows a Site Error.
+
+    A page is ready when the path of the current url matches `_url_pattern`,
+    which is anchored to the legacy path of the page (see `matches_url`),
+    its key element `_ready_locator` is present and there is no Site Error.
+    Either can be None, e.g. for pages that are found at any url. The url
+    tells a page apart from the page it was opened from, whose elements can
+    still be there right after a click. A Site Error ends the wait too, as
+    the callers retry on it.
+
+    `find_element` memoizes the elements per page object (see ElementCache).
+    The presence checks don't, since they have to see the page change.
+
+    """
     _site_error_header_locator = (By.XPATH, ".//h1[text()='Site error']|.//h2[text()='Site Error']")
     _my_account_locator = (By.CSS_SELECTOR, "#portlet-login, #portlet-loggedin")
+    _url_pattern = None
+    _ready_locator = None
 
-    # Default to a 60 second timeout for CNX legacy
-    def __init__(self, driver, base_url=None, timeout=60, **url_kwargs):
+    def __init__(self, driver, base_url=None, timeout=PAGE_LOAD_TIMEOUT, **url_kwargs):
         super().__init__(driver, base_url, timeout, **url_kwargs)
+        self._elements = ElementCache()
+
+    def find_element(self, strategy, locator, within=None):
+        """Finds an element, or the element inside the element at the `within` locator, and caches it.
+
+        A parent element that went stale is found again, once.
+
+        """
+        if within is None:
+            return self._elements.get((strategy, locator), lambda: super(Page, self).find_element(strategy, locator))
+        try:
+            return self._elements.get((within, strategy, locator),
+                                      lambda: self.find_element(*within).find_element(strategy, locator))
+        except StaleElementReferenceException:
+            self._elements.clear()
+            return self._elements.get((within, strategy, locator),
+                                      lambda: self.find_element(*within).find_element(strategy, locator))
+
+    def forget_elements(self) -> None:
+        """Clears the cached elements, e.g. because one of them went stale.
+
+        """
+        self._elements.clear()
+
+    def open(self):
+        # The driver only returns from opening a page once it loaded as far as the page load strategy asks
+        with tracing.span(f"open {type(self).__name__}"):
+            return super().open()
+
+    def wait_for_page_to_load(self):
+        # The page is (re)loading, so the elements found so far are gone
+        self.forget_elements()
+        # Every page load is traced as a stage of its own, e.g. "load ModuleEdit"
+        self.wait_until(lambda: self.loaded, f"load {type(self).__name__}")
+        self.pm.hook.pypom_after_wait_for_page_to_load(page=self)
+        return self
+
+    def wait_until(self, condition, stage: str) -> None:
+        """Waits until `condition()` is true and traces the wait as a span of `stage`.
+
+        The condition is checked again as soon as the DOM changes (see
+        `wait_for_mutation`), and at least every PAGE_READY_POLL_INTERVAL
+        seconds. The span records how many checks it took. Raises a
+        TimeoutException after the page's timeout.
+
+        """
+        with tracing.span(stage) as span:
+            deadline = time.monotonic() + self.timeout
+            checks = 0
+            while True:
+                checks += 1
+                try:
+                    if condition():
+                        span.set(checks=checks)
+                        return
+                except (NoSuchElementException, StaleElementReferenceException):
+                    # The page changed while the condition looked at it
+                    self.forget_elements()
+                if time.monotonic() >= deadline:
+                    raise TimeoutException(f"{stage} timed out after {self.timeout}s at {self.driver.current_url}")
+                wait_for_mutation(self.driver, min(PAGE_READY_POLL_INTERVAL, max(0, deadline - time.monotonic())))
+
+    def wait_until_changed(self, element, stage: str) -> None:
+        """Waits until `element` is gone from the DOM, i.e. its page was replaced by the next one.
+
+        Use it after a submit that can land on a page the current one would
+        pass for, e.g. a login form that is answered with the login form.
+
+        """
+        def is_stale():
+            try:
+                element.tag_name
+                return False
+            except StaleElementReferenceException:
+                return True
+
+        self.wait_until(is_stale, stage)
+
+    @property
+    def loaded(self):
+        return self.is_ready or self.has_site_error
+
+    @classmethod
+    def matches_url(cls, url: str) -> bool:
+        """Whether `url` is one of this page's, going by the path alone.
+
+        """
+        return cls._url_pattern is None or re.search(cls._url_pattern, urlparse(url).path) is not None
+
+    @property
+    def is_ready(self):
+        if not self.matches_url(self.current_url):
+            return False
+        if self._ready_locator is not None and not self.is_element_present(*self._ready_locator):
+            return False
+        return not self.has_site_error
 
     @property
     def current_url(self):
@@ -52,6 +203,16 @@ class PublicPage(Page):
 
 class PrivatePage(Page):
     # These pages require you to be logged in already
+    _login_form_locator = (By.ID, "login_form")
+
+    @property
+    def loaded(self):
+        from src.pages.login_form import LoginForm
+
+        # Without a session the server redirects to the login form, which ends the wait for the caller to log in
+        return super().loaded or (LoginForm.matches_url(self.current_url)
+                                  and self.is_element_present(*self._login_form_locator))
+
     @property
     def can_login(self):
         return False
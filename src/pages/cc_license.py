@@ -6,6 +6,8 @@ from selenium.webdriver.common.by import By
 class CcLicense(PrivatePage):
     _cc_license_form_locator = (By.CSS_SELECTOR, 'form[action="cc_license"]')
     _agree_checkbox_locator = (By.CSS_SELECTOR, 'input[type="checkbox"][name="agree"]')
+    _url_pattern = r"^/mydashboard/cc_license/?$"
+    _ready_locator = _cc_license_form_locator
 
     @property
     def cc_license_form(self):
@@ -13,7 +15,7 @@ class CcLicense(PrivatePage):
 
     @property
     def agree_checkbox(self):
-        return self.cc_license_form.find_element(*self._agree_checkbox_locator)
+        return self.find_element(*self._agree_checkbox_locator, within=self._cc_license_form_locator)
 
     def agree(self):
         self.agree_checkbox.click()
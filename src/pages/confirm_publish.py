@@ -1,3 +1,7 @@
+import time
+
+from src import tracing
+from src.constants import SITE_ERROR_RETRY_DELAY
 from src.pages.base import PrivatePage
 
 from selenium.webdriver.common.by import By
@@ -5,17 +9,20 @@ from selenium.webdriver.common.by import By
 
 class ConfirmPublish(PrivatePage):
     _publish_form_locator = (By.CSS_SELECTOR, 'form[action="publishContent"]')
+    _url_pattern = r"^/Members/[^/]+/[^/]+/(module|collection)_publish_description/?$"
+    _ready_locator = _publish_form_locator
 
     @property
     def publish_form(self):
         return self.find_element(*self._publish_form_locator)
 
-    def submit(self, max_attempts=5):
+    def submit(self, max_attempts=5, limiter=None):
         from src.pages.content_published import ContentPublished
 
         content_published = ContentPublished(self.driver, self.base_url, self.timeout)
 
-        # Sometimes publishing fails with a SiteError. In those cases, we retry it a few times.
+        # Sometimes publishing fails with a SiteError. In those cases, we back off and retry it a few times.
+        # The SiteError also tells the limiter, if any, that the server is under stress
         for i in range(max_attempts):
             self.publish_form.submit()
             content_published = content_published.wait_for_page_to_load()
@@ -24,6 +31,10 @@ class ConfirmPublish(PrivatePage):
                 return content_published
             elif i < max_attempts - 1:
                 print(f"SiteError detected retry number {i}")
+                if limiter is not None:
+                    limiter.penalize()
+                tracing.retried()
+                time.sleep(SITE_ERROR_RETRY_DELAY * 2 ** i)
                 self.driver.back()
                 self.wait_for_page_to_load()
 
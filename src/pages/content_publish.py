@@ -16,6 +16,8 @@ class ContentPublish(PrivatePage):
         'input[type="submit"][name="form.button.submit"]',
     )
     _block_msg_locator = (By.CSS_SELECTOR, "#region-content > div > div > div > div > div")
+    _url_pattern = r"^/Members/[^/]+/[^/]+/(module|collection)_publish/?$"
+    _ready_locator = _message_textarea_locator
 
     @property
     def publish_form(self):
@@ -27,7 +29,7 @@ class ContentPublish(PrivatePage):
 
     @property
     def submit_button(self):
-        return self.publish_form.find_element(*self._submit_button_locator)
+        return self.find_element(*self._submit_button_locator, within=self._publish_form_locator)
 
     def fill_in_message(self, message):
         self.message_textarea.send_keys(message)
@@ -11,6 +11,8 @@ class ContentPublished(PrivatePage):
     _tbody_locator = (By.CSS_SELECTOR, "table.leftheadings tbody")
     _title_locator = (By.XPATH, ("./tr/th[text()='Name:']/following-sibling::td/span"))
     _id_locator = (By.XPATH, ("./tr/th[text()='ID:']/following-sibling::td"))
+    _url_pattern = r"^/Members/[^/]+/[^/]+/publishContent/?$"
+    _ready_locator = _tbody_locator
 
     @property
     def tbody(self):
@@ -18,7 +20,7 @@ class ContentPublished(PrivatePage):
 
     @property
     def title_span(self):
-        return self.tbody.find_element(*self._title_locator)
+        return self.find_element(*self._title_locator, within=self._tbody_locator)
 
     @property
     def title(self):
@@ -26,7 +28,7 @@ class ContentPublished(PrivatePage):
 
     @property
     def id_span(self):
-        return self.tbody.find_element(*self._id_locator)
+        return self.find_element(*self._id_locator, within=self._tbody_locator)
 
     @property
     def id(self):
@@ -9,9 +9,12 @@ from src.pages.base import Page
 
 class LoginForm(Page):
     URL_TEMPLATE = "/login_form"
+    # Plone answers require_login under whatever path needed the login, so only the end is anchored
+    _url_pattern = r"/(login_form|require_login)/?$"
     _login_form_locator = (By.ID, "login_form")
     _username_field_locator = (By.ID, "__ac_name")
     _password_field_locator = (By.ID, "__ac_password")
+    _ready_locator = _login_form_locator
 
     @property
     def login_form(self):
@@ -36,8 +39,13 @@ class LoginForm(Page):
     def login(self, username, password):
         self.username_field.send_keys(username)
         self.password_field.send_keys(password)
-        self.login_form.submit()
+        login_form = self.login_form
+        login_form.submit()
+        # Until the answer replaces this page its login form would count as a loaded private page
+        self.wait_until_changed(login_form, "submit LoginForm")
         from src.pages.my_cnx import MyCnx
 
-        my_cnx = MyCnx(self.driver, self.base_url, self.timeout)
-        return my_cnx.wait_for_page_to_load()
+        my_cnx = MyCnx(self.driver, self.base_url, self.timeout).wait_for_page_to_load()
+        if not my_cnx.is_ready and self.matches_url(self.driver.current_url):
+            raise Exception(f"Could not log in as {username}, the server answered with the login form again")
+        return my_cnx
@@ -2,9 +2,13 @@
 # License, v. 2.0. If a copy of the MPL was not distributed with this
 # file, You can obtain one at http://mozilla.org/MPL/2.0/.
 
+import time
+
 from selenium.webdriver.common.by import By
 from selenium.common.exceptions import UnexpectedAlertPresentException
 
+from src import tracing
+from src.constants import SITE_ERROR_RETRY_DELAY
 from src.pages.base import PrivatePage
 
 
@@ -13,6 +17,8 @@ class MetadataEdit(PrivatePage):
     _title_field_locator = (By.CSS_SELECTOR, 'input[type="text"][name="title"]')
     _collection_subtype_select_locator = (By.ID, "collectionType")
     _submit_button_locator = (By.CSS_SELECTOR, 'input[type="submit"][name="form.button.next"]')
+    _url_pattern = r"^/Members/[^/]+/[^/]+/content_title/?$"
+    _ready_locator = _title_field_locator
 
     @property
     def metadata_form(self):
@@ -20,11 +26,11 @@ class MetadataEdit(PrivatePage):
 
     @property
     def title_field(self):
-        return self.metadata_form.find_element(*self._title_field_locator)
+        return self.find_element(*self._title_field_locator, within=self._metadata_form_locator)
 
     @property
     def submit_button(self):
-        return self.metadata_form.find_element(*self._submit_button_locator)
+        return self.find_element(*self._submit_button_locator, within=self._metadata_form_locator)
 
     @property
     def is_collection(self):
@@ -39,7 +45,7 @@ class MetadataEdit(PrivatePage):
         self.title_field.send_keys(title)
         return self
 
-    def submit(self, max_attempts=3):
+    def submit(self, max_attempts=3, limiter=None):
         if self.is_collection:
             from src.pages.collection_edit import CollectionEdit
 
@@ -61,7 +67,11 @@ class MetadataEdit(PrivatePage):
                     return edit
                 elif i < max_attempts - 1:
                     # Sometimes creating a module or collection fails with a SiteError
-                    # In those cases, we retry creating them a few times
+                    # In those cases, we back off and retry creating them a few times
+                    if limiter is not None:
+                        limiter.penalize()
+                    tracing.retried()
+                    time.sleep(SITE_ERROR_RETRY_DELAY * 2 ** i)
                     self.driver.back()
                     self = self.wait_for_page_to_load()
                     self.submit_button.click()
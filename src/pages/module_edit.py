@@ -23,6 +23,10 @@ class ModuleEdit(PrivatePage):
     _edit_method_locator = (By.ID, "eipTopEditingMode")
     _save_button_locator = (By.CSS_SELECTOR, '[type="submit"][name="save"]')
     _portal_msg_locator = (By.CLASS_NAME, "portalMessage")
+    # Only the module itself, not its content_title or module_import_form pages
+    _url_pattern = r"^/Members/[^/]+/[^/]+/?$"
+    # The import page has a module_import_form form too, but no format to select
+    _ready_locator = _import_select_locator
 
     @property
     def username(self):
@@ -46,20 +50,24 @@ class ModuleEdit(PrivatePage):
 
     @property
     def portal_msg(self):
-        self.wait.until(lambda _: self.is_portal_msg_present)
+        self.wait_until(lambda: self.is_portal_msg_present, "wait ModuleEdit portal message")
         return self.find_element(*self._portal_msg_locator).text
 
     @property
     def publish_link(self):
         return self.find_element(*self._publish_link_locator)
 
+    @property
+    def can_publish(self):
+        return self.is_element_present(*self._publish_link_locator)
+
     @property
     def import_form(self):
         return self.find_element(*self._import_form_locator)
 
     @property
     def import_select(self):
-        return self.import_form.find_element(*self._import_select_locator)
+        return self.find_element(*self._import_select_locator, within=self._import_form_locator)
 
     @property
     def content_textarea(self):
@@ -88,7 +96,7 @@ class ModuleEdit(PrivatePage):
 
     def import_select_option(self, format):
         css_selector = 'option[value="{format}"]'.format(format=format)
-        return self.import_select.find_element(By.CSS_SELECTOR, css_selector)
+        return self.find_element(By.CSS_SELECTOR, css_selector, within=self._import_select_locator)
 
     def select_import_format(self, format):
         self.import_select_option(format).click()
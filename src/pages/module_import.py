@@ -6,6 +6,8 @@ from selenium.webdriver.common.by import By
 class ModuleImport(PrivatePage):
     _import_form_locator = (By.CSS_SELECTOR, 'form[action="module_import_form"][name="import"]')
     _import_file_field_locator = (By.CSS_SELECTOR, 'input[type="file"][name="importFile"]')
+    _url_pattern = r"^/Members/[^/]+/[^/]+/module_import_form/?$"
+    _ready_locator = _import_file_field_locator
 
     @property
     def import_form(self):
@@ -13,7 +15,7 @@ class ModuleImport(PrivatePage):
 
     @property
     def import_file_field(self):
-        return self.import_form.find_element(*self._import_file_field_locator)
+        return self.find_element(*self._import_file_field_locator, within=self._import_form_locator)
 
     def fill_in_filename(self, filename):
         self.import_file_field.send_keys(filename)
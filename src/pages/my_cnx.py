@@ -6,6 +6,8 @@ from selenium.webdriver.common.by import By
 
 class MyCnx(PrivatePage):
     URL_TEMPLATE = "/mycnx"
+    _url_pattern = r"^/mycnx/?$"
+    _ready_locator = (By.CSS_SELECTOR, "p.createlink a")
     _create_a_new_module_locator = (
         By.CSS_SELECTOR,
         'p.createlink a[href$="/mydashboard/cc_license?type_name=Module"',
@@ -1,24 +1,43 @@
 import asyncio
+import codecs
 import os
 from datetime import datetime, timezone
-from typing import List
+from typing import AsyncIterable, Iterable, List, Optional, Union
 
-from bs4 import BeautifulSoup
+from aiohttp import ClientSession
 
-from src.constants import DOWNLOAD_PATH
-from src.utils import (aiohttp_get,
+from src import tracing
+from src.cache import HttpCache
+from src.constants import DOWNLOAD_CHUNK_SIZE, DOWNLOAD_PATH, POLL_ITEM_TIMEOUT
+from src.ids import resolve
+from src.limits import ConcurrencyLimits
+from src.polling import PollItem, PollScheduler
+from src.query_ptool import PdfStatus, PtoolStatusParser, finish_parse
+from src.store import ArtifactStore
+from src.throttle import HostLimiters
+from src.tracing import Tracer
+from src.utils import (ConnectionStats,
+                       aiohttp_get,
                        build_url,
-                       download_file, make_time_obj)
+                       download_file,
+                       get_with_retries,
+                       http_session,
+                       make_time_obj,
+                       raise_for_status,
+                       reuse_or_create_session)
 
 
-async def fetch_query_ptool_page(server_url: str, col_id: str):
+async def fetch_query_ptool_page(server_url: str,
+                                 col_id: str,
+                                 session: ClientSession = None,
+                                 cache: HttpCache = None):
     """ Gets the query_ptool_page and adds some more metadata to the request.
 
     """
     start_time = datetime.now(timezone.utc)
 
     url = await build_url(server_url, col_id, "query_ptool")
-    r = await aiohttp_get(url)
+    r = await aiohttp_get(url, session, cache)
 
     r["start_time"] = start_time
     r["server_url"] = server_url
@@ -26,8 +45,15 @@ async def fetch_query_ptool_page(server_url: str, col_id: str):
     return r
 
 
-async def download_pdf(url: str, filename: str, timestamp: bool = True) -> None:
-    """ Downloads a pdf to a specific path.
+async def download_pdf(url: str,
+                       filename: str,
+                       timestamp: bool = True,
+                       session: ClientSession = None,
+                       segments: int = 1) -> str:
+    """ Downloads a pdf to a specific path and returns the path.
+
+    Large collection PDFs can be fetched over several connections at once by
+    passing the number of `segments` to split the download into.
 
     """
     if timestamp:
@@ -36,43 +62,200 @@ async def download_pdf(url: str, filename: str, timestamp: bool = True) -> None:
     filename = os.path.join(DOWNLOAD_PATH, filename + ".pdf")
     print("Downloading PDF to: {filename}".format(filename=filename))
 
-    await download_file(url, filename)
+    await download_file(url, filename, session, segments=segments)
+    return filename
+
+
+async def fetch_pdf_status(server_url: str,
+                           col_id: str,
+                           session: ClientSession = None,
+                           cache: HttpCache = None) -> PdfStatus:
+    """ Reads the PDF status of a collection from its query_ptool_page.
+
+    Without a cache the page is fed to a PtoolStatusParser while it streams in,
+    and parsing stops at the time cell. 5xx responses are retried like
+    `aiohttp_get` does. The rest of the body is still read, but
+    not parsed, so the connection can be reused. With a cache the full page
+    (possibly from disk) is fed to the same parser.
+
+    """
+    parser = PtoolStatusParser()
+
+    if cache is not None:
+        r = await fetch_query_ptool_page(server_url, col_id, session, cache)
+        parser.feed(r["text"])
+        time_string = await finish_parse(parser, r["text"])
+        return PdfStatus(col_id, r["url"], r["start_time"], time_string, r["cached"])
+
+    checked_at = datetime.now(timezone.utc)
+    url = await build_url(server_url, col_id, "query_ptool")
+    decoder = codecs.getincrementaldecoder("utf-8")()
+    chunks = []
+
+    async with reuse_or_create_session(session) as session:
+        async with get_with_retries(session, url) as response:
+            if response.status != 200:
+                raise_for_status(url, response.status)
+            async for chunk in response.content.iter_chunked(DOWNLOAD_CHUNK_SIZE):
+                tracing.add_bytes(len(chunk))
+                if not parser.found:
+                    text = decoder.decode(chunk)
+                    chunks.append(text)
+                    parser.feed(text)
+    if not parser.found:
+        # Characters split across the end of the last chunk are only decoded by the final call
+        text = decoder.decode(b"", final=True)
+        chunks.append(text)
+        parser.feed(text)
 
+    time_string = await finish_parse(parser, "".join(chunks))
+    return PdfStatus(col_id, url, checked_at, time_string)
 
-async def download_pdf_when_ready(server_url: str, col_id:str):
-    """ Checks the query_ptool_page for a time string and downloads the pdf.
 
-    The PDF creation process can take several minutes. This command will check
-    the status of the query_ptool_page by looking for a timestamp of when the
-    PDF was generated. Upon finding a timestamp it will begin a download of the
-    pdf. BeautifulSoup makes this very easy to do.
+async def check_pdf_ready(server_url: str,
+                          col_id: str,
+                          session: ClientSession = None,
+                          cache: HttpCache = None):
+    """ Checks the query_ptool_page once for the time the PDF was generated.
+
+    The PDF creation process can take several minutes. When the
+    query_ptool_page has a timestamp of when the PDF was generated the PDF is
+    available and the timestamp is returned. Otherwise `None` is returned so
+    the caller can check again later.
 
     """
-    r = await fetch_query_ptool_page(server_url, col_id)
-    pdf_url = await build_url(server_url, col_id, "pdf")
-    if r["status"] == 200:
-        soup = BeautifulSoup(r["text"], "html.parser")
-        time_string = soup.findAll("td")[2].string
-        # When we have a time string that means the PDF is available
-        if time_string:
-            time_obj = await make_time_obj(time_string)
-            time_diff = r["start_time"] - time_obj
-            print(f"PDF for col{col_id} is {time_diff} old")
-            await download_pdf(pdf_url, col_id)
-        else:
-            print(f"The pdf is not ready for {col_id} at {r['url']}. "
-                  f"Will wait and retry in 20 sec.")
-            await asyncio.sleep(20)
-            await download_pdf_when_ready(server_url, col_id)
+    with tracing.span("query_ptool", col_id=col_id) as span:
+        status = await fetch_pdf_status(server_url, col_id, session, cache)
+        span.set(ready=status.ready, cached=status.cached)
+    # When we have a time string that means the PDF is available
+    if status.ready:
+        time_obj = await make_time_obj(status.time_string)
+        time_diff = status.checked_at - time_obj
+        print(f"PDF for col{col_id} is {time_diff} old")
+        return time_obj
     else:
-        print(f"There was a problem with {server_url} and col_id {col_id}")
-        return 0
+        print(f"The pdf is not ready for {col_id} at {status.url}. Will check again later.")
+        return None
+
+
+def create_pdf_scheduler(server_url: str,
+                         session: ClientSession,
+                         item_timeout: float = POLL_ITEM_TIMEOUT,
+                         deadline: Optional[float] = None,
+                         segments: int = 1,
+                         cache: HttpCache = None,
+                         store: ArtifactStore = None,
+                         limits: ConcurrencyLimits = None) -> PollScheduler:
+    """ Creates a PollScheduler that downloads each PDF as soon as it is ready.
+
+    With a `store`, a PDF whose generation time matches one that was already
+    downloaded is taken from the store instead of being downloaded again. At
+    most `limits.http` checks, and as many downloads, run at once.
+
+    """
+    limits = limits or ConcurrencyLimits()
+    downloads = asyncio.Semaphore(limits.http)
 
+    async def check(key):
+        col_server_url, col_id = resolve(key, server_url)
+        return await check_pdf_ready(col_server_url, col_id, session, cache)
 
-async def download_pdfs(server_url: str, col_ids: List) -> None:
-    """ Creates a list of download_pdf_when_ready futures and runs them.
+    async def on_ready(key, time_obj):
+        col_server_url, col_id = resolve(key, server_url)
+        with tracing.span("download_pdf", col_id=col_id, segments=segments) as span:
+            loop = asyncio.get_event_loop()
+            version = time_obj.isoformat()
+            if store is not None:
+                entry = store.lookup(col_server_url, col_id, "pdf", version)
+                span.set(from_store=entry is not None)
+                if entry is not None:
+                    path = store.checkout(entry)
+                    print(f"PDF for {col_id} is unchanged since it was downloaded to {path}")
+                    return
+
+            pdf_url = await build_url(col_server_url, col_id, "pdf")
+            async with downloads:
+                path = await download_pdf(pdf_url, col_id, session=session, segments=segments)
+            if store is not None:
+                await loop.run_in_executor(None, store.add, col_server_url, col_id, "pdf", version, path)
+
+    return PollScheduler(check, on_ready, item_timeout=item_timeout, deadline=deadline,
+                         max_in_flight=limits.http)
+
+
+async def download_pdf_when_ready(server_url: str,
+                                  col_id: str,
+                                  session: ClientSession = None,
+                                  item_timeout: float = POLL_ITEM_TIMEOUT,
+                                  segments: int = 1) -> PollItem:
+    """ Polls the query_ptool_page for a single collection and downloads the pdf.
+
+    """
+    async with reuse_or_create_session(session) as session:
+        scheduler = create_pdf_scheduler(server_url, session, item_timeout, segments=segments)
+        item = scheduler.add(col_id)
+        await scheduler.run()
+
+    return item
+
+
+async def download_pdfs(server_url: str,
+                        col_ids: Union[Iterable, AsyncIterable],
+                        item_timeout: float = POLL_ITEM_TIMEOUT,
+                        deadline: Optional[float] = None,
+                        segments: int = 1,
+                        use_cache: bool = True,
+                        use_store: bool = True,
+                        limits: ConcurrencyLimits = None,
+                        trace_path: str = None,
+                        metrics_path: str = None) -> List[PollItem]:
+    """ Polls the query_ptool_page of every collection and downloads the pdfs.
+
+    All of the collections are polled from a single PollScheduler, with
+    backoff between checks, and share one pooled HTTP session for the whole
+    run. Collections that are not ready within `item_timeout` seconds, or
+    before the `deadline` for the whole run, are given up on.
+
+    Unless `use_cache` is False the query_ptool_pages are revalidated against
+    the on-disk HttpCache, and unless `use_store` is False PDFs that have not
+    been regenerated since the last download are taken from the ArtifactStore.
+
+    `limits.http` caps the concurrent checks, downloads and connections, and
+    the AdaptiveLimiter of the server lowers the concurrency below that while
+    the server is answering with 5xx responses or timing out.
+
+    `col_ids` can also be IdRows, whose server replaces `server_url`, and an
+    async iterable such as `stream_ids`, which is polled as it is read.
+
+    Every query_ptool check and PDF download is traced. The spans are written
+    to `trace_path` as JSON lines and the metrics per stage to `metrics_path`
+    as a Prometheus textfile, if given, and the p50, p95 and max of every
+    stage are printed at the end.
+
+    Returns a PollItem for every collection whose PDF was not downloaded,
+    with its status and error.
 
     """
-    futures = [download_pdf_when_ready(server_url, col_id) for col_id in col_ids]
+    limits = limits or ConcurrencyLimits()
+    limiters = HostLimiters(max_limit=limits.http)
+    stats = ConnectionStats()
+    cache = HttpCache() if use_cache else None
+    store = ArtifactStore() if use_store else None
+    tracer = Tracer(trace_path, metrics_path).start()
+
+    try:
+        async with http_session(stats, limit_per_host=limits.http, limiters=limiters) as session:
+            scheduler = create_pdf_scheduler(server_url, session, item_timeout, deadline, segments, cache,
+                                             store, limits)
+            items = await scheduler.run(col_ids)
+    finally:
+        print(f"HTTP connections: {stats}")
+        print(f"Adaptive limits: {limiters}")
+        if cache is not None:
+            print(f"HTTP cache: {cache}")
+        tracer.finish()
+    print(f"downloaded {scheduler.ready} PDFs")
+    for item in items:
+        print(f"No PDF downloaded for {item.key} ({item.status} after {item.attempts} checks)")
 
-    await asyncio.wait(futures)
+    return items
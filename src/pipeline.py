@@ -0,0 +1,130 @@
+import asyncio
+import time
+from typing import Any, AsyncIterable, Awaitable, Callable, Hashable, Iterable, List, NamedTuple, Union
+
+from src.constants import PIPELINE_QUEUE_SIZE
+
+_DONE = object()
+
+
+class Stage(NamedTuple):
+    """One step of a `Pipeline`: `handle` is run by `workers` concurrent workers.
+
+    """
+    name: str
+    handle: Callable[[Any], Awaitable]
+    workers: int = 1
+
+
+class PipelineItem:
+    """The state of one key as it moves through the stages of a `Pipeline`.
+
+    """
+    PENDING = "pending"
+    DONE = "done"
+    FAILED = "failed"
+
+    def __init__(self, key: Hashable):
+        self.key = key
+        self.status = self.PENDING
+        self.stage = None
+        self.result = None
+        self.error = None
+        self.started_at = None
+        self.finished_at = None
+
+    @property
+    def elapsed(self) -> float:
+        return (self.finished_at or time.monotonic()) - (self.started_at or time.monotonic())
+
+    def __repr__(self):
+        return f"<PipelineItem {self.key} {self.status} stage={self.stage}>"
+
+
+class Pipeline:
+    """Runs keys through a chain of stages connected by bounded queues.
+
+    The first stage is called with each key, every later stage with what the
+    stage before it returned. A key moves on to the next stage as soon as it
+    is done with the current one, so e.g. the first module can be uploading
+    while the last one is still downloading. The queues between the stages
+    hold at most `queue_size` values, so a fast stage waits for a slow one
+    instead of piling up work it can't hand off.
+
+    A key whose stage raises is marked failed at that stage and dropped,
+    without affecting any other key.
+
+    The keys can be an async iterable, e.g. ids streamed from a file. They are
+    only read as the first stage takes them, so no work is set up for keys
+    that are still waiting. A key that was already seen is skipped.
+
+    """
+    def __init__(self, stages: List[Stage], queue_size: int = PIPELINE_QUEUE_SIZE):
+        if not stages:
+            raise Exception("A pipeline needs at least one stage")
+        self.stages = stages
+        self.queue_size = queue_size
+        self.items = {}
+
+    async def run(self, keys: Union[Iterable[Hashable], AsyncIterable[Hashable]]) -> List[PipelineItem]:
+        """Runs every key through the pipeline and returns their items in order.
+
+        """
+        queues = [asyncio.Queue(maxsize=self.queue_size) for _ in self.stages]
+
+        stage_tasks = []
+        for index, stage in enumerate(self.stages):
+            next_queue = queues[index + 1] if index + 1 < len(self.stages) else None
+            workers = [asyncio.ensure_future(self._work(stage, queues[index], next_queue))
+                       for _ in range(stage.workers)]
+            stage_tasks.append(workers)
+
+        try:
+            if isinstance(keys, AsyncIterable):
+                async for key in keys:
+                    await self._feed(queues[0], key)
+            else:
+                for key in keys:
+                    await self._feed(queues[0], key)
+            for index, workers in enumerate(stage_tasks):
+                for _ in workers:
+                    await queues[index].put(_DONE)
+                await asyncio.gather(*workers)
+        finally:
+            for workers in stage_tasks:
+                for worker in workers:
+                    worker.cancel()
+
+        return list(self.items.values())
+
+    async def _feed(self, queue: asyncio.Queue, key: Hashable) -> None:
+        if key in self.items:
+            return
+        self.items[key] = PipelineItem(key)
+        await queue.put((key, key))
+
+    async def _work(self, stage: Stage, queue: asyncio.Queue, next_queue: asyncio.Queue) -> None:
+        while True:
+            entry = await queue.get()
+            if entry is _DONE:
+                return
+
+            key, value = entry
+            item = self.items[key]
+            item.stage = stage.name
+            item.started_at = item.started_at or time.monotonic()
+            try:
+                result = await stage.handle(value)
+            except Exception as e:
+                item.status = PipelineItem.FAILED
+                item.error = e
+                item.finished_at = time.monotonic()
+                print(f"{key} failed at the {stage.name} stage: {e}")
+                continue
+
+            if next_queue is not None:
+                await next_queue.put((key, result))
+            else:
+                item.status = PipelineItem.DONE
+                item.result = result
+                item.finished_at = time.monotonic()
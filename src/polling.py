@@ -0,0 +1,256 @@
+import asyncio
+import heapq
+import itertools
+import random
+from typing import AsyncIterable, Awaitable, Callable, Hashable, Iterable, List, Optional, Union
+
+from aiohttp import ClientError
+
+from src.constants import (POLL_BACKOFF_FACTOR,
+                           POLL_BASE_DELAY,
+                           POLL_ITEM_TIMEOUT,
+                           POLL_JITTER,
+                           POLL_MAX_DELAY,
+                           POLL_MAX_IN_FLIGHT)
+from src.utils import ServerError
+
+# Errors a check can run into while the server is under stress, after which the key is checked again later
+TRANSIENT_ERRORS = (ServerError, ClientError, asyncio.TimeoutError)
+
+
+class PollItem:
+    """The state of one key that is being polled by a `PollScheduler`.
+
+    """
+    PENDING = "pending"
+    READY = "ready"
+    FAILED = "failed"
+    EXPIRED = "expired"
+
+    def __init__(self, key: Hashable, deadline: float):
+        self.key = key
+        self.deadline = deadline
+        self.attempts = 0
+        self.status = self.PENDING
+        self.result = None
+        self.error = None
+
+    def __repr__(self):
+        return f"<PollItem {self.key} {self.status} attempts={self.attempts}>"
+
+
+class PollScheduler:
+    """Polls many keys from a single priority queue ordered by next check time.
+
+    Every pending key lives in one heap keyed by the time it should next be
+    checked, so memory stays flat no matter how long a key takes to become
+    ready. The `check` coroutine is called with a key and returns `None` when
+    the key is not ready yet, or any other value once it is. Not ready keys are
+    rescheduled with exponential backoff and jitter until they are ready, their
+    own deadline (`item_timeout`) passes or the global `deadline` passes. At
+    most `max_in_flight` checks run at the same time. A check that fails with
+    one of the TRANSIENT_ERRORS, such as a 5xx response, is rescheduled the
+    same way, and any other error fails the key.
+
+    When a key becomes ready `on_ready(key, result)` is started as a separate
+    task, so slow downloads don't hold up the polling of the other keys.
+
+    Only the keys that are still being polled are kept in `items`. Keys that
+    are done are dropped from it: ready ones are counted in `ready`, and the
+    ones that failed or expired are kept in `unfinished` to be reported, so
+    memory doesn't grow with the number of keys that were ready.
+
+    """
+    def __init__(self,
+                 check: Callable[[Hashable], Awaitable],
+                 on_ready: Callable[[Hashable, object], Awaitable] = None,
+                 base_delay: float = POLL_BASE_DELAY,
+                 max_delay: float = POLL_MAX_DELAY,
+                 factor: float = POLL_BACKOFF_FACTOR,
+                 jitter: float = POLL_JITTER,
+                 item_timeout: float = POLL_ITEM_TIMEOUT,
+                 deadline: Optional[float] = None,
+                 max_in_flight: int = POLL_MAX_IN_FLIGHT):
+        self.check = check
+        self.on_ready = on_ready
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+        self.factor = factor
+        self.jitter = jitter
+        self.item_timeout = item_timeout
+        self.deadline = deadline
+        self.max_in_flight = max_in_flight
+
+        self.items = {}
+        self.ready = 0
+        self.unfinished = []
+        self._queue = []
+        self._counter = itertools.count()
+        self._in_flight = {}
+        self._ready_tasks = set()
+        self._wakeup = None
+
+    def backoff(self, attempts: int) -> float:
+        """Returns the delay before the next check after `attempts` checks.
+
+        """
+        delay = min(self.max_delay, self.base_delay * self.factor ** (attempts - 1))
+        return delay * (1 - self.jitter * random.random())
+
+    def add(self, key: Hashable) -> PollItem:
+        """Adds a key to be checked as soon as possible, unless it is already being polled.
+
+        """
+        if key in self.items:
+            return self.items[key]
+
+        now = self._now()
+        item = PollItem(key, now + self.item_timeout)
+        self.items[key] = item
+        self._push(now, item)
+        if self._wakeup is not None:
+            self._wakeup.set()
+        return item
+
+    async def run(self, keys: Union[Iterable[Hashable], AsyncIterable[Hashable]] = None) -> List[PollItem]:
+        """Polls until every key is ready, failed or expired, and returns the ones that were not ready.
+
+        `keys` are added while the scheduler runs, as they are read, so e.g. ids
+        streamed from a file are polled before the whole file has been read.
+
+        """
+        self._wakeup = asyncio.Event()
+        global_deadline = self._now() + self.deadline if self.deadline is not None else None
+        feeder = asyncio.ensure_future(self._feed(keys)) if keys is not None else None
+
+        try:
+            while self._queue or self._in_flight or (feeder is not None and not feeder.done()):
+                now = self._now()
+                if global_deadline is not None and now >= global_deadline:
+                    self._expire_all()
+                    break
+
+                if not self._queue or len(self._in_flight) >= self.max_in_flight:
+                    await self._sleep(None, global_deadline)
+                    continue
+
+                next_check, _, item = self._queue[0]
+                if next_check > now:
+                    await self._sleep(next_check, global_deadline)
+                    continue
+
+                heapq.heappop(self._queue)
+                self._in_flight[item.key] = asyncio.ensure_future(self._check(item))
+            if feeder is not None and feeder.done():
+                # Raises the error, if any, of reading the keys
+                feeder.result()
+        finally:
+            if feeder is not None:
+                feeder.cancel()
+            # Checks still running when the global deadline passes are abandoned
+            tasks = list(self._in_flight.values())
+            for task in tasks:
+                task.cancel()
+            if tasks:
+                await asyncio.gather(*tasks, return_exceptions=True)
+
+        if self._ready_tasks:
+            await asyncio.gather(*self._ready_tasks, return_exceptions=True)
+
+        return self.unfinished
+
+    async def _feed(self, keys: Union[Iterable[Hashable], AsyncIterable[Hashable]]) -> None:
+        try:
+            if isinstance(keys, AsyncIterable):
+                async for key in keys:
+                    self.add(key)
+            else:
+                for key in keys:
+                    self.add(key)
+        finally:
+            self._wakeup.set()
+
+    async def _check(self, item: PollItem) -> None:
+        item.attempts += 1
+        try:
+            result = await self.check(item.key)
+        except asyncio.CancelledError:
+            item.status = PollItem.EXPIRED
+            self._finish(item)
+            raise
+        except TRANSIENT_ERRORS as e:
+            item.error = e
+            print(f"Checking {item.key} failed ({e!r}). Will check again later.")
+            self._reschedule(item)
+        except Exception as e:
+            item.status = PollItem.FAILED
+            item.error = e
+            print(f"Polling {item.key} failed: {e}")
+            self._finish(item)
+        else:
+            if result is not None:
+                item.status = PollItem.READY
+                item.result = result
+                item.error = None
+                if self.on_ready is not None:
+                    task = asyncio.ensure_future(self._ready(item))
+                    self._ready_tasks.add(task)
+                    task.add_done_callback(self._ready_tasks.discard)
+                else:
+                    self._finish(item)
+            else:
+                self._reschedule(item)
+        finally:
+            del self._in_flight[item.key]
+            self._wakeup.set()
+
+    async def _ready(self, item: PollItem) -> None:
+        try:
+            await self.on_ready(item.key, item.result)
+        except Exception as e:
+            item.status = PollItem.FAILED
+            item.error = e
+            print(f"Handling ready {item.key} failed: {e}")
+        finally:
+            self._finish(item)
+
+    def _reschedule(self, item: PollItem) -> None:
+        next_check = self._now() + self.backoff(item.attempts)
+        if next_check > item.deadline:
+            item.status = PollItem.EXPIRED
+            print(f"Gave up polling {item.key} after {item.attempts} checks")
+            self._finish(item)
+        else:
+            self._push(next_check, item)
+
+    def _finish(self, item: PollItem) -> None:
+        self.items.pop(item.key, None)
+        if item.status == PollItem.READY:
+            self.ready += 1
+        else:
+            self.unfinished.append(item)
+
+    async def _sleep(self, until: Optional[float], global_deadline: Optional[float]) -> None:
+        """Sleeps until `until`, the global deadline or a check finishes.
+
+        """
+        wake_times = [t for t in (until, global_deadline) if t is not None]
+        timeout = max(0.0, min(wake_times) - self._now()) if wake_times else None
+        try:
+            await asyncio.wait_for(self._wakeup.wait(), timeout)
+        except asyncio.TimeoutError:
+            pass
+        self._wakeup.clear()
+
+    def _expire_all(self) -> None:
+        for _, _, item in self._queue:
+            item.status = PollItem.EXPIRED
+            self._finish(item)
+        self._queue.clear()
+
+    def _push(self, when: float, item: PollItem) -> None:
+        heapq.heappush(self._queue, (when, next(self._counter), item))
+
+    @staticmethod
+    def _now() -> float:
+        return asyncio.get_event_loop().time()
@@ -0,0 +1,100 @@
+import asyncio
+from datetime import datetime
+from html.parser import HTMLParser
+from typing import NamedTuple, Optional
+
+from bs4 import BeautifulSoup
+
+# The query_ptool_page has the time the PDF was generated in its third cell
+TIME_CELL_INDEX = 2
+
+
+class PdfStatus(NamedTuple):
+    """The PDF status of a collection as read from its query_ptool_page.
+
+    """
+    col_id: str
+    url: str
+    checked_at: datetime
+    time_string: Optional[str]
+    cached: bool = False
+
+    @property
+    def ready(self) -> bool:
+        return bool(self.time_string)
+
+
+class _TimeCellFound(Exception):
+    pass
+
+
+class PtoolStatusParser(HTMLParser):
+    """Reads the time cell of a query_ptool_page without building a tree.
+
+    The page can be fed in chunks as it is downloaded. `feed` stops tokenizing
+    and returns True as soon as the time cell has been read, after which the
+    rest of the page can be ignored. This is the same tokenizer BeautifulSoup's
+    `html.parser` uses, without the cost of building and searching a full soup.
+
+    """
+    def __init__(self):
+        super().__init__(convert_charrefs=True)
+        self.found = False
+        self._cells = 0
+        self._in_time_cell = False
+        self._text = []
+
+    def feed(self, data: str) -> bool:
+        if not self.found:
+            try:
+                super().feed(data)
+            except _TimeCellFound:
+                self.found = True
+        return self.found
+
+    def handle_starttag(self, tag, attrs):
+        if tag in ("td", "th", "tr") and self._in_time_cell:
+            # The time cell was closed implicitly by the next cell or row
+            raise _TimeCellFound()
+        if tag == "td":
+            self._in_time_cell = self._cells == TIME_CELL_INDEX
+            self._cells += 1
+
+    def handle_endtag(self, tag):
+        if tag in ("td", "tr", "table") and self._in_time_cell:
+            raise _TimeCellFound()
+
+    def handle_data(self, data):
+        if self._in_time_cell:
+            self._text.append(data)
+
+    @property
+    def time_string(self) -> Optional[str]:
+        return "".join(self._text).strip() or None
+
+
+def soup_time_string(text: str) -> Optional[str]:
+    """Reads the time cell with BeautifulSoup, for pages the fast parser can't.
+
+    This is CPU heavy, so run it in a worker thread.
+
+    """
+    cells = BeautifulSoup(text, "html.parser").findAll("td")
+    if len(cells) <= TIME_CELL_INDEX:
+        raise Exception("The query_ptool_page has no time cell")
+    time_string = cells[TIME_CELL_INDEX].string
+    return (time_string.strip() or None) if time_string else None
+
+
+async def finish_parse(parser: PtoolStatusParser, text: str) -> Optional[str]:
+    """Returns the time string, falling back to BeautifulSoup off the event loop.
+
+    `text` is the full page and is only parsed again when the fast parser
+    reached the end of it without finding a closed time cell.
+
+    """
+    if parser.found:
+        return parser.time_string
+
+    loop = asyncio.get_event_loop()
+    return await loop.run_in_executor(None, soup_time_string, text)
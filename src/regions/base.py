@@ -1,7 +1,30 @@
 import pypom
 
+from selenium.common.exceptions import StaleElementReferenceException
+
+from src.elements import ElementCache
+
 
 class Region(pypom.Region):
+    def __init__(self, page, root=None):
+        # Loading the region can look up elements already
+        self._elements = ElementCache()
+        super().__init__(page, root)
+
+    def find_element(self, strategy, locator):
+        """Finds an element in the region and caches it, like `Page.find_element`.
+
+        When the root went stale the page's cache is cleared too, so a root
+        found by its locator is looked up again, once.
+
+        """
+        try:
+            return self._elements.get((strategy, locator), lambda: super(Region, self).find_element(strategy, locator))
+        except StaleElementReferenceException:
+            self._elements.clear()
+            self.page.forget_elements()
+            return self._elements.get((strategy, locator), lambda: super(Region, self).find_element(strategy, locator))
+
     @property
     def current_url(self):
         return self.driver.current_url
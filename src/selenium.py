@@ -1,16 +1,432 @@
+import os
+import shutil
+import tempfile
+import threading
+from contextlib import contextmanager, nullcontext
+from typing import Iterable, List, NamedTuple, Optional, Tuple
+
 from selenium import webdriver
+from selenium.common.exceptions import WebDriverException
 from selenium.webdriver.chrome.options import Options
 
+from src import tracing
+from src.constants import (CHROME_BLOCKED_URLS,
+                           CHROME_MEMORY_SWITCHES,
+                           CHROME_PAGE_LOAD_STRATEGY,
+                           CHROME_PROFILE_TEMPLATE,
+                           DRIVER_MAX_USES,
+                           DRIVER_POOL_SIZE)
+from src.throttle import HostLimiters
+
+_template_lock = threading.Lock()
+
+
+class ChromeProfile(NamedTuple):
+    """How the Chrome drivers are started, and what their browsers leave out.
+
+    The defaults are a lightweight profile for the upload workers, which only
+    need the forms of the legacy pages. A page counts as loaded once its DOM
+    is ready (the `eager` strategy), images are blocked by the content
+    settings and fonts, media and analytics by `blocked_urls`. Every browser
+    starts from a copy of the user data directory at `template_dir`, which is
+    warmed by a first browser, so the others skip creating a profile. The
+    `switches` turn off background features of Chrome to save memory.
+
+    `full()` is a stock Chrome, e.g. to compare against.
+
+    """
+    page_load_strategy: str = CHROME_PAGE_LOAD_STRATEGY
+    block_images: bool = True
+    blocked_urls: Tuple[str, ...] = CHROME_BLOCKED_URLS
+    template_dir: Optional[str] = CHROME_PROFILE_TEMPLATE
+    switches: Tuple[str, ...] = CHROME_MEMORY_SWITCHES
+
+    @classmethod
+    def full(cls) -> "ChromeProfile":
+        return cls(page_load_strategy="normal", block_images=False, blocked_urls=(), template_dir=None, switches=())
+
+    @classmethod
+    def from_options(cls, full: bool = False, switches: str = None) -> "ChromeProfile":
+        """Creates the profile from command line values. `switches` replaces the switches, separated by spaces.
 
-def create_chrome_driver(headless=False):
+        """
+        profile = cls.full() if full else cls()
+        if switches is not None:
+            profile = profile._replace(switches=tuple(switches.split()))
+        return profile
+
+    def __str__(self):
+        parts = [f"{self.page_load_strategy} page loads"]
+        if self.block_images:
+            parts.append("images blocked")
+        if self.blocked_urls:
+            parts.append(f"{len(self.blocked_urls)} url patterns blocked")
+        parts.append(f"{len(self.switches)} extra switches")
+        if self.template_dir is not None:
+            parts.append(f"profile template at {self.template_dir}")
+        return ", ".join(parts)
+
+
+class _Chrome(webdriver.Chrome):
+    """A Chrome driver that removes its copy of the profile template when it quits.
+
+    """
+    def __init__(self, user_data_dir: Optional[str], **kwargs):
+        self.user_data_dir = user_data_dir
+        super().__init__(**kwargs)
+        # The chromedriver and the browser it started, for the pool's memory measurements
+        self.browser_pids = process_tree_pids([self.service.process.pid])
+
+    def quit(self):
+        try:
+            super().quit()
+        finally:
+            if self.user_data_dir is not None:
+                shutil.rmtree(self.user_data_dir, ignore_errors=True)
+
+
+def create_chrome_driver(headless=False, profile: ChromeProfile = None):
     """ Instantiates the Chrome webdriver with or without the headless option.
 
+    The browser is started with `profile`, the lightweight ChromeProfile by
+    default.
+
     """
+    profile = profile or ChromeProfile()
+    chrome_options = _chrome_options(headless, profile)
+
+    user_data_dir = None
+    if profile.template_dir is not None:
+        user_data_dir = _copy_profile_template(profile)
+        chrome_options.add_argument(f"--user-data-dir={user_data_dir}")
+    try:
+        driver = _Chrome(user_data_dir, options=chrome_options)
+    except Exception:
+        if user_data_dir is not None:
+            shutil.rmtree(user_data_dir, ignore_errors=True)
+        raise
+
+    if profile.blocked_urls:
+        driver.execute_cdp_cmd("Network.enable", {})
+        driver.execute_cdp_cmd("Network.setBlockedURLs", {"urls": list(profile.blocked_urls)})
+    return driver
+
+
+def _chrome_options(headless: bool, profile: ChromeProfile) -> Options:
     chrome_options = Options()
     chrome_options.add_experimental_option("w3c", False)
     if headless:
         chrome_options.add_argument("--headless")
+    chrome_options.page_load_strategy = profile.page_load_strategy
+    if profile.block_images:
+        chrome_options.add_experimental_option("prefs", {"profile.managed_default_content_settings.images": 2})
+    for switch in profile.switches:
+        chrome_options.add_argument(switch)
+    return chrome_options
+
+
+def _copy_profile_template(profile: ChromeProfile) -> str:
+    """Copies the profile template to a new user data directory for one browser, warming it first if needed.
+
+    """
+    with _template_lock:
+        if not os.path.isdir(profile.template_dir):
+            _warm_profile_template(profile)
+
+    user_data_dir = tempfile.mkdtemp(prefix="kcopy-chrome-")
+    # The Singleton files lock a user data directory to the browser using it
+    shutil.copytree(profile.template_dir, user_data_dir, dirs_exist_ok=True,
+                    ignore=shutil.ignore_patterns("Singleton*"))
+    return user_data_dir
+
+
+def _warm_profile_template(profile: ChromeProfile) -> None:
+    print(f"warming the Chrome profile template at {profile.template_dir}")
+    part_dir = profile.template_dir + ".part"
+    shutil.rmtree(part_dir, ignore_errors=True)
+    os.makedirs(os.path.dirname(profile.template_dir), exist_ok=True)
+
+    chrome_options = _chrome_options(True, profile)
+    chrome_options.add_argument(f"--user-data-dir={part_dir}")
     driver = webdriver.Chrome(options=chrome_options)
+    try:
+        driver.get("about:blank")
+    finally:
+        driver.quit()
+    os.replace(part_dir, profile.template_dir)
+
+
+def process_tree_pids(pids: Iterable[int]) -> List[int]:
+    """Returns the pids that are still running and all of their descendants.
+
+    For a chromedriver that is its browser with the renderer, GPU and utility
+    processes. Only the processes of the tree are read, through the children
+    lists Linux keeps for every thread. Returns an empty list where there is
+    no /proc to read, e.g. on macOS.
+
+    """
+    found = []
+    pending = list(pids)
+    while pending:
+        pid = pending.pop()
+        try:
+            threads = os.listdir(f"/proc/{pid}/task")
+        except OSError:
+            continue
+        found.append(pid)
+        for thread in threads:
+            try:
+                with open(f"/proc/{pid}/task/{thread}/children") as children_file:
+                    pending += [int(child) for child in children_file.read().split()]
+            except (OSError, ValueError):
+                continue
+    return found
+
+
+def processes_rss(pids: Iterable[int]) -> Optional[int]:
+    """Returns the resident memory of processes in bytes.
+
+    Pages shared by the processes are counted once per process. Returns None
+    if none of them could be read.
+
+    """
+    rss = None
+    for pid in pids:
+        try:
+            with open(f"/proc/{pid}/statm") as statm_file:
+                rss = (rss or 0) + int(statm_file.read().split()[1]) * os.sysconf("SC_PAGE_SIZE")
+        except (OSError, IndexError, ValueError):
+            continue
+    return rss
+
+
+class DriverPool:
+    """A bounded pool of Chrome drivers that are logged into a legacy server.
+
+    Every driver is created and logged in once, then reused for up to
+    `max_uses` modules. Idle drivers are health checked before they are handed
+    out again. Drivers that fail the check, were used for a copy that raised,
+    or reached `max_uses` are quit and replaced on demand. At most `size`
+    drivers are alive at once. The pool is thread safe, so it can be shared by
+    the workers of a ThreadPoolExecutor, and `prestart` can be run in that
+    executor to launch the browsers while the downloads are still running.
+
+    With a SessionBroker that has logged into the server, new drivers are given
+    its cookies instead of going through the login form. A driver that does
+    log in through the form, e.g. because the session expired, hands its fresh
+    cookies back to the broker.
+
+    With `limiters`, the logins and the steps of a module copy each hold a
+    slot of the server's adaptive limiter (see `throttle`).
+
+    The drivers are started with `profile` (see ChromeProfile). The memory of
+    every browser is measured when it is released, and the most any of them
+    used is kept in `peak_rss`.
+
+    """
+    def __init__(self,
+                 server_url: str,
+                 username: str,
+                 password: str,
+                 headless: bool = False,
+                 size: int = DRIVER_POOL_SIZE,
+                 max_uses: int = DRIVER_MAX_USES,
+                 broker=None,
+                 limiters: HostLimiters = None,
+                 profile: ChromeProfile = None):
+        self.server_url = server_url
+        self.username = username
+        self.password = password
+        self.headless = headless
+        self.size = size
+        self.max_uses = max_uses
+        self.broker = broker
+        self.limiter = limiters.get(server_url) if limiters is not None else None
+        self.profile = profile
+        self.created = 0
+        self.peak_rss = None
+        self.recycled = 0
+        self._condition = threading.Condition()
+        self._idle = []
+        self._uses = {}
+        self._starting = 0
+        self._closed = False
+
+    def prestart(self) -> None:
+        """Creates and logs in one more driver, unless the pool is already full.
+
+        Raises what creating or logging in the driver raised, for the caller
+        to report. The pool itself is left as if the driver was never started.
+
+        """
+        with self._condition:
+            if self._closed or self._is_full():
+                return
+            self._starting += 1
+
+        driver = None
+        try:
+            driver = self._create()
+        finally:
+            with self._condition:
+                self._starting -= 1
+                closed = self._closed
+                if driver is not None and not closed:
+                    self._uses[driver] = 0
+                    self._idle.append(driver)
+                self._condition.notify()
+            if driver is not None and closed:
+                driver.quit()
+
+    def acquire(self):
+        """Returns a healthy, logged in driver, waiting for one if all are in use.
+
+        """
+        while True:
+            with self._condition:
+                while not self._closed and not self._idle and self._is_full():
+                    self._condition.wait()
+                if self._closed:
+                    raise Exception("The driver pool is closed")
+                if self._idle:
+                    driver = self._idle.pop()
+                else:
+                    self._starting += 1
+                    driver = None
+
+            if driver is None:
+                try:
+                    driver = self._create()
+                finally:
+                    with self._condition:
+                        self._starting -= 1
+                        if driver is not None:
+                            self._uses[driver] = 0
+                        self._condition.notify()
+                return driver
+
+            if self._is_healthy(driver):
+                return driver
+            print(f"Chrome driver failed its health check, starting a new one")
+            self._discard(driver)
+
+    def release(self, driver, failed: bool = False) -> None:
+        """Returns a driver to the pool, or quits it if it failed or is used up.
+
+        """
+        rss = _browser_rss(driver)
+        with self._condition:
+            if rss is not None:
+                self.peak_rss = max(self.peak_rss or 0, rss)
+            self._uses[driver] += 1
+            recycle = failed or self._closed or self._uses[driver] >= self.max_uses
+            if not recycle:
+                self._idle.append(driver)
+                self._condition.notify()
+        if recycle:
+            self._discard(driver)
+
+    @contextmanager
+    def driver(self):
+        """Yields a driver from the pool and gives it back when the block exits.
+
+        """
+        driver = self.acquire()
+        try:
+            yield driver
+        except Exception:
+            self.release(driver, failed=True)
+            raise
+        else:
+            self.release(driver)
+
+    def open_my_cnx(self, driver):
+        """Opens MyCnx with a pooled driver, logging in again if the session expired.
+
+        """
+        from src.pages.login_form import LoginForm
+        from src.pages.my_cnx import MyCnx
+
+        with self.throttle():
+            my_cnx = MyCnx(driver, self.server_url).open()
+        login_form = LoginForm(driver, self.server_url)
+        if login_form.can_login:
+            print(f"session expired, logging into the legacy server {self.server_url} as {self.username} again")
+            my_cnx = self._login(driver)
+        return my_cnx
+
+    def throttle(self):
+        """Holds a slot of the server's adaptive limiter around a browser action, if there is one.
+
+        """
+        return self.limiter.hold() if self.limiter is not None else nullcontext()
+
+    def close(self) -> None:
+        """Quits every driver in the pool. Drivers in use are quit when released.
+
+        """
+        with self._condition:
+            self._closed = True
+            idle, self._idle = self._idle, []
+            self._condition.notify_all()
+        for driver in idle:
+            self._discard(driver)
+
+    def _create(self):
+        driver = create_chrome_driver(self.headless, self.profile)
+        try:
+            if self.broker is None or not self.broker.add_to_driver(driver, self.server_url):
+                self._login(driver)
+        except Exception:
+            driver.quit()
+            raise
+        with self._condition:
+            self.created += 1
+        return driver
+
+    def _login(self, driver):
+        from src.pages.login_form import LoginForm
+
+        print(f"logging into the legacy server {self.server_url} as {self.username}")
+        with tracing.span("login", server=self.server_url, engine="selenium"), self.throttle():
+            my_cnx = LoginForm(driver, self.server_url).open().login(self.username, self.password)
+        if self.broker is not None:
+            self.broker.update(self.server_url, {cookie["name"]: cookie["value"] for cookie in driver.get_cookies()})
+        return my_cnx
+
+    def _is_full(self) -> bool:
+        # Drivers that are still starting count against the size too
+        return len(self._uses) + self._starting >= self.size
+
+    def _discard(self, driver) -> None:
+        with self._condition:
+            self._uses.pop(driver, None)
+            if not self._closed:
+                self.recycled += 1
+            self._condition.notify()
+        try:
+            driver.quit()
+        except WebDriverException:
+            pass
+
+    @staticmethod
+    def _is_healthy(driver) -> bool:
+        try:
+            driver.current_url
+            return bool(driver.window_handles)
+        except WebDriverException:
+            return False
+
+    def __str__(self):
+        peak_rss = f", peak browser RSS {self.peak_rss / 2 ** 20:.0f} MB" if self.peak_rss is not None else ""
+        return f"{self.created} Chrome drivers started, {self.recycled} recycled{peak_rss}"
 
-    return driver
 
+def _browser_rss(driver) -> Optional[int]:
+    # Drivers that weren't started by us, e.g. remote ones, have no pids and aren't measured
+    pids = getattr(driver, "browser_pids", None)
+    if not pids:
+        return None
+    # Renderers come and go with the pages, so the tree is followed again from the processes found before
+    driver.browser_pids = process_tree_pids(pids)
+    return processes_rss(driver.browser_pids)
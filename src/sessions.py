@@ -0,0 +1,115 @@
+import asyncio
+import threading
+from typing import Dict
+
+from aiohttp import ClientSession, CookieJar
+from yarl import URL
+
+from src import tracing
+from src.legacy_http import LegacyHttpClient, LegacyPage
+
+
+class SessionBroker:
+    """Logs into each legacy server once per run and shares the auth cookies.
+
+    The broker owns the cookie jar of the run's HTTP session (see
+    `http_session(cookie_jar=broker.cookie_jar)`), so once it has logged into a
+    server every request to that server, `aiohttp_get` and `download_file`
+    included, is signed in. The same cookies are injected into new Chrome
+    drivers with `add_to_driver`, so they don't go through the login form.
+
+    A server is only logged into again with `relogin`, when a page shows the
+    login form because the session expired.
+
+    """
+    def __init__(self, username: str, password: str):
+        self.username = username
+        self.password = password
+        # The legacy servers set their auth cookie for whatever host they are on, IP addresses included
+        self.cookie_jar = CookieJar(unsafe=True)
+        self.logins = 0
+        self._cookies = {}
+        self._locks = {}
+        self._cookies_lock = threading.Lock()
+
+    async def login(self, session: ClientSession, server_url: str) -> Dict[str, str]:
+        """Logs into a server unless that was already done, and returns its cookies.
+
+        """
+        async with self._lock(server_url):
+            if self.cookies(server_url) is None:
+                await self._login(session, server_url)
+        return self.cookies(server_url)
+
+    async def relogin(self, session: ClientSession, server_url: str, stale: Dict[str, str]) -> Dict[str, str]:
+        """Logs into a server again after its `stale` cookies stopped working.
+
+        When several tasks find the session expired at once only the first logs
+        in again and the others get its new cookies.
+
+        """
+        async with self._lock(server_url):
+            if self.cookies(server_url) in (None, stale):
+                print(f"session expired for {server_url}, logging in again")
+                await self._login(session, server_url)
+        return self.cookies(server_url)
+
+    async def my_cnx(self, session: ClientSession, server_url: str) -> LegacyPage:
+        """Returns the MyCnx page of a server, logging in first or again as needed.
+
+        """
+        client = LegacyHttpClient(session, server_url)
+        cookies = await self.login(session, server_url)
+        page = await client.get("mycnx")
+        if page.has_login_form:
+            await self.relogin(session, server_url, cookies)
+            page = await client.get("mycnx")
+        return page
+
+    def cookies(self, server_url: str) -> Dict[str, str]:
+        """Returns the cookies of a server that was logged into, or None.
+
+        """
+        with self._cookies_lock:
+            return self._cookies.get(self._key(server_url))
+
+    def update(self, server_url: str, cookies: Dict[str, str]) -> None:
+        """Records cookies a browser got by logging in through the login form itself.
+
+        """
+        with self._cookies_lock:
+            self._cookies[self._key(server_url)] = dict(cookies)
+
+    def add_to_driver(self, driver, server_url: str) -> bool:
+        """Adds a server's cookies to a Chrome driver. Returns False if there are none.
+
+        """
+        cookies = self.cookies(server_url)
+        if not cookies:
+            return False
+
+        # Cookies can only be added for the domain the browser is on
+        driver.get(f"{server_url.rstrip('/')}/login_form")
+        for name, value in cookies.items():
+            driver.add_cookie({"name": name, "value": value, "path": "/"})
+        return True
+
+    async def _login(self, session: ClientSession, server_url: str) -> None:
+        if session.cookie_jar is not self.cookie_jar:
+            raise Exception("The session has to be opened with the broker's cookie jar")
+
+        with tracing.span("login", server=server_url, engine="http"):
+            await LegacyHttpClient(session, server_url).login(self.username, self.password)
+        self.logins += 1
+        cookies = self.cookie_jar.filter_cookies(URL(server_url))
+        self.update(server_url, {name: morsel.value for name, morsel in cookies.items()})
+
+    def _lock(self, server_url: str) -> asyncio.Lock:
+        return self._locks.setdefault(self._key(server_url), asyncio.Lock())
+
+    @staticmethod
+    def _key(server_url: str) -> str:
+        return server_url.rstrip("/")
+
+    def __str__(self):
+        return f"{self.logins} logins for {len(self._cookies)} servers"
@@ -0,0 +1,180 @@
+import hashlib
+import os
+import shutil
+import sqlite3
+from contextlib import contextmanager
+from datetime import datetime
+from typing import Dict, Optional
+
+from src.constants import (ARTIFACT_KEEP_VERSIONS,
+                           ARTIFACT_STORE_MAX_SIZE,
+                           ARTIFACT_STORE_PATH)
+
+
+class ArtifactStore:
+    """A local, version-aware store of downloaded PDFs and module zips.
+
+    A SQLite manifest maps a server, item id, kind ("pdf" or "module") and
+    version (the PDF generation time or the module version) to the sha256 of
+    the downloaded file. The files themselves are kept once per hash under
+    `blobs/` and hard-linked to the path they were downloaded to, so an
+    unchanged artifact is never transferred again and duplicate content takes
+    up no extra space.
+
+    Only the newest `keep_versions` versions of each item are kept, and the
+    oldest versions overall are evicted once the store grows past `max_size`
+    bytes, counting every blob once however many versions share it. Evicting
+    a version only removes its blob from the store. The file at its download
+    path was handed to the user and is left alone, even when it is a link to
+    the blob.
+
+    """
+    def __init__(self,
+                 path: str = ARTIFACT_STORE_PATH,
+                 keep_versions: int = ARTIFACT_KEEP_VERSIONS,
+                 max_size: int = ARTIFACT_STORE_MAX_SIZE):
+        self.path = path
+        self.blobs_path = os.path.join(path, "blobs")
+        self.db_path = os.path.join(path, "manifest.sqlite")
+        self.keep_versions = keep_versions
+        self.max_size = max_size
+        os.makedirs(self.blobs_path, exist_ok=True)
+
+        with self._connect() as db:
+            db.execute("""
+                CREATE TABLE IF NOT EXISTS artifacts (
+                    server TEXT NOT NULL,
+                    item_id TEXT NOT NULL,
+                    kind TEXT NOT NULL,
+                    version TEXT NOT NULL,
+                    sha256 TEXT NOT NULL,
+                    size INTEGER NOT NULL,
+                    path TEXT NOT NULL,
+                    created_at TEXT NOT NULL,
+                    PRIMARY KEY (server, item_id, kind, version)
+                )
+            """)
+
+    def lookup(self, server: str, item_id: str, kind: str, version: str) -> Optional[Dict]:
+        """Returns the manifest entry for a version, if its blob is still stored.
+
+        """
+        with self._connect() as db:
+            row = db.execute(
+                "SELECT * FROM artifacts WHERE server = ? AND item_id = ? AND kind = ? AND version = ?",
+                (server, item_id, kind, version)).fetchone()
+
+        if row is None or not os.path.exists(self._blob_path(row["sha256"])):
+            return None
+        return dict(row)
+
+    def checkout(self, entry: Dict, path: str = None) -> str:
+        """Makes a stored artifact available at `path` (default: where it was downloaded).
+
+        If the download path still holds the artifact nothing is written.
+
+        """
+        path = path or entry["path"]
+        blob_path = self._blob_path(entry["sha256"])
+        if os.path.exists(path) and os.path.samefile(path, blob_path):
+            return path
+
+        self._link(blob_path, path)
+        if path != entry["path"]:
+            with self._connect() as db:
+                db.execute(
+                    "UPDATE artifacts SET path = ? WHERE server = ? AND item_id = ? AND kind = ? AND version = ?",
+                    (path, entry["server"], entry["item_id"], entry["kind"], entry["version"]))
+        return path
+
+    def add(self, server: str, item_id: str, kind: str, version: str, path: str) -> Dict:
+        """Records a freshly downloaded file and moves its content into the store.
+
+        When a blob with the same hash already exists the new copy is replaced
+        with a link to it. This hashes the whole file, so call it from a worker
+        thread for large artifacts.
+
+        """
+        sha256 = self._hash(path)
+        blob_path = self._blob_path(sha256)
+        os.makedirs(os.path.dirname(blob_path), exist_ok=True)
+        if os.path.exists(blob_path):
+            os.remove(path)
+            self._link(blob_path, path)
+        else:
+            self._link(path, blob_path)
+
+        entry = dict(server=server, item_id=item_id, kind=kind, version=version, sha256=sha256,
+                     size=os.path.getsize(blob_path), path=path, created_at=datetime.utcnow().isoformat())
+        with self._connect() as db:
+            db.execute(
+                "INSERT OR REPLACE INTO artifacts VALUES "
+                "(:server, :item_id, :kind, :version, :sha256, :size, :path, :created_at)", entry)
+
+        self.evict()
+        return entry
+
+    def evict(self) -> None:
+        """Applies the retention policy to the manifest and removes unused blobs.
+
+        """
+        with self._connect() as db:
+            rows = db.execute("SELECT * FROM artifacts ORDER BY created_at DESC").fetchall()
+
+            expired, versions, kept, total = [], {}, set(), 0
+            for row in rows:
+                key = (row["server"], row["item_id"], row["kind"])
+                versions[key] = versions.get(key, 0) + 1
+                # A blob shared with a version that is kept takes up no more space
+                size = 0 if row["sha256"] in kept else row["size"]
+                if versions[key] > self.keep_versions or total + size > self.max_size:
+                    expired.append(row)
+                else:
+                    kept.add(row["sha256"])
+                    total += size
+
+            for row in expired:
+                db.execute(
+                    "DELETE FROM artifacts WHERE server = ? AND item_id = ? AND kind = ? AND version = ?",
+                    (row["server"], row["item_id"], row["kind"], row["version"]))
+
+            in_use = {row["sha256"] for row in db.execute("SELECT sha256 FROM artifacts")}
+
+        for row in expired:
+            blob_path = self._blob_path(row["sha256"])
+            if row["sha256"] in in_use or not os.path.exists(blob_path):
+                continue
+            os.remove(blob_path)
+
+    @contextmanager
+    def _connect(self):
+        db = sqlite3.connect(self.db_path, timeout=30)
+        db.row_factory = sqlite3.Row
+        try:
+            with db:
+                yield db
+        finally:
+            db.close()
+
+    def _blob_path(self, sha256: str) -> str:
+        return os.path.join(self.blobs_path, sha256[:2], sha256)
+
+    @staticmethod
+    def _hash(path: str) -> str:
+        sha256 = hashlib.sha256()
+        with open(path, "rb") as f_handle:
+            for chunk in iter(lambda: f_handle.read(1024 * 1024), b""):
+                sha256.update(chunk)
+        return sha256.hexdigest()
+
+    @staticmethod
+    def _link(source: str, destination: str) -> None:
+        """Hard links `source` to `destination`, copying across file systems.
+
+        """
+        if os.path.exists(destination):
+            os.remove(destination)
+        try:
+            os.link(source, destination)
+        except OSError:
+            shutil.copy2(source, destination)
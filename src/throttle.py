@@ -0,0 +1,259 @@
+import asyncio
+import threading
+import time
+from collections import deque
+from contextlib import asynccontextmanager, contextmanager
+from typing import Dict
+
+from aiohttp import ClientConnectionError, TraceConfig
+from yarl import URL
+
+from src.constants import (ADAPTIVE_DECREASE_FACTOR,
+                           ADAPTIVE_DECREASE_INTERVAL,
+                           ADAPTIVE_INITIAL_LIMIT,
+                           ADAPTIVE_MAX_LIMIT,
+                           ADAPTIVE_SLOW_RESPONSE)
+
+# Errors that mean the server is struggling, as opposed to e.g. a missing page
+OVERLOAD_ERRORS = (asyncio.TimeoutError, ClientConnectionError)
+
+
+class Slot:
+    """A request or browser action holding one unit of an AdaptiveLimiter.
+
+    Call `overloaded()` when the response shows the server is struggling,
+    e.g. a Site Error page that came with a 200 status.
+
+    """
+    def __init__(self):
+        self.is_overloaded = False
+        self.started_at = time.monotonic()
+
+    def overloaded(self) -> None:
+        self.is_overloaded = True
+
+
+class AdaptiveLimiter:
+    """An AIMD limit on the concurrent requests and browser actions for one host.
+
+    Every healthy response below `slow` seconds raises the limit additively,
+    by about one per round of `limit` responses, up to `max_limit`. A 5xx
+    response, Site Error page, timeout or dropped connection multiplies the
+    limit by `decrease`, at most once per `decrease_interval` so a burst of
+    failures from the same moment of overload only counts once. Slow
+    responses hold the limit where it is.
+
+    The limiter is shared between the event loop (`slot`, `acquire`) and the
+    threads the browsers run in (`hold`, `acquire_blocking`).
+
+    """
+    OK = "ok"
+    OVERLOADED = "overloaded"
+    NEUTRAL = "neutral"
+
+    def __init__(self,
+                 host: str,
+                 initial: float = ADAPTIVE_INITIAL_LIMIT,
+                 min_limit: int = 1,
+                 max_limit: int = ADAPTIVE_MAX_LIMIT,
+                 decrease: float = ADAPTIVE_DECREASE_FACTOR,
+                 decrease_interval: float = ADAPTIVE_DECREASE_INTERVAL,
+                 slow: float = ADAPTIVE_SLOW_RESPONSE):
+        self.host = host
+        self.min_limit = min_limit
+        self.max_limit = max_limit
+        self.decrease = decrease
+        self.decrease_interval = decrease_interval
+        self.slow = slow
+        self.in_flight = 0
+        self.decreases = 0
+        self.lowest = self.highest = None
+        self._limit = float(min(max(initial, min_limit), max_limit))
+        self._last_decrease = None
+        self._condition = threading.Condition()
+        self._waiters = deque()
+        self._record()
+
+    @property
+    def limit(self) -> int:
+        return int(self._limit)
+
+    async def acquire(self) -> None:
+        loop = asyncio.get_event_loop()
+        while True:
+            with self._condition:
+                if self.in_flight < self.limit:
+                    self.in_flight += 1
+                    return
+                waiter = loop.create_future()
+                self._waiters.append((loop, waiter))
+            try:
+                await waiter
+            except asyncio.CancelledError:
+                with self._condition:
+                    if (loop, waiter) in self._waiters:
+                        self._waiters.remove((loop, waiter))
+                    else:
+                        # We were woken for a free slot, so pass it on
+                        self._wake()
+                raise
+
+    def acquire_blocking(self) -> None:
+        with self._condition:
+            while self.in_flight >= self.limit:
+                self._condition.wait()
+            self.in_flight += 1
+
+    def release(self, outcome: str = OK, latency: float = None) -> None:
+        with self._condition:
+            self.in_flight -= 1
+            if outcome == self.OVERLOADED:
+                self._decrease()
+            elif outcome == self.OK and (latency is None or latency <= self.slow):
+                self._limit = min(self.max_limit, self._limit + 1 / self._limit)
+                self._record()
+            self._wake()
+
+    def penalize(self) -> None:
+        """Cuts the limit for a sign of overload that came outside of a slot.
+
+        """
+        with self._condition:
+            self._decrease()
+
+    @asynccontextmanager
+    async def slot(self):
+        await self.acquire()
+        slot = Slot()
+        try:
+            yield slot
+        except OVERLOAD_ERRORS:
+            self.release(self.OVERLOADED)
+            raise
+        except BaseException:
+            self.release(self.NEUTRAL)
+            raise
+        else:
+            self._release_slot(slot)
+
+    @contextmanager
+    def hold(self):
+        """Holds a slot around a blocking browser action.
+
+        """
+        self.acquire_blocking()
+        slot = Slot()
+        try:
+            yield slot
+        except BaseException as e:
+            self.release(self.OVERLOADED if _is_browser_timeout(e) else self.NEUTRAL)
+            raise
+        else:
+            self._release_slot(slot)
+
+    def _release_slot(self, slot: Slot) -> None:
+        if slot.is_overloaded:
+            self.release(self.OVERLOADED)
+        else:
+            self.release(self.OK, time.monotonic() - slot.started_at)
+
+    def _decrease(self) -> None:
+        now = time.monotonic()
+        if self._last_decrease is not None and now - self._last_decrease < self.decrease_interval:
+            return
+        self._last_decrease = now
+        previous = self.limit
+        self._limit = max(self.min_limit, self._limit * self.decrease)
+        self.decreases += 1
+        self._record()
+        if self.limit != previous:
+            print(f"{self.host} is under stress, lowering its concurrency limit to {self.limit}")
+
+    def _wake(self) -> None:
+        self._condition.notify_all()
+        free = self.limit - self.in_flight
+        while free > 0 and self._waiters:
+            loop, waiter = self._waiters.popleft()
+            loop.call_soon_threadsafe(_set_waiter, waiter)
+            free -= 1
+
+    def _record(self) -> None:
+        self.lowest = min(self.lowest or self.limit, self.limit)
+        self.highest = max(self.highest or self.limit, self.limit)
+
+    def __str__(self):
+        return (f"{self.host}: limit {self.limit} (lowest {self.lowest}, highest {self.highest}), "
+                f"{self.in_flight} in flight, {self.decreases} cuts")
+
+
+def _set_waiter(waiter: asyncio.Future) -> None:
+    if not waiter.done():
+        waiter.set_result(None)
+
+
+def _is_browser_timeout(error: BaseException) -> bool:
+    from selenium.common.exceptions import TimeoutException
+
+    return isinstance(error, TimeoutException)
+
+
+class HostLimiters:
+    """The AdaptiveLimiter of every host, created the first time a host is used.
+
+    Attach it to an HTTP session with `http_session(limiters=...)` to put every
+    request through the limiter of its host, and give it to the DriverPool
+    for the browser actions. `limits` is the current limit of every host.
+
+    """
+    def __init__(self, **limiter_options):
+        self.limiter_options = limiter_options
+        self._limiters = {}
+        self._lock = threading.Lock()
+
+    def get(self, url: str) -> AdaptiveLimiter:
+        host = URL(url).host
+        with self._lock:
+            if host not in self._limiters:
+                self._limiters[host] = AdaptiveLimiter(host, **self.limiter_options)
+            return self._limiters[host]
+
+    @property
+    def limits(self) -> Dict[str, int]:
+        with self._lock:
+            return {host: limiter.limit for host, limiter in self._limiters.items()}
+
+    def trace_config(self) -> TraceConfig:
+        """Holds a slot of the host's limiter from the start of a request until its response arrives.
+
+        The slot is given back once the status and headers are in, so a long
+        download doesn't keep other requests waiting, and responses with a
+        5xx status count as overload.
+
+        """
+        trace_config = TraceConfig()
+        trace_config.on_request_start.append(self._on_request_start)
+        trace_config.on_request_end.append(self._on_request_end)
+        trace_config.on_request_exception.append(self._on_request_exception)
+        return trace_config
+
+    async def _on_request_start(self, session, context, params):
+        context.limiter = self.get(str(params.url))
+        await context.limiter.acquire()
+        context.started_at = time.monotonic()
+
+    async def _on_request_end(self, session, context, params):
+        if params.response.status >= 500:
+            context.limiter.release(AdaptiveLimiter.OVERLOADED)
+        else:
+            context.limiter.release(AdaptiveLimiter.OK, time.monotonic() - context.started_at)
+
+    async def _on_request_exception(self, session, context, params):
+        if not hasattr(context, "started_at"):
+            # The request failed while it was still waiting for a slot
+            return
+        overloaded = isinstance(params.exception, OVERLOAD_ERRORS)
+        context.limiter.release(AdaptiveLimiter.OVERLOADED if overloaded else AdaptiveLimiter.NEUTRAL)
+
+    def __str__(self):
+        with self._lock:
+            return "; ".join(str(limiter) for limiter in self._limiters.values()) or "no hosts"
@@ -0,0 +1,225 @@
+import asyncio
+import json
+import math
+import os
+import threading
+import time
+from contextlib import contextmanager
+from contextvars import ContextVar
+from datetime import datetime, timezone
+from typing import Dict, List
+
+_current_span = ContextVar("current_span", default=None)
+_tracer = None
+
+
+class Span:
+    """One timed run of a stage, e.g. downloading a module or loading a page.
+
+    Besides the duration a span counts the bytes it transferred and the times
+    it retried a request or form, and ends with an outcome: ok, error or
+    cancelled.
+
+    """
+    OK = "ok"
+    ERROR = "error"
+    CANCELLED = "cancelled"
+
+    def __init__(self, stage: str, attributes: Dict, parent: "Span" = None):
+        self.stage = stage
+        self.attributes = attributes
+        self.parent = parent
+        self.started_at = datetime.now(timezone.utc)
+        self.bytes = 0
+        self.retries = 0
+        self.duration = None
+        self.outcome = None
+        self.error = None
+        self._started = time.monotonic()
+
+    def add_bytes(self, count: int) -> None:
+        self.bytes += count
+
+    def retried(self) -> None:
+        self.retries += 1
+
+    def set(self, **attributes) -> None:
+        self.attributes.update(attributes)
+
+    def finish(self, outcome: str, error: BaseException = None) -> None:
+        self.duration = time.monotonic() - self._started
+        self.outcome = outcome
+        self.error = str(error) if error is not None else None
+
+    def to_dict(self) -> Dict:
+        return dict(stage=self.stage, started_at=self.started_at.isoformat(), duration=self.duration,
+                    bytes=self.bytes, retries=self.retries, outcome=self.outcome, error=self.error,
+                    parent=self.parent.stage if self.parent is not None else None,
+                    attributes=self.attributes)
+
+
+class StageMetrics:
+    """The finished spans of one stage, summed up.
+
+    """
+    def __init__(self):
+        self.durations = []
+        self.bytes = 0
+        self.retries = 0
+        self.outcomes = {}
+
+    def add(self, span: Span) -> None:
+        self.durations.append(span.duration)
+        self.bytes += span.bytes
+        self.retries += span.retries
+        self.outcomes[span.outcome] = self.outcomes.get(span.outcome, 0) + 1
+
+    def percentile(self, fraction: float) -> float:
+        """Returns the nearest-rank percentile of the durations.
+
+        """
+        durations = sorted(self.durations)
+        return durations[max(0, math.ceil(fraction * len(durations)) - 1)] if durations else 0.0
+
+    @property
+    def max(self) -> float:
+        return max(self.durations, default=0.0)
+
+
+class Tracer:
+    """Collects the spans of a run and exports them.
+
+    While a tracer is started, `span()` anywhere in the process records to it,
+    the threads the Chrome drivers run in included. Every finished span is
+    appended to `trace_path` as a JSON line, if given, and `finish()` writes
+    the per-stage metrics to `metrics_path` in the Prometheus textfile format
+    and prints the p50, p95 and max duration of every stage.
+
+    """
+    def __init__(self, trace_path: str = None, metrics_path: str = None):
+        self.trace_path = trace_path
+        self.metrics_path = metrics_path
+        self.stages = {}
+        self._lock = threading.Lock()
+        self._trace_file = None
+
+    def start(self) -> "Tracer":
+        global _tracer
+        if self.trace_path is not None:
+            self._trace_file = open(self.trace_path, "a", buffering=1)
+        _tracer = self
+        return self
+
+    def finish(self) -> None:
+        global _tracer
+        if _tracer is self:
+            _tracer = None
+        with self._lock:
+            if self._trace_file is not None:
+                self._trace_file.close()
+                self._trace_file = None
+        if self.metrics_path is not None:
+            self.write_metrics(self.metrics_path)
+        print(self.summary())
+
+    def record(self, span: Span) -> None:
+        with self._lock:
+            self.stages.setdefault(span.stage, StageMetrics()).add(span)
+            if self._trace_file is not None:
+                self._trace_file.write(json.dumps(span.to_dict()) + "\n")
+
+    def summary(self) -> str:
+        with self._lock:
+            lines = ["Stage timings (p50 / p95 / max):"]
+            for stage, metrics in sorted(self.stages.items()):
+                errors = sum(count for outcome, count in metrics.outcomes.items() if outcome != Span.OK)
+                lines.append(f"  {stage}: {len(metrics.durations)} spans, "
+                             f"{metrics.percentile(0.5):.2f}s / {metrics.percentile(0.95):.2f}s / "
+                             f"{metrics.max:.2f}s, {metrics.bytes} bytes, {metrics.retries} retries, "
+                             f"{errors} failed")
+        if len(lines) == 1:
+            lines.append("  no spans recorded")
+        return "\n".join(lines)
+
+    def write_metrics(self, path: str) -> None:
+        """Writes the metrics of every stage in the Prometheus text format.
+
+        The file is written next to `path` and renamed into place, so the
+        node_exporter textfile collector never reads half of it.
+
+        """
+        with self._lock:
+            lines = _metrics_lines(self.stages)
+        with open(path + ".part", "w") as f_handle:
+            f_handle.write("\n".join(lines) + "\n")
+        os.replace(path + ".part", path)
+
+
+def _metrics_lines(stages: Dict[str, StageMetrics]) -> List[str]:
+    lines = ["# HELP kcopy_stage_duration_seconds How long the spans of a stage took",
+             "# TYPE kcopy_stage_duration_seconds summary"]
+    for stage, metrics in sorted(stages.items()):
+        label = f'stage="{_escape(stage)}"'
+        for quantile in (0.5, 0.95):
+            lines.append(f'kcopy_stage_duration_seconds{{{label},quantile="{quantile}"}} '
+                         f'{metrics.percentile(quantile):.6f}')
+        lines.append(f"kcopy_stage_duration_seconds_sum{{{label}}} {sum(metrics.durations):.6f}")
+        lines.append(f"kcopy_stage_duration_seconds_count{{{label}}} {len(metrics.durations)}")
+
+    for name, kind, help_text, value in (
+            ("kcopy_stage_duration_max_seconds", "gauge", "The longest span of a stage", lambda m: f"{m.max:.6f}"),
+            ("kcopy_stage_bytes_total", "counter", "Bytes transferred by the spans of a stage", lambda m: m.bytes),
+            ("kcopy_stage_retries_total", "counter", "Requests and forms retried by a stage", lambda m: m.retries)):
+        lines += [f"# HELP {name} {help_text}", f"# TYPE {name} {kind}"]
+        for stage, metrics in sorted(stages.items()):
+            lines.append(f'{name}{{stage="{_escape(stage)}"}} {value(metrics)}')
+
+    lines += ["# HELP kcopy_stage_spans_total Finished spans of a stage by outcome",
+              "# TYPE kcopy_stage_spans_total counter"]
+    for stage, metrics in sorted(stages.items()):
+        for outcome, count in sorted(metrics.outcomes.items()):
+            lines.append(f'kcopy_stage_spans_total{{stage="{_escape(stage)}",outcome="{outcome}"}} {count}')
+    return lines
+
+
+def _escape(value: str) -> str:
+    return value.replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+
+@contextmanager
+def span(stage: str, **attributes):
+    """Times the code in the block as a span of `stage` and records it with the started Tracer.
+
+    The span is the current one until the block ends, so `add_bytes` and
+    `retried` count towards it. Without a started tracer nothing is recorded.
+
+    """
+    current = Span(stage, attributes, _current_span.get())
+    token = _current_span.set(current)
+    try:
+        yield current
+    except BaseException as e:
+        current.finish(Span.CANCELLED if isinstance(e, asyncio.CancelledError) else Span.ERROR, e)
+        raise
+    else:
+        current.finish(Span.OK)
+    finally:
+        _current_span.reset(token)
+        if _tracer is not None:
+            _tracer.record(current)
+
+
+def add_bytes(count: int) -> None:
+    """Counts bytes towards the current span, if any.
+
+    """
+    if _current_span.get() is not None:
+        _current_span.get().add_bytes(count)
+
+
+def retried() -> None:
+    """Counts a retry towards the current span, if any.
+
+    """
+    if _current_span.get() is not None:
+        _current_span.get().retried()
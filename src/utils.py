@@ -1,14 +1,108 @@
+import asyncio
 import os
-import re
 import zipfile
+from contextlib import asynccontextmanager
 from datetime import datetime
-from tempfile import TemporaryDirectory
-from typing import Dict
+from typing import Callable, Dict, List
 
 import dateutil.parser
-from aiohttp import ClientSession
+from aiohttp import ClientError, ClientSession, ClientTimeout, TCPConnector, TraceConfig
+from aiohttp.abc import AbstractCookieJar
 
-from src.constants import DOWNLOAD_PATH
+from src import tracing
+from src.cache import HttpCache
+from src.throttle import HostLimiters
+from src.constants import (DOWNLOAD_CHUNK_SIZE,
+                           DOWNLOAD_CONNECT_TIMEOUT,
+                           DOWNLOAD_MAX_ATTEMPTS,
+                           DOWNLOAD_PATH,
+                           DOWNLOAD_READ_TIMEOUT,
+                           DOWNLOAD_SEGMENT_MIN_SIZE,
+                           HTTP_CONNECTION_LIMIT,
+                           HTTP_CONNECTION_LIMIT_PER_HOST,
+                           HTTP_DNS_CACHE_TTL,
+                           HTTP_KEEPALIVE_TIMEOUT,
+                           HTTP_MAX_ATTEMPTS,
+                           PDF_TRAILER_SEARCH_SIZE,
+                           SITE_ERROR_RETRY_DELAY)
+from src.zips import UnsupportedZip, ZipStreamFilter, filter_zip
+
+
+class ConnectionStats:
+    """Counts requests and new vs. reused connections for a ClientSession.
+
+    Attach it to a session with `http_session(stats)` and print it at the end
+    of a run to see how well keep-alive connections are being reused.
+
+    """
+    def __init__(self):
+        self.requests = 0
+        self.created = 0
+        self.reused = 0
+
+    @property
+    def reuse_ratio(self) -> float:
+        total = self.created + self.reused
+        return self.reused / total if total else 0.0
+
+    def trace_config(self) -> TraceConfig:
+        trace_config = TraceConfig()
+        trace_config.on_request_start.append(self._on_request_start)
+        trace_config.on_connection_create_end.append(self._on_connection_create_end)
+        trace_config.on_connection_reuseconn.append(self._on_connection_reuseconn)
+        return trace_config
+
+    async def _on_request_start(self, session, context, params):
+        self.requests += 1
+
+    async def _on_connection_create_end(self, session, context, params):
+        self.created += 1
+
+    async def _on_connection_reuseconn(self, session, context, params):
+        self.reused += 1
+
+    def __str__(self):
+        return (f"{self.requests} requests, {self.created} new connections, "
+                f"{self.reused} reused ({self.reuse_ratio:.0%})")
+
+
+@asynccontextmanager
+async def http_session(stats: ConnectionStats = None,
+                       limit: int = HTTP_CONNECTION_LIMIT,
+                       limit_per_host: int = HTTP_CONNECTION_LIMIT_PER_HOST,
+                       cookie_jar: AbstractCookieJar = None,
+                       limiters: HostLimiters = None):
+    """Opens the long-lived ClientSession shared by every request in a run.
+
+    The connector keeps connections alive between requests, caps the number of
+    connections per host and caches DNS lookups, so polling hundreds of
+    collections does not pay for a new handshake on every request. Pass a
+    `cookie_jar` to keep a logged in session's cookies, and `limiters` to put
+    every request through the adaptive limiter of its host.
+
+    """
+    connector = TCPConnector(limit=limit,
+                             limit_per_host=limit_per_host,
+                             ttl_dns_cache=HTTP_DNS_CACHE_TTL,
+                             keepalive_timeout=HTTP_KEEPALIVE_TIMEOUT)
+    trace_configs = [stats.trace_config()] if stats is not None else []
+    if limiters is not None:
+        trace_configs.append(limiters.trace_config())
+
+    async with ClientSession(connector=connector, trace_configs=trace_configs, cookie_jar=cookie_jar) as session:
+        yield session
+
+
+@asynccontextmanager
+async def reuse_or_create_session(session: ClientSession = None):
+    """Yields the given session, or a throwaway one when none was passed in.
+
+    """
+    if session is not None:
+        yield session
+    else:
+        async with ClientSession() as new_session:
+            yield new_session
 
 
 async def make_time_obj(t: str) -> datetime.date:
@@ -17,27 +111,400 @@ async def make_time_obj(t: str) -> datetime.date:
     return dateutil.parser.parse(t)
 
 
-async def aiohttp_get(url: str) -> Dict:
-    async with ClientSession() as session:
-        async with session.get(url) as response:
-            if response.status == 200:
+class ServerError(Exception):
+    """Raised for a 5xx response, which is how a legacy server under stress answers.
+
+    Unlike a 4xx response it is worth retrying after a delay.
+
+    """
+    def __init__(self, url: str, status: int):
+        super().__init__(f"There was a problem retrieving the {url}. Status Code: {status}")
+        self.url = url
+        self.status = status
+
+
+def raise_for_status(url: str, status: int) -> None:
+    """Raises ServerError for a 5xx status and a plain Exception for any other.
+
+    """
+    if status >= 500:
+        raise ServerError(url, status)
+    raise Exception(f"There was a problem retrieving the {url}. Status Code: {status}")
+
+
+def server_error_delay(attempt: int) -> float:
+    """Returns how long to wait before retrying after the 5xx response to `attempt`.
+
+    """
+    return SITE_ERROR_RETRY_DELAY * 2 ** (attempt - 1)
+
+
+@asynccontextmanager
+async def get_with_retries(session: ClientSession,
+                           url: str,
+                           headers: Dict = None,
+                           max_attempts: int = HTTP_MAX_ATTEMPTS):
+    """Yields the response to a GET request, retrying 5xx responses first.
+
+    A 5xx response, which is how a legacy server under stress answers, is
+    retried after a delay that doubles with every attempt, and raises
+    ServerError once the attempts run out. Any other response is yielded as
+    is, for the caller to read or stream.
+
+    """
+    for attempt in range(1, max_attempts + 1):
+        async with session.get(url, headers=headers) as response:
+            if response.status < 500:
+                yield response
+                return
+            if attempt == max_attempts:
+                raise_for_status(url, response.status)
+
+        delay = server_error_delay(attempt)
+        print(f"{url} answered with status {response.status}. Retrying in {delay}s, attempt {attempt + 1}")
+        tracing.retried()
+        await asyncio.sleep(delay)
+
+
+async def aiohttp_get(url: str,
+                      session: ClientSession = None,
+                      cache: HttpCache = None,
+                      max_attempts: int = HTTP_MAX_ATTEMPTS) -> Dict:
+    """Gets a page and returns its status, url, url after redirects and decoded text.
+
+    When a `cache` is given the request is conditional, and a 304 Not Modified
+    response is answered with the body stored on disk. 5xx responses are
+    retried by `get_with_retries`.
+
+    """
+    headers = cache.conditional_headers(url) if cache is not None else {}
+
+    async with reuse_or_create_session(session) as session:
+        async with get_with_retries(session, url, headers, max_attempts) as response:
+            if response.status == 304 and cache is not None:
+                text = cache.load(url)
+                if text is not None:
+                    return {"status": 200, "url": url, "final_url": str(response.url),
+                            "text": text.decode('utf-8'), "cached": True}
+            elif response.status == 200:
                 text = await response.read()
-                return {"status": response.status, "url": url, "text": text.decode('utf-8')}
+                tracing.add_bytes(len(text))
+                if cache is not None:
+                    cache.store(url, response.headers, text)
+                return {"status": response.status, "url": url, "final_url": str(response.url),
+                        "text": text.decode('utf-8'), "cached": False}
+            else:
+                raise_for_status(url, response.status)
+
+        # The entry was evicted after we sent its validators. The 304 is released, so ask again without them
+        return await aiohttp_get(url, session, max_attempts=max_attempts)
+
+
+class IncompleteDownload(Exception):
+    """Raised when a transfer ends before the whole file has been received.
+
+    """
+
+
+class RangesIgnored(Exception):
+    """Raised when a server answers a segment's Range request with the whole body.
+
+    """
+
+
+class CorruptDownload(Exception):
+    """Raised when a downloaded file is complete but is not a valid PDF or zip.
+
+    """
+
+
+async def download_file(url: str,
+                        filename: str,
+                        session: ClientSession = None,
+                        max_attempts: int = DOWNLOAD_MAX_ATTEMPTS,
+                        segments: int = 1) -> None:
+    """Downloads a url to `filename` so that a finished file is always complete.
+
+    The body is written to `filename + ".part"` and only renamed into place
+    once the byte count matches the Content-Length and the file passes
+    `verify_download`. When a transfer is interrupted the next attempt resumes
+    from the end of the `.part` file with an HTTP Range request, so a dropped
+    connection doesn't mean downloading the whole file again.
+
+    With `segments` greater than one, large files from servers that support
+    Range requests are fetched as that many byte ranges over concurrent
+    connections (see `_download_segmented`). Otherwise, and when resuming an
+    earlier single stream `.part` file, the body comes down as a single stream.
+
+    """
+    part_path = filename + ".part"
+    timeout = ClientTimeout(sock_connect=DOWNLOAD_CONNECT_TIMEOUT, sock_read=DOWNLOAD_READ_TIMEOUT)
+
+    async with reuse_or_create_session(session) as session:
+        if segments > 1 and not os.path.exists(part_path):
+            try:
+                segmented = await _download_segmented(session, url, part_path, timeout,
+                                                      segments, max_attempts)
+                if segmented:
+                    verify_download(part_path)
+            except RangesIgnored:
+                # The server stopped honoring ranges after the probe, so the file comes down as one stream
+                print(f"{url} ignored a segment's Range request, downloading it as a single stream")
+                os.remove(part_path)
+                segmented = False
+            except Exception:
+                # A preallocated .part file has holes, so it can't be resumed as a single stream
+                if os.path.exists(part_path):
+                    os.remove(part_path)
+                raise
+            if segmented:
+                os.replace(part_path, filename)
+                return
+
+        for attempt in range(1, max_attempts + 1):
+            try:
+                await _download_part(session, url, part_path, timeout)
+                verify_download(part_path)
+            except (ClientError, asyncio.TimeoutError, IncompleteDownload) as e:
+                if attempt == max_attempts:
+                    raise
+                print(f"Download of {url} interrupted ({e!r}). Resuming, attempt {attempt + 1}")
+                tracing.retried()
+            except ServerError as e:
+                if attempt == max_attempts:
+                    raise
+                delay = server_error_delay(attempt)
+                print(f"Download of {url} answered with status {e.status}. Retrying in {delay}s, "
+                      f"attempt {attempt + 1}")
+                tracing.retried()
+                await asyncio.sleep(delay)
+            except CorruptDownload as e:
+                # The data on disk is unusable, so the next attempt starts over
+                os.remove(part_path)
+                if attempt == max_attempts:
+                    raise
+                print(f"Download of {url} is corrupt ({e}). Restarting, attempt {attempt + 1}")
+                tracing.retried()
+            else:
+                os.replace(part_path, filename)
+                return
+
+
+async def download_filtered_zip(url: str,
+                                filename: str,
+                                exclude: Callable[[str], bool],
+                                session: ClientSession = None,
+                                max_attempts: int = DOWNLOAD_MAX_ATTEMPTS) -> List[str]:
+    """Downloads a zip to `filename`, leaving out members while the bytes arrive.
+
+    The body is passed through a ZipStreamFilter on its way to disk, so the
+    archive is read and written only once and no unfiltered copy is kept. The
+    filtered `.part` file can't be resumed with a Range request, because its
+    offsets no longer match the server's, so an interrupted attempt starts
+    over. Raises UnsupportedZip for archives that can't be filtered as a
+    stream. Returns the names of the members that were left out.
+
+    """
+    part_path = filename + ".part"
+    timeout = ClientTimeout(sock_connect=DOWNLOAD_CONNECT_TIMEOUT, sock_read=DOWNLOAD_READ_TIMEOUT)
+
+    async with reuse_or_create_session(session) as session:
+        for attempt in range(1, max_attempts + 1):
+            zip_filter = ZipStreamFilter(exclude)
+            try:
+                async with session.get(url, timeout=timeout) as response:
+                    if response.status != 200:
+                        raise_for_status(url, response.status)
+                    with open(part_path, "wb") as f_handle:
+                        async for chunk in response.content.iter_chunked(DOWNLOAD_CHUNK_SIZE):
+                            f_handle.write(zip_filter.feed(chunk))
+                            tracing.add_bytes(len(chunk))
+                        f_handle.write(zip_filter.close())
+                verify_download(part_path)
+            except (ClientError, asyncio.TimeoutError, zipfile.BadZipFile, CorruptDownload) as e:
+                if os.path.exists(part_path):
+                    os.remove(part_path)
+                if attempt == max_attempts:
+                    raise
+                print(f"Download of {url} failed ({e!r}). Restarting, attempt {attempt + 1}")
+                tracing.retried()
+            except ServerError as e:
+                if attempt == max_attempts:
+                    raise
+                delay = server_error_delay(attempt)
+                print(f"Download of {url} answered with status {e.status}. Retrying in {delay}s, "
+                      f"attempt {attempt + 1}")
+                tracing.retried()
+                await asyncio.sleep(delay)
+            except UnsupportedZip:
+                if os.path.exists(part_path):
+                    os.remove(part_path)
+                raise
             else:
-                raise Exception(f"There was a problem retrieving the {url}. "
-                                f"Status Code: {response.status}")
+                os.replace(part_path, filename)
+                return zip_filter.removed
+
+
+async def _download_part(session: ClientSession, url: str, part_path: str, timeout: ClientTimeout) -> None:
+    """Downloads or resumes `url` into `part_path` and checks its length.
+
+    """
+    offset = os.path.getsize(part_path) if os.path.exists(part_path) else 0
+    headers = {"Range": f"bytes={offset}-"} if offset else {}
+
+    async with session.get(url, headers=headers, timeout=timeout) as response:
+        if response.status == 416 and offset:
+            # The .part file already holds the whole body
+            return
+        elif response.status == 206:
+            mode = "ab"
+            total = _content_range_total(response.headers.get("Content-Range"))
+        elif response.status == 200:
+            # The server ignored the Range header and sent the whole body
+            mode, offset = "wb", 0
+            total = response.content_length
+        else:
+            raise_for_status(url, response.status)
+
+        with open(part_path, mode) as f_handle:
+            async for chunk in response.content.iter_chunked(DOWNLOAD_CHUNK_SIZE):
+                f_handle.write(chunk)
+                tracing.add_bytes(len(chunk))
+
+    size = os.path.getsize(part_path)
+    if total is not None and size != total:
+        raise IncompleteDownload(f"received {size} of {total} bytes")
+
+
+async def _download_segmented(session: ClientSession,
+                              url: str,
+                              part_path: str,
+                              timeout: ClientTimeout,
+                              segments: int,
+                              max_attempts: int) -> bool:
+    """Downloads `url` as concurrent byte ranges into a preallocated `part_path`.
+
+    A one byte Range request probes whether the server supports ranges and
+    tells us the total size. Returns False, without creating `part_path`, when
+    ranges are not supported or the file is too small to be worth splitting.
+    Raises RangesIgnored if a segment is answered with the whole body.
+
+    """
+    async with session.get(url, headers={"Range": "bytes=0-0"}, timeout=timeout) as response:
+        if response.status != 206:
+            # A server that ignores ranges sends the whole file, so drop the connection instead of reading it
+            response.close()
+            return False
+        await response.read()
+        total = _content_range_total(response.headers.get("Content-Range"))
+
+    if total is None or total < DOWNLOAD_SEGMENT_MIN_SIZE * 2:
+        return False
+
+    segments = min(segments, total // DOWNLOAD_SEGMENT_MIN_SIZE)
+    segment_size = -(-total // segments)
+    with open(part_path, "wb") as f_handle:
+        f_handle.truncate(total)
+
+    tasks = [
+        asyncio.ensure_future(_download_segment(session, url, part_path, start,
+                                                min(start + segment_size, total) - 1, timeout, max_attempts))
+        for start in range(0, total, segment_size)
+    ]
+    try:
+        await asyncio.gather(*tasks)
+    except BaseException:
+        # Stop the other segments before the caller removes the .part file they write to
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+        raise
+    return True
+
+
+async def _download_segment(session: ClientSession,
+                            url: str,
+                            part_path: str,
+                            start: int,
+                            end: int,
+                            timeout: ClientTimeout,
+                            max_attempts: int) -> None:
+    """Writes the bytes `start` to `end` (inclusive) of `url` at their offset.
+
+    An interrupted segment is resumed from the last byte written.
+
+    """
+    position = start
+    for attempt in range(1, max_attempts + 1):
+        try:
+            headers = {"Range": f"bytes={position}-{end}"}
+            async with session.get(url, headers=headers, timeout=timeout) as response:
+                if response.status == 200:
+                    response.close()
+                    raise RangesIgnored(f"{url} answered the range {position}-{end} with the whole body")
+                elif response.status != 206:
+                    raise_for_status(url, response.status)
+                with open(part_path, "r+b") as f_handle:
+                    f_handle.seek(position)
+                    async for chunk in response.content.iter_chunked(DOWNLOAD_CHUNK_SIZE):
+                        f_handle.write(chunk)
+                        position += len(chunk)
+                        tracing.add_bytes(len(chunk))
+
+            if position != end + 1:
+                raise IncompleteDownload(f"received {position - start} of {end + 1 - start} bytes "
+                                         f"for the segment starting at {start}")
+            return
+        except (ClientError, asyncio.TimeoutError, IncompleteDownload) as e:
+            if attempt == max_attempts:
+                raise
+            print(f"Download of {url} segment {start}-{end} interrupted ({e!r}). "
+                  f"Resuming, attempt {attempt + 1}")
+            tracing.retried()
+        except ServerError as e:
+            if attempt == max_attempts:
+                raise
+            delay = server_error_delay(attempt)
+            print(f"Download of {url} segment {start}-{end} answered with status {e.status}. "
+                  f"Retrying in {delay}s, attempt {attempt + 1}")
+            tracing.retried()
+            await asyncio.sleep(delay)
+
+
+def _content_range_total(content_range: str):
+    """Returns the total length from a `bytes start-end/total` header.
+
+    """
+    if content_range and "/" in content_range:
+        total = content_range.rsplit("/", 1)[1]
+        if total.isdigit():
+            return int(total)
+    return None
 
 
-async def download_file(url: str, filename: str) -> None:
-    async with ClientSession() as session:
-        async with session.get(url) as response:
-            with open(filename, "wb") as f_handle:
-                while True:
-                    chunk = await response.content.read(1024)
-                    if not chunk:
-                        break
-                    f_handle.write(chunk)
-            return await response.release()
+def verify_download(path: str) -> None:
+    """Checks that a downloaded PDF or zip file is not truncated.
+
+    A PDF must end with the `%%EOF` trailer and a zip must have a readable
+    central directory. Any other kind of file is accepted as is.
+
+    """
+    if path.endswith(".part"):
+        kind = os.path.splitext(path[:-len(".part")])[1]
+    else:
+        kind = os.path.splitext(path)[1]
+
+    if kind == ".pdf":
+        with open(path, "rb") as f_handle:
+            f_handle.seek(max(0, os.path.getsize(path) - PDF_TRAILER_SEARCH_SIZE))
+            if b"%%EOF" not in f_handle.read():
+                raise CorruptDownload(f"{path} has no %%EOF trailer")
+    elif kind == ".zip":
+        try:
+            with zipfile.ZipFile(path) as zip_file:
+                zip_file.infolist()
+        except zipfile.BadZipFile as e:
+            raise CorruptDownload(f"{path} has no valid central directory: {e}")
 
 
 async def build_url(base_url: str, item_id: str, endpoint: str) -> str:
@@ -48,51 +515,40 @@ async def build_url(base_url: str, item_id: str, endpoint: str) -> str:
     )
 
 
+def is_cnx_index(filename: str) -> bool:
+    """Returns True for the index.cnxml.html member of a module export zip.
+
+    """
+    return filename.endswith("/index.cnxml.html")
+
+
 def fix_cnx_zip(zip_path):
     """Fixes a downloaded cnx zip file by removing the index.cnxml.html file.
 
     When a zip is uploaded that contains an index.cnxml.html file it causes an
-    Integrity error during publishing. To avoid this we search the downloaded
-    zip file for the index.cnxml.html file. If one is found we extract the zip
-    into a temporary directory remove the file and create a new zip with
-    `_fixed.zip` appended to it.
+    Integrity error during publishing. To avoid this we search the central
+    directory of the downloaded zip for the index.cnxml.html file. If one is
+    found the other members are copied, still compressed, into a new zip with
+    `_fixed.zip` appended to it. If there is nothing to remove the original
+    zip is returned as is.
 
     """
-    def create_zip(dir_path, archive_path):
-        zip = zipfile.ZipFile(archive_path, 'w')
-        for root, dirs, files in os.walk(extract_path):
-            for file in files:
-                new_filepath = os.path.join(root, file)
-                zip.write(new_filepath, os.path.basename(new_filepath))
-        zip.close()
+    with zipfile.ZipFile(zip_path, "r") as zip_file:
+        if not any(is_cnx_index(name) for name in zip_file.namelist()):
+            return zip_path
 
     # Get the name of the module zip file from the path
-    zip_name = zip_path.split("/")[-1]
+    zip_name = os.path.basename(zip_path)
     module_id = zip_name.replace(".zip", "")
     new_zip_name = f"{module_id}_fixed.zip"
     new_zip_path = os.path.join(DOWNLOAD_PATH, new_zip_name)
-    cnx_index_regex = re.compile(r".*/index.cnxml.html")
-
-    zip = zipfile.ZipFile(zip_path, "r")
-
-    # Find the directory name the zip will extract as
-    temp_item = zip.namelist()[0]
-    temp_dir_name = temp_item[:temp_item.find('/')]
-
-    for filename in zip.namelist():
-        if re.search(cnx_index_regex, filename):
-            # Extract zip to a temp dir
-            with TemporaryDirectory() as tmp_dir:
-                extract_path = os.path.join(tmp_dir, temp_dir_name)
-                zip.extractall(path=tmp_dir)
 
-                # Remove the index.cnxml.html file from the archive
-                os.remove(os.path.join(extract_path, "index.cnxml.html"))
-
-                # Create a new zip with the removed file
-                create_zip(extract_path, new_zip_path)
-
-                break
+    try:
+        filter_zip(zip_path, new_zip_path + ".part", is_cnx_index)
+    except Exception:
+        if os.path.exists(new_zip_path + ".part"):
+            os.remove(new_zip_path + ".part")
+        raise
+    os.replace(new_zip_path + ".part", new_zip_path)
 
     return new_zip_path
-
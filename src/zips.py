@@ -0,0 +1,479 @@
+import os
+import shutil
+import struct
+import zipfile
+from typing import BinaryIO, Callable, Dict, List, NamedTuple, Tuple
+from xml.etree import ElementTree
+
+_EOCD_SIGNATURE = b"PK\x05\x06"
+_EOCD_STRUCT = struct.Struct("<4s4H2LH")
+_CENTRAL_DIR_SIGNATURE = b"PK\x01\x02"
+_CENTRAL_DIR_STRUCT = struct.Struct("<4s6H3L5H2L")
+_LOCAL_HEADER_SIZE = 30
+_MAX_COMMENT_SIZE = 0xFFFF
+_ZIP64_MARKER = 0xFFFFFFFF
+_UTF8_FLAG = 0x800
+_CNXML_NAMESPACE = "{http://cnx.rice.edu/cnxml}"
+_MDML_NAMESPACE = "{http://cnx.rice.edu/mdml}"
+
+
+class UnsupportedZip(Exception):
+    """Raised for archives the raw rewriters can't handle, such as zip64 files.
+
+    """
+
+
+class _Member(NamedTuple):
+    name: str
+    header_offset: int
+    record: bytes
+
+
+def filter_zip(src_path: str, dst_path: str, exclude: Callable[[str], bool]) -> List[str]:
+    """Copies a zip to `dst_path` leaving out the members `exclude` returns True for.
+
+    The kept members are copied byte for byte, local header, compressed data
+    and data descriptor included, so nothing is decompressed or recompressed.
+    Only the central directory is written anew, with the new member offsets.
+    Archives the raw copy can't handle are rewritten member by member with
+    `zipfile` instead. Returns the names of the members that were left out.
+
+    """
+    with open(src_path, "rb") as src:
+        try:
+            return _filter_raw(src, dst_path, exclude)
+        except UnsupportedZip:
+            pass
+
+    return _filter_with_zipfile(src_path, dst_path, exclude)
+
+
+def _filter_raw(src: BinaryIO, dst_path: str, exclude: Callable[[str], bool]) -> List[str]:
+    total_entries, cd_size, cd_offset, comment = _read_end_record(src)
+
+    src.seek(cd_offset)
+    members = _read_central_directory(src.read(cd_size), total_entries)
+
+    # Each member's raw bytes run from its local header to the next member's
+    ends = sorted(member.header_offset for member in members) + [cd_offset]
+    next_offset = {start: end for start, end in zip(ends, ends[1:])}
+
+    removed = []
+    central_directory = []
+    with open(dst_path, "wb") as dst:
+        for member in members:
+            if exclude(member.name):
+                removed.append(member.name)
+                continue
+
+            new_offset = dst.tell()
+            src.seek(member.header_offset)
+            _copy_bytes(src, dst, next_offset[member.header_offset] - member.header_offset)
+            central_directory.append(member.record[:42] + struct.pack("<L", new_offset) + member.record[46:])
+
+        new_cd_offset = dst.tell()
+        for record in central_directory:
+            dst.write(record)
+        new_cd_size = dst.tell() - new_cd_offset
+
+        dst.write(_EOCD_STRUCT.pack(_EOCD_SIGNATURE, 0, 0, len(central_directory), len(central_directory),
+                                    new_cd_size, new_cd_offset, len(comment)))
+        dst.write(comment)
+
+    return removed
+
+
+def _find_end_record(src: BinaryIO):
+    """Returns the offset and bytes (comment included) of the end of central directory record.
+
+    """
+    src.seek(0, os.SEEK_END)
+    size = src.tell()
+    search_size = min(size, _EOCD_STRUCT.size + _MAX_COMMENT_SIZE)
+    src.seek(size - search_size)
+    tail = src.read(search_size)
+
+    position = tail.rfind(_EOCD_SIGNATURE)
+    while position >= 0:
+        comment_size = struct.unpack("<H", tail[position + 20:position + 22])[0]
+        if position + _EOCD_STRUCT.size + comment_size == len(tail):
+            return size - search_size + position, tail[position:]
+        position = tail.rfind(_EOCD_SIGNATURE, 0, position)
+
+    raise zipfile.BadZipFile("File is not a zip file")
+
+
+def _read_end_record(src: BinaryIO) -> Tuple[int, int, int, bytes]:
+    """Returns the entry count, central directory size and offset and comment of a zip.
+
+    Raises UnsupportedZip for the archives the raw copies can't handle:
+    multi-disk and zip64 ones, and ones whose central directory isn't right
+    before its end record, whose offsets would be off.
+
+    """
+    eocd_offset, eocd = _find_end_record(src)
+    (_, disk, cd_disk, disk_entries, total_entries,
+     cd_size, cd_offset, _) = _EOCD_STRUCT.unpack(eocd[:_EOCD_STRUCT.size])
+    if disk or cd_disk or disk_entries != total_entries:
+        raise UnsupportedZip("multi-disk archives are not supported")
+    if total_entries == 0xFFFF or _ZIP64_MARKER in (cd_size, cd_offset):
+        raise UnsupportedZip("zip64 archives are not supported")
+    if cd_offset + cd_size != eocd_offset:
+        raise UnsupportedZip("the central directory is not right before its end record, e.g. data was prepended")
+    return total_entries, cd_size, cd_offset, eocd[_EOCD_STRUCT.size:]
+
+
+def _read_central_directory(data: bytes, total_entries: int) -> List[_Member]:
+    members = []
+    position = 0
+    for _ in range(total_entries):
+        fields = _CENTRAL_DIR_STRUCT.unpack(data[position:position + _CENTRAL_DIR_STRUCT.size])
+        if fields[0] != _CENTRAL_DIR_SIGNATURE:
+            raise zipfile.BadZipFile("Bad magic number for central directory")
+
+        flags = fields[3]
+        name_size, extra_size, comment_size = fields[10], fields[11], fields[12]
+        header_offset = fields[16]
+        if _ZIP64_MARKER in (fields[8], fields[9], header_offset):
+            raise UnsupportedZip("zip64 members are not supported")
+
+        record_size = _CENTRAL_DIR_STRUCT.size + name_size + extra_size + comment_size
+        record = data[position:position + record_size]
+        raw_name = record[_CENTRAL_DIR_STRUCT.size:_CENTRAL_DIR_STRUCT.size + name_size]
+        name = raw_name.decode("utf-8" if flags & _UTF8_FLAG else "cp437")
+
+        members.append(_Member(name, header_offset, record))
+        position += record_size
+
+    return members
+
+
+def _copy_bytes(src: BinaryIO, dst: BinaryIO, length: int, chunk_size: int = 1024 * 1024) -> None:
+    while length > 0:
+        chunk = src.read(min(chunk_size, length))
+        if not chunk:
+            raise zipfile.BadZipFile("Truncated zip member")
+        dst.write(chunk)
+        length -= len(chunk)
+
+
+def _filter_with_zipfile(src_path: str, dst_path: str, exclude: Callable[[str], bool]) -> List[str]:
+    removed = []
+    with zipfile.ZipFile(src_path) as src, zipfile.ZipFile(dst_path, "w") as dst:
+        for info in src.infolist():
+            if exclude(info.filename):
+                removed.append(info.filename)
+                continue
+            with src.open(info) as member, dst.open(info, "w", force_zip64=True) as copy:
+                shutil.copyfileobj(member, copy)
+    return removed
+
+
+def split_collection_zip(zip_path: str, dst_dir: str, exclude: Callable[[str], bool]) -> List[Dict[str, str]]:
+    """Splits the complete export zip of a collection into a zip per module.
+
+    Every directory of the collection zip with an index.cnxml is a module,
+    named by the directory. Its members are written to `{module_id}.zip` in
+    `dst_dir` under a `{module_id}/` directory, like the export zip of the
+    module, leaving out the members `exclude` returns True for. The members
+    are copied byte for byte with only their names changed, so nothing is
+    decompressed or recompressed, unless the archive is one the raw copy
+    can't handle. Returns the id and zip path of every module, in the order
+    of the collection zip.
+
+    """
+    with zipfile.ZipFile(zip_path) as zip_file:
+        names = zip_file.namelist()
+    prefixes = [name[:-len("index.cnxml")] for name in names
+                if name == "index.cnxml" or name.endswith("/index.cnxml")]
+    # The innermost module directory a member is in, in case modules are nested
+    prefixes.sort(key=len, reverse=True)
+
+    modules = {}
+    for name in names:
+        prefix = next((prefix for prefix in prefixes if name.startswith(prefix)), None)
+        if prefix is None or name.endswith("/") or exclude(name):
+            continue
+        module_id = os.path.basename(prefix.rstrip("/"))
+        if not module_id:
+            raise Exception(f"{zip_path} has an index.cnxml outside of a module directory")
+        modules.setdefault(module_id, {})[name] = f"{module_id}/{name[len(prefix):]}"
+
+    try:
+        with open(zip_path, "rb") as src:
+            split = _split_raw(src, dst_dir, modules)
+    except UnsupportedZip:
+        split = _split_with_zipfile(zip_path, dst_dir, modules)
+
+    for path in split.values():
+        os.replace(path + ".part", path)
+    return [dict(module_id=module_id, zip_path=path) for module_id, path in split.items()]
+
+
+def _split_raw(src: BinaryIO, dst_dir: str, modules: Dict[str, Dict[str, str]]) -> Dict[str, str]:
+    total_entries, cd_size, cd_offset, _ = _read_end_record(src)
+
+    src.seek(cd_offset)
+    members = {member.name: member for member in _read_central_directory(src.read(cd_size), total_entries)}
+    ends = sorted(member.header_offset for member in members.values()) + [cd_offset]
+    next_offset = {start: end for start, end in zip(ends, ends[1:])}
+
+    split = {}
+    for module_id, renames in modules.items():
+        path = os.path.join(dst_dir, f"{module_id}.zip")
+        central_directory = []
+        with open(path + ".part", "wb") as dst:
+            for name, new_name in renames.items():
+                member = members[name]
+                new_offset = dst.tell()
+                raw_name = new_name.encode("utf-8")
+                flags = struct.unpack("<H", member.record[8:10])[0] | _UTF8_FLAG
+
+                src.seek(member.header_offset)
+                header = src.read(_LOCAL_HEADER_SIZE)
+                name_size, extra_size = struct.unpack("<2H", header[26:30])
+                src.seek(name_size, os.SEEK_CUR)
+                dst.write(header[:6] + struct.pack("<H", flags) + header[8:26]
+                          + struct.pack("<2H", len(raw_name), extra_size) + raw_name)
+                _copy_bytes(src, dst, next_offset[member.header_offset] - member.header_offset
+                            - _LOCAL_HEADER_SIZE - name_size)
+
+                record_name_size = struct.unpack("<H", member.record[28:30])[0]
+                central_directory.append(member.record[:8] + struct.pack("<H", flags) + member.record[10:28]
+                                         + struct.pack("<H", len(raw_name)) + member.record[30:42]
+                                         + struct.pack("<L", new_offset) + raw_name
+                                         + member.record[_CENTRAL_DIR_STRUCT.size + record_name_size:])
+
+            new_cd_offset = dst.tell()
+            for record in central_directory:
+                dst.write(record)
+            dst.write(_EOCD_STRUCT.pack(_EOCD_SIGNATURE, 0, 0, len(central_directory), len(central_directory),
+                                        dst.tell() - new_cd_offset, new_cd_offset, 0))
+        split[module_id] = path
+
+    return split
+
+
+def _split_with_zipfile(zip_path: str, dst_dir: str, modules: Dict[str, Dict[str, str]]) -> Dict[str, str]:
+    split = {}
+    with zipfile.ZipFile(zip_path) as src:
+        for module_id, renames in modules.items():
+            path = os.path.join(dst_dir, f"{module_id}.zip")
+            with zipfile.ZipFile(path + ".part", "w") as dst:
+                for name, new_name in renames.items():
+                    info = zipfile.ZipInfo(new_name, src.getinfo(name).date_time)
+                    info.compress_type = src.getinfo(name).compress_type
+                    with src.open(name) as member, dst.open(info, "w", force_zip64=True) as copy:
+                        shutil.copyfileobj(member, copy)
+            split[module_id] = path
+    return split
+
+
+def read_cnxml_metadata(zip_path: str) -> Dict[str, str]:
+    """Reads the metadata of a module from the index.cnxml member of its export zip.
+
+    Only that member is decompressed, and only up to the end of its metadata
+    block, so the images and other files in the zip are never read. Returns
+    the text of the simple md: elements of the metadata by their local name,
+    e.g. title, version and content-id. The document title is used when the
+    metadata has no title. Zips without a readable index.cnxml return an
+    empty dict.
+
+    """
+    with zipfile.ZipFile(zip_path) as zip_file:
+        name = next((name for name in zip_file.namelist()
+                     if name == "index.cnxml" or name.endswith("/index.cnxml")), None)
+        if name is None:
+            return {}
+
+        metadata = {}
+        document_title = None
+        with zip_file.open(name) as member:
+            try:
+                for _, element in ElementTree.iterparse(member):
+                    if element.tag == f"{_CNXML_NAMESPACE}title" and document_title is None:
+                        document_title = (element.text or "").strip()
+                    elif element.tag == f"{_CNXML_NAMESPACE}metadata":
+                        for child in element:
+                            if child.tag.startswith(_MDML_NAMESPACE) and len(child) == 0 and child.text:
+                                metadata[child.tag[len(_MDML_NAMESPACE):]] = child.text.strip()
+                        break
+            except ElementTree.ParseError as e:
+                print(f"could not read the metadata of {name} in {zip_path}: {e}")
+
+    if not metadata.get("title") and document_title:
+        metadata["title"] = document_title
+    return metadata
+
+
+class ZipStreamFilter:
+    """Leaves members out of a zip while its bytes arrive, e.g. from a download.
+
+    Feed the archive in order with `feed`, write out whatever it returns, then
+    write what `close` returns. Local headers are parsed as they come in. Kept
+    members are passed through untouched and left out members are skipped
+    without being buffered. The central directory at the end of the archive is
+    collected, stripped of the removed members, given the new offsets and
+    written out by `close`.
+
+    Members whose sizes are only given in a data descriptor are followed by
+    scanning their data for the descriptor's signature, which is only taken
+    for the end of the member when the compressed size in it matches the
+    bytes that came before it. Nothing is decompressed. Archives that can't
+    be filtered as a stream, e.g. ones whose descriptors have no signature,
+    raise UnsupportedZip.
+
+    """
+    _LOCAL_HEADER_SIGNATURE = b"PK\x03\x04"
+    _LOCAL_HEADER_STRUCT = struct.Struct("<4s5H3L2H")
+    _DESCRIPTOR_SIGNATURE = b"PK\x07\x08"
+    _DESCRIPTOR_FLAG = 0x08
+    _DESCRIPTOR_STRUCT = struct.Struct("<4s3L")
+
+    def __init__(self, exclude: Callable[[str], bool]):
+        self.exclude = exclude
+        self.removed = []
+        self._buffer = bytearray()
+        self._offset = 0
+        self._out_offset = 0
+        self._new_offsets = {}
+        self._state = self._read_header
+        self._keep = True
+        self._remaining = 0
+        self._member_size = 0
+        self._scan_from = 0
+        self._tail = bytearray()
+
+    def feed(self, data: bytes) -> bytes:
+        self._buffer += data
+        out = bytearray()
+        while self._buffer and self._state(out):
+            pass
+        self._out_offset += len(out)
+        return bytes(out)
+
+    def close(self) -> bytes:
+        if self._state == self._read_described:
+            raise UnsupportedZip("a member's data descriptor has no signature")
+        if self._state != self._read_tail or self._buffer:
+            raise zipfile.BadZipFile("The zip ended in the middle of a member")
+
+        eocd_position = self._tail.rfind(_EOCD_SIGNATURE)
+        if eocd_position < 0:
+            raise zipfile.BadZipFile("The zip has no end of central directory record")
+        eocd = bytes(self._tail[eocd_position:])
+        (_, disk, _, _, total_entries,
+         cd_size, _, comment_size) = _EOCD_STRUCT.unpack(eocd[:_EOCD_STRUCT.size])
+        if disk or total_entries == 0xFFFF or cd_size == _ZIP64_MARKER or cd_size > eocd_position:
+            raise UnsupportedZip("zip64 and multi-disk archives can't be filtered as a stream")
+
+        members = _read_central_directory(bytes(self._tail[eocd_position - cd_size:eocd_position]),
+                                          total_entries)
+        kept = [member for member in members if member.header_offset in self._new_offsets]
+        out = bytearray()
+        for member in kept:
+            new_offset = self._new_offsets[member.header_offset]
+            out += member.record[:42] + struct.pack("<L", new_offset) + member.record[46:]
+
+        out += _EOCD_STRUCT.pack(_EOCD_SIGNATURE, 0, 0, len(kept), len(kept), len(out), self._out_offset,
+                                 comment_size)
+        out += eocd[_EOCD_STRUCT.size:]
+        return bytes(out)
+
+    def _take(self, size: int) -> bytes:
+        data = bytes(self._buffer[:size])
+        del self._buffer[:size]
+        self._offset += len(data)
+        return data
+
+    def _read_header(self, out: bytearray) -> bool:
+        if len(self._buffer) < 4:
+            return False
+        signature = bytes(self._buffer[:4])
+        if signature != self._LOCAL_HEADER_SIGNATURE:
+            # Local headers are done. The central directory is collected until close
+            self._state = self._read_tail
+            return True
+
+        header_size = self._LOCAL_HEADER_STRUCT.size
+        if len(self._buffer) < header_size:
+            return False
+        fields = self._LOCAL_HEADER_STRUCT.unpack(self._buffer[:header_size])
+        flags, compress_size = fields[2], fields[7]
+        name_size, extra_size = fields[9], fields[10]
+        if len(self._buffer) < header_size + name_size + extra_size:
+            return False
+
+        header_offset = self._offset
+        header = self._take(header_size + name_size + extra_size)
+        raw_name = header[header_size:header_size + name_size]
+        name = raw_name.decode("utf-8" if flags & _UTF8_FLAG else "cp437")
+
+        self._keep = not self.exclude(name)
+        if self._keep:
+            self._new_offsets[header_offset] = self._out_offset + len(out)
+            out += header
+        else:
+            self.removed.append(name)
+
+        if flags & self._DESCRIPTOR_FLAG:
+            self._member_size = 0
+            self._scan_from = 0
+            self._state = self._read_described
+        else:
+            if compress_size == _ZIP64_MARKER:
+                raise UnsupportedZip(f"{name} is a zip64 member")
+            self._remaining = compress_size
+            self._state = self._read_data
+        return True
+
+    def _read_data(self, out: bytearray) -> bool:
+        data = self._take(self._remaining)
+        self._remaining -= len(data)
+        if self._keep:
+            out += data
+        if self._remaining == 0:
+            self._state = self._read_header
+        return True
+
+    def _read_described(self, out: bytearray) -> bool:
+        position = self._buffer.find(self._DESCRIPTOR_SIGNATURE, self._scan_from)
+        if position < 0:
+            # The last bytes could be the start of a signature that is cut off
+            self._pass_data(max(0, len(self._buffer) - len(self._DESCRIPTOR_SIGNATURE) + 1), out)
+            return False
+        if len(self._buffer) < position + self._DESCRIPTOR_STRUCT.size:
+            self._pass_data(position, out)
+            return False
+
+        compress_size = self._DESCRIPTOR_STRUCT.unpack(
+            self._buffer[position:position + self._DESCRIPTOR_STRUCT.size])[2]
+        if compress_size != self._member_size + position:
+            # The signature's bytes happen to be in the compressed data
+            self._scan_from = position + 1
+            return True
+        self._pass_data(position, out)
+        self._state = self._read_descriptor
+        return True
+
+    def _pass_data(self, size: int, out: bytearray) -> None:
+        data = self._take(size)
+        self._member_size += len(data)
+        self._scan_from = 0
+        if self._keep:
+            out += data
+
+    def _read_descriptor(self, out: bytearray) -> bool:
+        if len(self._buffer) < 16:
+            return False
+        size = 16 if bytes(self._buffer[:4]) == self._DESCRIPTOR_SIGNATURE else 12
+        descriptor = self._take(size)
+        if self._keep:
+            out += descriptor
+        self._state = self._read_header
+        return True
+
+    def _read_tail(self, out: bytearray) -> bool:
+        self._tail += self._buffer
+        del self._buffer[:]
+        return False
@@ -0,0 +1,64 @@
+import pytest
+
+from src.pages.cc_license import CcLicense
+from src.pages.confirm_publish import ConfirmPublish
+from src.pages.content_publish import ContentPublish
+from src.pages.content_published import ContentPublished
+from src.pages.login_form import LoginForm
+from src.pages.metadata_edit import MetadataEdit
+from src.pages.module_edit import ModuleEdit
+from src.pages.module_import import ModuleImport
+from src.pages.my_cnx import MyCnx
+
+# The urls a browser goes through on legacy.cnx.org while a module is created, imported and published
+LEGACY_URLS = {
+    LoginForm: [
+        "https://legacy.cnx.org/login_form",
+        "https://legacy.cnx.org/acl_users/credentials_cookie_auth/require_login?came_from=https%3A//legacy.cnx.org/mycnx",
+    ],
+    MyCnx: [
+        "https://legacy.cnx.org/mycnx",
+        "https://legacy.cnx.org/mycnx/",
+    ],
+    CcLicense: [
+        "https://legacy.cnx.org/mydashboard/cc_license?type_name=Module",
+        "https://legacy.cnx.org/mydashboard/cc_license?type_name=Collection",
+    ],
+    MetadataEdit: [
+        "https://legacy.cnx.org/Members/openstax/module.2021-03-01.3261783482/content_title",
+        "https://legacy.cnx.org/Members/openstax/collection.2021-03-01.0467295151/content_title",
+    ],
+    ModuleEdit: [
+        "https://legacy.cnx.org/Members/openstax/module.2021-03-01.3261783482",
+        "https://legacy.cnx.org/Members/openstax/m68143/",
+    ],
+    ModuleImport: [
+        "https://legacy.cnx.org/Members/openstax/module.2021-03-01.3261783482/module_import_form",
+    ],
+    ContentPublish: [
+        "https://legacy.cnx.org/Members/openstax/module.2021-03-01.3261783482/module_publish",
+        "https://legacy.cnx.org/Members/openstax/col23456/collection_publish",
+    ],
+    ConfirmPublish: [
+        "https://legacy.cnx.org/Members/openstax/module.2021-03-01.3261783482/module_publish_description",
+        "https://legacy.cnx.org/Members/openstax/col23456/collection_publish_description",
+    ],
+    ContentPublished: [
+        "https://legacy.cnx.org/Members/openstax/module.2021-03-01.3261783482/publishContent",
+    ],
+}
+
+
+@pytest.mark.parametrize("page", LEGACY_URLS)
+def test_page_matches_its_urls(page):
+    for url in LEGACY_URLS[page]:
+        assert page.matches_url(url), url
+
+
+@pytest.mark.parametrize("page", LEGACY_URLS)
+def test_page_does_not_match_other_pages_urls(page):
+    for other_page, urls in LEGACY_URLS.items():
+        if other_page is page:
+            continue
+        for url in urls:
+            assert not page.matches_url(url), f"{page.__name__} matches the {other_page.__name__} url {url}"
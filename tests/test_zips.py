@@ -0,0 +1,112 @@
+import os
+import zipfile
+
+import pytest
+
+from src import utils, zips
+from src.utils import fix_cnx_zip, is_cnx_index
+from src.zips import filter_zip, read_cnxml_metadata, split_collection_zip
+
+CNXML = ('<document xmlns="http://cnx.rice.edu/cnxml" xmlns:md="http://cnx.rice.edu/mdml">'
+         '<metadata><md:title>Module {id}</md:title><md:version>1.{version}</md:version></metadata></document>')
+
+
+def write_module_zip(path, module_id="m1", comment=b""):
+    with zipfile.ZipFile(path, "w", zipfile.ZIP_DEFLATED) as zip_file:
+        zip_file.comment = comment
+        zip_file.writestr(f"{module_id}/index.cnxml", CNXML.format(id=module_id, version=1))
+        zip_file.writestr(f"{module_id}/index.cnxml.html", "<html/>")
+        zip_file.writestr(f"{module_id}/image.png", os.urandom(4096), zipfile.ZIP_STORED)
+    # A member written as a stream has a data descriptor after its data
+    with zipfile.ZipFile(path, "a") as zip_file:
+        with zip_file.open(f"{module_id}/notes.txt", "w") as member:
+            member.write(b"notes " * 500)
+
+
+def write_collection_zip(path, module_ids=("m1", "m2")):
+    with zipfile.ZipFile(path, "w", zipfile.ZIP_DEFLATED) as zip_file:
+        zip_file.writestr("col1_1.7_complete/collection.xml", "<collection/>")
+        for number, module_id in enumerate(module_ids):
+            prefix = f"col1_1.7_complete/{module_id}/"
+            zip_file.writestr(prefix, "")
+            zip_file.writestr(prefix + "index.cnxml", CNXML.format(id=module_id, version=number))
+            zip_file.writestr(prefix + "index.cnxml.html", "<html/>")
+            zip_file.writestr(prefix + "image é.png", os.urandom(4096))
+    with zipfile.ZipFile(path, "a") as zip_file:
+        with zip_file.open(f"col1_1.7_complete/{module_ids[-1]}/notes.txt", "w") as member:
+            member.write(b"notes " * 500)
+
+
+@pytest.fixture
+def raw_only(monkeypatch):
+    # Fail the tests that would pass only because the zipfile fallback covered for the raw copy
+    def fallback(*args):
+        raise AssertionError("the zipfile fallback was used")
+
+    monkeypatch.setattr(zips, "_filter_with_zipfile", fallback)
+    monkeypatch.setattr(zips, "_split_with_zipfile", fallback)
+
+
+def test_filter_zip_copies_the_kept_members(tmp_path, raw_only):
+    src_path, dst_path = tmp_path / "m1.zip", tmp_path / "m1_filtered.zip"
+    write_module_zip(src_path, comment=b"exported from legacy")
+
+    removed = filter_zip(str(src_path), str(dst_path), is_cnx_index)
+
+    assert removed == ["m1/index.cnxml.html"]
+    with zipfile.ZipFile(src_path) as src, zipfile.ZipFile(dst_path) as dst:
+        assert dst.testzip() is None
+        assert dst.namelist() == ["m1/index.cnxml", "m1/image.png", "m1/notes.txt"]
+        assert dst.comment == b"exported from legacy"
+        for name in dst.namelist():
+            assert dst.read(name) == src.read(name)
+
+
+def test_fix_cnx_zip_removes_the_index_html(tmp_path, monkeypatch, raw_only):
+    monkeypatch.setattr(utils, "DOWNLOAD_PATH", str(tmp_path))
+    zip_path = tmp_path / "m1.zip"
+    write_module_zip(zip_path)
+
+    fixed_path = fix_cnx_zip(str(zip_path))
+
+    assert fixed_path == str(tmp_path / "m1_fixed.zip")
+    assert not os.path.exists(fixed_path + ".part")
+    with zipfile.ZipFile(fixed_path) as fixed:
+        assert "m1/index.cnxml.html" not in fixed.namelist()
+
+
+def test_split_collection_zip_writes_a_zip_per_module(tmp_path, raw_only):
+    zip_path = tmp_path / "col1_complete.zip"
+    write_collection_zip(zip_path)
+
+    split = split_collection_zip(str(zip_path), str(tmp_path), is_cnx_index)
+
+    assert [module["module_id"] for module in split] == ["m1", "m2"]
+    with zipfile.ZipFile(zip_path) as src:
+        for module in split:
+            module_id = module["module_id"]
+            with zipfile.ZipFile(module["zip_path"]) as dst:
+                assert dst.testzip() is None
+                assert f"{module_id}/index.cnxml.html" not in dst.namelist()
+                for name in dst.namelist():
+                    assert dst.read(name) == src.read(f"col1_1.7_complete/{name}")
+    assert read_cnxml_metadata(split[1]["zip_path"]) == {"title": "Module m2", "version": "1.1"}
+    assert not [name for name in os.listdir(tmp_path) if name.endswith(".part")]
+
+
+@pytest.mark.parametrize("write_zip", [write_module_zip, write_collection_zip])
+def test_prepended_data_falls_back_to_zipfile(tmp_path, write_zip):
+    zip_path = tmp_path / "prepended.zip"
+    write_zip(zip_path)
+    zip_path.write_bytes(b"#!/bin/sh\n" + zip_path.read_bytes())
+
+    with open(zip_path, "rb") as src, pytest.raises(zips.UnsupportedZip):
+        zips._filter_raw(src, str(tmp_path / "raw.zip"), is_cnx_index)
+
+    if write_zip is write_module_zip:
+        filter_zip(str(zip_path), str(tmp_path / "filtered.zip"), is_cnx_index)
+        with zipfile.ZipFile(tmp_path / "filtered.zip") as dst:
+            assert dst.testzip() is None
+    else:
+        split = split_collection_zip(str(zip_path), str(tmp_path), is_cnx_index)
+        assert [module["module_id"] for module in split] == ["m1", "m2"]